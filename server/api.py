@@ -1,18 +1,32 @@
+import hashlib
 import sys
 import traceback
 from json import loads
 from datetime import datetime
 
+from bson import ObjectId
+from bson.errors import InvalidId
 from flask import current_app, jsonify, request
 from flask_mongoengine import MongoEngine
 from flask_security import MongoEngineUserDatastore, Security
 
+import chunks
+from cache import map_cache
+from encoding import encoder
+from hashing import HasherBusy
 from helper import Helper
-from constants import json_tag, malformed_request, internal_error
+from constants import json_tag, malformed_request, internal_error, max_page_size, server_busy
 
+from mesh import meshed
 from models import GameMap, User, Role, Session
-from flask_socketio import SocketIO
-from mongoengine import DoesNotExist
+from mongoengine import DoesNotExist, ValidationError
+from pymongo import ReturnDocument
+from voxels import MapChanges, model_changes, validate_models
+
+# Map fields that can be asked for with fields= when listing maps.
+listable_fields = set(GameMap._fields) - {'id', 'models', 'voxels', 'chunked', 'writing'}
+# Map fields a client can change with a PUT.
+updatable_fields = {'name', 'color', 'width', 'height', 'depth', 'private', 'models'}
 
 
 class Api():
@@ -53,8 +67,11 @@ class Api():
             return jsonify(error=validation[1]), 422, json_tag
 
         # Hash and create user
-        self.user_datastore.create_user(
-            email=email, password=Helper.hashpw(password))
+        try:
+            password = Helper.hashpw(password)
+        except HasherBusy as e:
+            return server_busy(e.retry_after)
+        self.user_datastore.create_user(email=email, password=password)
 
         # So we can log user in automatically after registration
         token = User.objects(email=email).first().generate_auth_token()
@@ -84,7 +101,10 @@ class Api():
             current_app.logger.error(str(e))
             return jsonify(error="Malformed Request; expecting email and password"), 422, json_tag
 
-        validator = Helper.validate_auth(email, password)
+        try:
+            validator = Helper.validate_auth(email, password)
+        except HasherBusy as e:
+            return server_busy(e.retry_after)
 
         if validator[0] is True:
             return jsonify(error=validator[1]), 422, json_tag
@@ -99,13 +119,33 @@ class Api():
         claims -- The JWT claims that are being passed to this methods. Must include email.
         id -- The ID that is associated with the requested map.
 
+        With mesh=1 in the query, voxels, floors and walls come merged into
+        boxes under mesh and models only holds the other models, see mesh.py.
+
         Returns a HTTP response.
         """
-        game_map = None
-
         try:
-            game_map = GameMap.objects(id=id, owner=token_user.id).first()
-        except (StopIteration, DoesNotExist):
+            # Answer conditional requests from the revision alone, without loading models.
+            header = GameMap.find_raw(id=id, owner=token_user.id,
+                                      projection={'revision': 1, 'updated': 1})
+            if header is None:
+                return jsonify(error="Map does not exist"), 404, json_tag
+            etag = str(header.get('revision', 0))
+            if Helper.not_modified(etag, header.get('updated')):
+                return '', 304, Helper.cache_headers(etag, header.get('updated'))
+
+            def load():
+                game_map = GameMap.find_raw(id=header['_id'])
+                if game_map is None:
+                    raise DoesNotExist("Map " + id + " does not exist")
+                return game_map
+
+            if request.args.get('mesh') in ('1', 'true'):
+                response = Helper.map_json(header['_id'], header.get('revision', 0), lambda: meshed(load()),
+                                           'document.mesh')
+            else:
+                response = Helper.map_json(header['_id'], header.get('revision', 0), load)
+        except (StopIteration, DoesNotExist) as e:
             current_app.logger.error(e)
             # Malicious user may be trying to overwrite someone's map
             # or there actually is something wrong; treat these situations the same
@@ -114,30 +154,109 @@ class Api():
             current_app.logger.error(e)
             return internal_error()
 
-        return jsonify(game_map), 200, json_tag
+        return response, 200, dict(json_tag, **Helper.cache_headers(etag, header.get('updated')))
+
+    @staticmethod
+    def read_chunks(claims, token_user, map_id):
+        """Read the models of a range of chunks of a map.
+
+        Keyword arguments:
+        claims -- The JWT claims that are being passed to this methods. Must include email.
+        map_id -- The ID that is associated with the requested map.
+
+        The optional from and to query arguments are x,y,z chunk coordinates,
+        both included. A chunk covers chunks.chunk_size cells a side and
+        chunks without models are left out.
+
+        Returns a HTTP response with the map's revision, the chunk size and the chunks.
+        """
+        try:
+            bounds = [request.args.get(name) for name in ('from', 'to')]
+            bounds = [None if bound is None else [int(value) for value in bound.split(',')] for bound in bounds]
+            if any(bound is not None and len(bound) != 3 for bound in bounds):
+                raise ValueError("Chunk coordinates need x, y and z")
+        except ValueError:
+            return malformed_request()
+        low, high = bounds
+
+        try:
+            header = GameMap._get_collection().find_one({'_id': ObjectId(map_id), 'owner': token_user.id},
+                                                        projection={'revision': 1, 'updated': 1, 'chunked': 1})
+        except (InvalidId, TypeError):
+            header = None
+        if header is None:
+            return jsonify(error="Map does not exist"), 404, json_tag
+
+        try:
+            etag = str(header.get('revision', 0))
+            if Helper.not_modified(etag, header.get('updated')):
+                return '', 304, Helper.cache_headers(etag, header.get('updated'))
+            if header.get('chunked'):
+                found = chunks.read_chunks(header['_id'], low, high)
+            else:
+                # Maps stored whole are split here, so clients read every map the same way.
+                split = chunks.split(GameMap.find_raw(id=header['_id'])['models'])
+                found = [(coordinates, split[coordinates]) for coordinates in sorted(split)
+                         if all((low is None or low[i] <= coordinates[i]) and
+                                (high is None or coordinates[i] <= high[i]) for i in range(3))]
+            body = {'revision': header.get('revision', 0), 'chunk_size': chunks.chunk_size,
+                    'chunks': [{'x': x, 'y': y, 'z': z, 'models': models} for (x, y, z), models in found]}
+        except Exception as e:
+            current_app.logger.error(e)
+            return internal_error()
+
+        return Helper.mongo_json(body), 200, dict(json_tag, **Helper.cache_headers(etag, header.get('updated')))
 
     @staticmethod
     def read_list_of_maps(claims, token_user, user_id):
-        """Gather all maps associated with a user.
+        """Gather a page of the maps associated with a user, newest first.
 
         Keyword arguments:
         claims -- The JWT claims that are being passed to this methods. Must include email.
         id -- The ID that is associated with the requested map.
 
+        Query arguments:
+        limit -- Most maps to return, capped at max_page_size.
+        cursor -- The X-Next-Cursor header of the previous page.
+        fields -- Comma separated map fields to return. Models are never returned.
+
         Returns a HTTP response.
         """
-        map_list = None
         if token_user is None:
-            error = "token expired"
+            return jsonify(error="token expired"), 422, json_tag
         # I am assuming that the user will need to login again and I don't need to check password here
-        else:
-            map_list = GameMap.objects.exclude(
-                'models').filter(owner=token_user.id)
-            if map_list == None:
-                error = "map error"
-            else:
-                return jsonify(map_list), 200, json_tag
-        return jsonify(error=error), 422, json_tag
+
+        try:
+            limit = min(int(request.args.get('limit', max_page_size)), max_page_size)
+            if limit < 1:
+                raise ValueError("Limit must be positive")
+            after = None
+            if request.args.get('cursor'):
+                after = Helper.decode_cursor(request.args['cursor'])
+            projection = None
+            if request.args.get('fields'):
+                projection = request.args['fields'].split(',')
+                if not set(projection) <= listable_fields:
+                    raise ValueError("Unknown field")
+        except ValueError as e:
+            return malformed_request()
+
+        try:
+            map_list, next_key = GameMap.find_page(token_user.id, limit, after, projection)
+            # Every write of a map sets updated, so the ETag covers the maps on
+            # this page and where the next one starts, and the page asked for.
+            rows = [(game_map['_id'], game_map.get('updated')) for game_map in map_list]
+            etag = hashlib.md5((str(rows) + str(next_key) + request.query_string.decode()).encode()).hexdigest()
+            if Helper.not_modified(etag):
+                return '', 304, Helper.cache_headers(etag)
+        except Exception as e:
+            current_app.logger.error(str(e))
+            return internal_error()
+
+        headers = dict(json_tag, **Helper.cache_headers(etag))
+        if next_key is not None:
+            headers['X-Next-Cursor'] = Helper.encode_cursor(next_key)
+        return Helper.mongo_json(map_list), 200, headers
 
     @staticmethod
     def create_map(claims, token_user):
@@ -175,9 +294,23 @@ class Api():
             return malformed_request()
 
         try:
+            models, errors = validate_models(models, width, height, depth)
+        except ValueError:
+            return malformed_request()
+        if errors:
+            return jsonify(error="Invalid models", errors=errors), 422, json_tag
+
+        try:
+            # The models are validated above in one batch, skip mongoengine's per model validation.
             new_game_map = GameMap(owner=token_user.id, name=name, width=width, height=height,
-                                   depth=depth, color=color, private=private, models=models)
-            new_game_map.save()
+                                   depth=depth, color=color, private=private)
+            new_game_map.validate()
+        except ValidationError:
+            return malformed_request()
+
+        try:
+            new_game_map.models = models
+            new_game_map.save(validate=False)
         except Exception as e:
             current_app.logger.error("Failed to save map for user",
                                      str(token_user), "\n", str(e))
@@ -201,47 +334,160 @@ class Api():
         except Exception as e:
             current_app.logger.error(str(e))
             return malformed_request()
+        if type(map) is not dict or not set(map) <= updatable_fields:
+            return malformed_request()
 
         # Make sure this user is actually the author of the map
         # and that the ID also is an existing map
-        remote_copy = None
         try:
-            remote_copy = GameMap.objects(id=map_id, owner=token_user.id).first()
-        except (StopIteration, DoesNotExist) as e:
-            # Malicious user may be trying to overwrite someone's map
-            # or there actually is something wrong; treat these situations the same
-            return jsonify(error="Map does not exist"), 404, json_tag
+            map_id = GameMap.owned_id(map_id, token_user.id)
+            if map_id is None:
+                # Malicious user may be trying to overwrite someone's map
+                # or there actually is something wrong; treat these situations the same
+                return jsonify(error="Map does not exist"), 404, json_tag
+            # Models are only read when they change or must fit new dimensions.
+            remote_copy = None
+            if 'models' in map or any(key in map for key in ('width', 'height', 'depth')):
+                remote_copy = GameMap.find_raw(id=map_id)
         except Exception as e:
             current_app.logger.error(str(e))
             return internal_error()
 
+        if remote_copy is not None:
+            size = [map.get(key, remote_copy[key]) for key in ('width', 'height', 'depth')]
+            try:
+                models, errors = validate_models(map.get('models', remote_copy['models']), *size)
+            except ValueError:
+                return malformed_request()
+            if errors:
+                return jsonify(error="Invalid models", errors=errors), 422, json_tag
+            if 'models' in map:
+                map = dict(map, models=models)
+
         try:
-            remote_copy.update(**map)
-            game_map = GameMap.objects(id=map_id).first()
-            game_map = game_map.to_json()
-            game_map = loads(game_map)
-            name = game_map["name"]
-            color = game_map["color"]
-            models = game_map["models"]
-            depth = game_map["depth"]
-            height = game_map["height"]
-            width = game_map["width"]
-            if current_app.config['REDIS_HOST'] is None or current_app.config['REDIS_HOST'] == "":
-                socketio = SocketIO(message_queue='redis://')
+            models = map.pop('models', None)
+            map = {'set__' + key: value for key, value in map.items()}
+            # Read as Last-Modified and to order the list of maps.
+            map['set__updated'] = datetime.now()
+            if models is None:
+                changes = MapChanges()
+                written = GameMap.write(map_id, inc__revision=1, **map)
             else:
-                socketio = SocketIO(message_queue='redis://' +
-                                    current_app.config['REDIS_HOST'])
-            socketio.emit(
-                'update', {'name': name, 'color': color, 'models': models, 'height': height, 'width': width, 'depth': depth})
-            return jsonify(success="Map updated successfully", map=GameMap.objects(id=map_id).first()), 200, json_tag
-        except AttributeError as e:
-            # happens when remote copy is None
-            return jsonify(error="Map does not exist"), 404, json_tag
+                changes = model_changes(remote_copy['models'], models)
+                # Rewriting only the changed chunks is right as long as nobody
+                # wrote the map since it was read, otherwise rewrite them all.
+                written = GameMap.write(map_id, models, changes.keys(), {'revision': remote_copy.get('revision', 0)},
+                                        inc__revision=1, **map) \
+                    or GameMap.write(map_id, models, inc__revision=1, **map)
+            if not written:
+                # Another writer is rewriting the chunks of this map.
+                return server_busy(1)
+            map_cache.invalidate(map_id)
+            game_map = GameMap.find_raw(id=map_id)
+            Helper.broadcast_map_diff(map_id, game_map, changes.to_diff())
+            # Encoding the new revision here also serves the reads that follow from the cache.
+            body = map_cache.get(game_map['_id'], game_map.get('revision', 0), 'document',
+                                 lambda: encoder.encode(game_map))
+            body = b'{"success":"Map updated successfully","map":' + body + b'}'
+            return encoder.body_response(*encoder.compress(body, request.accept_encodings)), 200, json_tag
         except Exception as e:
             current_app.logger.error(str(e))
             traceback.print_exc()
             return internal_error()
 
+    @staticmethod
+    def patch_map(claims, token_user, map_id):
+        """Apply a batch of voxel edits to a map without rewriting it.
+
+        Keyword arguments:
+        claims -- The JWT claims that are being passed to this methods. Must include email.
+        map_id -- The ID that is associated with the requested map.
+
+        Returns a HTTP response with the new revision of the map.
+        """
+        try:
+            # Use a dict access here, not ".get". The access is better with the try block.
+            changes = request.json['changes']
+
+            # The test send changes as a string.
+            if type(changes) is not dict:
+                changes = loads(changes)
+            changes = MapChanges.from_json(changes)
+        except Exception as e:
+            if not current_app.testing:
+                current_app.logger.error(str(e))
+            return malformed_request()
+
+        try:
+            query = {'_id': ObjectId(map_id), 'owner': token_user.id}
+        except (InvalidId, TypeError):
+            return jsonify(error="Map does not exist"), 404, json_tag
+
+        try:
+            collection = GameMap._get_collection()
+            header = collection.find_one(query, projection={'width': 1, 'height': 1, 'depth': 1, 'chunked': 1})
+            if header is None:
+                # Malicious user may be trying to overwrite someone's map
+                # or there actually is something wrong; treat these situations the same
+                return jsonify(error="Map does not exist"), 404, json_tag
+            try:
+                changes.check_bounds(header['width'], header['height'], header['depth'])
+            except ValueError as e:
+                return jsonify(error=str(e)), 422, json_tag
+
+            stored = header if header.get('chunked') else \
+                GameMap.find_raw(projection={'voxels': 1, 'revision': 1}, voxels={'$type': 'binData'}, **query)
+            if stored is not None and stored.get('chunked'):
+                # Only the chunks holding the edited positions are read and rewritten.
+                game_map = GameMap.patch_chunks(query['_id'], changes)
+                if game_map is None:
+                    return server_busy(1)
+                map_cache.invalidate(query['_id'])
+            elif stored is not None:
+                # Packed maps can't be edited in place, so rewrite the blob,
+                # unless another write landed since it was read.
+                written = GameMap.write(query['_id'], changes.apply(stored['models']), changes.keys(),
+                                        {'revision': stored.get('revision', 0)}, storage='packed',
+                                        inc__revision=1, set__updated=datetime.now())
+                if not written:
+                    return server_busy(1)
+                map_cache.invalidate(query['_id'])
+                game_map = collection.find_one(query, projection={'models': 0, 'voxels': 0, 'chunked': 0,
+                                                                  'writing': 0})
+            else:
+                # Mongo refuses to pull, push and set the same array in one
+                # update, so each kind of operation gets its own round trip.
+                # The claim keeps other writers out until the last one.
+                claimed = GameMap.claim(query['_id'])
+                if claimed is None:
+                    return server_busy(1)
+                step = dict(query, writing=claimed[0])
+                try:
+                    pull = changes.pull_update()
+                    if pull is not None:
+                        collection.update_one(step, pull)
+                    recolor, array_filters = changes.recolor_update()
+                    if recolor is not None:
+                        collection.update_one(step, recolor, array_filters=array_filters)
+                    update = changes.push_update() or {}
+                    update['$inc'] = {'revision': 1}
+                    update['$set'] = {'updated': datetime.now()}
+                    update['$unset'] = {'writing': 1}
+                    game_map = collection.find_one_and_update(
+                        step, update, projection={'models': 0, 'voxels': 0, 'chunked': 0, 'writing': 0},
+                        return_document=ReturnDocument.AFTER)
+                except Exception:
+                    GameMap.release(query['_id'], claimed[0])
+                    raise
+                GameMap.refresh_summary(query)
+                map_cache.invalidate(query['_id'])
+            Helper.broadcast_map_diff(game_map['_id'], game_map, changes.to_diff())
+        except Exception as e:
+            current_app.logger.error(str(e))
+            return internal_error()
+
+        return jsonify(success="Map patched successfully", revision=game_map['revision']), 200, json_tag
+
     @staticmethod
     def delete_map(claims, token_user, map_id):
         """Delete map from database.
@@ -253,10 +499,13 @@ class Api():
         Returns a HTTP response.
         """
         try:
-            remote_copy = GameMap.objects(id=map_id, owner=token_user.id).first()
-            if remote_copy is None:
+            game_map_id = GameMap.owned_id(map_id, token_user.id)
+            if game_map_id is None:
                 return jsonify(error="Map does not exist"), 404, json_tag
-            remote_copy.delete()
+            # Delete by query so the map is never loaded.
+            GameMap.objects(id=game_map_id).delete()
+            chunks.delete_chunks(game_map_id)
+            map_cache.invalidate(game_map_id)
         except (StopIteration, DoesNotExist):
             # Malicious user may be trying to overwrite someone's map
             # or there actually is something wrong; treat these situations the same
@@ -282,9 +531,8 @@ class Api():
         # Make sure this user is actually the author of the map with map_id
         # and that the map_id is of an existing map
         try:
-            game_map = GameMap.objects(
-                id=map_id, owner=token_user.id).first()
-            if game_map is None:
+            game_map_id = GameMap.owned_id(map_id, token_user.id)
+            if game_map_id is None:
                 return jsonify(error="Map does not exist"), 404, json_tag
         except (StopIteration, DoesNotExist) as e:
             # Malicious user may be trying to overwrite someone's map
@@ -296,7 +544,7 @@ class Api():
 
         try:
             new_session = Session(user_id=token_user.id,
-                                  game_map_id=game_map.id)
+                                  game_map_id=game_map_id)
             new_session.save()
         except Exception as e:
             current_app.logger.error("Failed to save session for user",
@@ -346,10 +594,9 @@ class Api():
             return malformed_request()
 
         # Make sure the map is owned by the token user
-        game_map = None
         try:
-            game_map = GameMap.objects(id=map_id, owner=token_user.id).first()
-            if game_map is None:
+            game_map_id = GameMap.owned_id(map_id, token_user.id)
+            if game_map_id is None:
                 return jsonify(error="Game map does not exist"), 404, json_tag
         except:
             return jsonify(error="Game map does not exist"), 404, json_tag
@@ -357,7 +604,7 @@ class Api():
         try:
             session_entity = Session.objects(id=id, user_id=token_user.id).first()
             assert session_entity is not None
-            session_entity.game_map_id = game_map.id
+            session_entity.game_map_id = game_map_id
             session_entity.save()
         except (StopIteration, DoesNotExist) as e:
             return jsonify(error="Session does not exist"), 404, json_tag
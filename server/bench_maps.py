@@ -0,0 +1,150 @@
+import json
+
+import pytest
+from flask import jsonify
+
+from benchmark import RestBenchmark, map_size, use_stand_ins
+from codec import pack_models, unpack_models
+from encoding import encoder
+from mesh import mesh_models
+from voxels import validate_models
+
+# Micro-benchmarks of map serialization and validation, using pytest-benchmark.
+#
+#   pytest bench_maps.py
+#
+# Save a baseline, then fail any later run where a benchmark got more than
+# 15% slower on average:
+#
+#   pytest bench_maps.py --benchmark-autosave
+#   pytest bench_maps.py --benchmark-compare --benchmark-compare-fail=mean:15%
+#
+# Every benchmark also has an absolute budget per voxel below, so a change
+# that makes map serialization much slower fails even without a baseline.
+
+voxel_counts = [100, 1000, 10000]
+# Fraction of the cells in the models' bounding box that hold a voxel.
+densities = [1.0, 0.1]
+
+# Mean microseconds allowed per voxel, several times what a laptop measures.
+budgets = {
+    'to_json': 150,
+    'json_loads': 20,
+    'jsonify': 250,
+    'validate': 150,
+    'encode': 30,
+    'validate_models': 20,
+    'pack': 30,
+    'unpack': 30,
+    'mesh': 30,
+    'read_map': 100,
+    'update_map': 2000,
+}
+
+
+def spread_models(count, density, color="#fff"):
+    """ Return count voxels with about density of the cells of their bounding box filled. """
+    models = []
+    for index in range(count):
+        cell = int(index / density)
+        models.append({'type': 'voxel', 'color': color, 'position': {
+            'x': cell % map_size, 'y': (cell // map_size) % map_size, 'z': cell // (map_size * map_size)}})
+    return models
+
+
+def check_budget(benchmark, name, voxels):
+    """ Fail when the mean time per voxel is over the budget. Skipped with --benchmark-disable. """
+    if benchmark.stats is None:
+        return
+    per_voxel = benchmark.stats.stats.mean / voxels * 1e6
+    assert per_voxel <= budgets[name], \
+        name + " took " + str(round(per_voxel, 2)) + "us per voxel, budget is " + str(budgets[name]) + "us"
+
+
+@pytest.fixture(scope='module')
+def app():
+    use_stand_ins()
+    from server import create_app
+    return create_app(MONGODB_HOST='mongomock://localhost', MONGODB_DB='benchmark', TESTING=True,
+                      EMITTER_ASYNC=False, BCRYPT_ROUNDS=4)
+
+
+@pytest.fixture(scope='module')
+def rest(app):
+    return RestBenchmark(app)
+
+
+@pytest.fixture(params=[(voxels, density) for voxels in voxel_counts for density in densities],
+                ids=lambda param: str(param[0]) + '-voxels-' + str(param[1]) + '-density')
+def game_map(request, app):
+    from models import GameMap
+    voxels, density = request.param
+    return GameMap(name='benchmark', width=map_size, height=map_size, depth=map_size, color="#fff",
+                   models=spread_models(voxels, density))
+
+
+def test_to_json(benchmark, game_map):
+    benchmark(game_map.to_json)
+    check_budget(benchmark, 'to_json', len(game_map.models))
+
+
+def test_json_loads(benchmark, game_map):
+    text = game_map.to_json()
+    benchmark(json.loads, text)
+    check_budget(benchmark, 'json_loads', len(game_map.models))
+
+
+def test_jsonify(benchmark, app, game_map):
+    with app.test_request_context():
+        benchmark(jsonify, map=game_map)
+    check_budget(benchmark, 'jsonify', len(game_map.models))
+
+
+def test_validate(benchmark, game_map):
+    benchmark(game_map.validate)
+    check_budget(benchmark, 'validate', len(game_map.models))
+
+
+def test_encode(benchmark, game_map):
+    document = game_map.to_mongo().to_dict()
+    benchmark(encoder.encode, document)
+    check_budget(benchmark, 'encode', len(game_map.models))
+
+
+def test_validate_models(benchmark, game_map):
+    models = [model.to_mongo().to_dict() for model in game_map.models]
+    benchmark(validate_models, models, map_size, map_size, map_size)
+    check_budget(benchmark, 'validate_models', len(models))
+
+
+def test_pack(benchmark, game_map):
+    models = [model.to_mongo().to_dict() for model in game_map.models]
+    benchmark(pack_models, models, map_size, map_size, map_size)
+    check_budget(benchmark, 'pack', len(models))
+
+
+def test_unpack(benchmark, game_map):
+    packed = pack_models([model.to_mongo().to_dict() for model in game_map.models], map_size, map_size, map_size)
+    benchmark(unpack_models, packed)
+    check_budget(benchmark, 'unpack', len(game_map.models))
+
+
+def test_mesh(benchmark, game_map):
+    models = [model.to_mongo().to_dict() for model in game_map.models]
+    benchmark(mesh_models, models)
+    check_budget(benchmark, 'mesh', len(models))
+
+
+@pytest.mark.parametrize('voxels', voxel_counts)
+def test_read_map(benchmark, rest, voxels):
+    map_id = rest.seed_map(voxels)
+    assert benchmark(rest.read_map(map_id), 0)
+    check_budget(benchmark, 'read_map', voxels)
+
+
+@pytest.mark.parametrize('voxels', voxel_counts)
+def test_update_map(benchmark, rest, voxels):
+    map_id = rest.seed_map(voxels)
+    # Whole map rewrites are slow, a few rounds are enough.
+    assert benchmark.pedantic(rest.update_map(map_id, voxels), args=(0,), rounds=5)
+    check_budget(benchmark, 'update_map', voxels)
@@ -0,0 +1,291 @@
+import base64
+import json
+import platform
+import subprocess
+import sys
+import time
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import jwt
+
+import secrets
+
+# Seeded maps are as large as allowed so 100k voxels fit.
+map_size = 48
+
+
+def use_stand_ins():
+    """ Replace Redis with one in-process fakeredis server shared by every client. """
+    import fakeredis
+    import redis
+
+    server = fakeredis.FakeServer()
+
+    class StandInRedis(fakeredis.FakeStrictRedis):
+        def __init__(self, *args, **kwargs):
+            kwargs['server'] = server
+            super(StandInRedis, self).__init__(*args, **kwargs)
+
+        @classmethod
+        def from_url(cls, url, **kwargs):
+            return cls(**kwargs)
+
+    redis.Redis = redis.StrictRedis = StandInRedis
+
+
+def percentile(samples, fraction):
+    """ Return the sample at a fraction (0 to 1) of the sorted samples, nearest rank. """
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, max(0, int(round(fraction * len(ordered))) - 1))]
+
+
+def summarize(name, samples, errors, seconds, **labels):
+    """Describe a run of one scenario.
+
+    Keyword arguments:
+    name -- Scenario name.
+    samples -- Latency of every successful call, in seconds.
+    errors -- Number of failed calls.
+    seconds -- Wall time of the whole run.
+    labels -- Extra fields identifying the run, like the map size.
+    """
+    result = dict(labels, scenario=name, requests=len(samples) + errors, errors=errors,
+                  seconds=round(seconds, 4), throughput=round(len(samples) / seconds, 2) if seconds else None)
+    if samples:
+        result.update(p50_ms=round(percentile(samples, 0.5) * 1000, 3),
+                      p99_ms=round(percentile(samples, 0.99) * 1000, 3),
+                      mean_ms=round(sum(samples) / len(samples) * 1000, 3))
+    return result
+
+
+def measure(name, call, count, concurrency=1, **labels):
+    """Call a function count times, from concurrency threads, and time every call.
+
+    Keyword arguments:
+    name -- Scenario name.
+    call -- Function taking the call number and returning True on success.
+    count -- Number of calls.
+    concurrency -- Calls in flight at once.
+    """
+    def timed(number):
+        start = time.perf_counter()
+        try:
+            ok = call(number)
+        except Exception:
+            ok = False
+        return ok, time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        outcomes = list(pool.map(timed, range(count)))
+    seconds = time.perf_counter() - start
+    samples = [elapsed for ok, elapsed in outcomes if ok]
+    result = summarize(name, samples, count - len(samples), seconds, concurrency=concurrency, **labels)
+    print(json.dumps(result))
+    return result
+
+
+def seed_models(count, color="#fff"):
+    """ Return count voxels filling the map x first, then y, then z. """
+    return [{'type': 'voxel', 'color': color, 'position': {
+        'x': index % map_size, 'y': (index // map_size) % map_size, 'z': index // (map_size * map_size)}}
+        for index in range(count)]
+
+
+class RestBenchmark():
+    """ Drives the REST api in process through the Flask test client. """
+
+    def __init__(self, app):
+        """Init function for RestBenchmark class.
+
+        Keyword arguments:
+        app -- The app made by server.create_app.
+        """
+        from models import User
+        self.app = app
+        self.client = app.test_client()
+        self.email, self.password = 'benchmark@example.com', 'benchmark123'
+        User.objects(email=self.email).delete()
+        with app.app_context():
+            from helper import Helper
+            User(email=self.email, password=Helper.hashpw(self.password).decode()).save()
+        self.user = User.objects(email=self.email).first()
+        self.auth_token = self.user.generate_auth_token().decode('utf-8')
+
+    def request(self, method, page, claims=None, payload=None, headers=None):
+        claims = dict(claims or {}, auth_token=self.auth_token)
+        headers = dict(headers or {}, Authorization='Bearer ' + jwt.encode(
+            dict(data=claims), base64.b64decode(secrets.JWT_KEY), algorithm='HS512').decode())
+        return self.client.open(page, method=method, data=json.dumps(payload), headers=headers,
+                                content_type='application/json')
+
+    def seed_map(self, voxels):
+        """ Create a map with a number of voxels and return its id. """
+        from models import GameMap
+        game_map = GameMap(owner=self.user.id, name='benchmark ' + str(voxels), width=map_size, height=map_size,
+                           depth=map_size, color="#fff", private=True, models=seed_models(voxels))
+        with self.app.app_context():
+            game_map.save()
+        return str(game_map.id)
+
+    def authenticate(self, number):
+        response = self.request('POST', '/api/auth', {'email': self.email, 'password': self.password})
+        return response.status_code == 200
+
+    def read_map(self, map_id):
+        def call(number):
+            response = self.request('GET', '/api/map/' + map_id, headers={'Accept-Encoding': 'gzip'})
+            return response.status_code == 200
+        return call
+
+    def update_map(self, map_id, voxels):
+        # Alternate colors so every update really rewrites the models.
+        bodies = [{'map': {'models': seed_models(voxels, color)}} for color in ("#000", "#fff")]
+
+        def call(number):
+            response = self.request('POST', '/api/map/' + map_id, payload=bodies[number % 2])
+            return response.status_code == 200
+        return call
+
+    def create_session(self, map_id):
+        def call(number):
+            response = self.request('POST', '/api/sessions', payload={'map_id': map_id})
+            return response.status_code == 200
+        return call
+
+
+def wait_for(clients, event, timeout):
+    """ Wait until every test client received an event. Returns the clients still waiting. """
+    deadline = time.perf_counter() + timeout
+    pending = list(clients)
+    while pending and time.perf_counter() < deadline:
+        pending = [client for client in pending
+                   if not any(packet['name'] == event for packet in client.get_received())]
+        if pending:
+            time.sleep(0.0005)
+    return pending
+
+
+def socket_fan_out(socket_app, code, auth_token, clients, edits, timeout):
+    """Join clients to a session room, then time how long each edit takes to reach all of them.
+
+    Keyword arguments:
+    socket_app -- The app made by somesockets.create_socket_app.
+    code -- Code of the session to join.
+    auth_token -- Token of the session's owner, used for the edits.
+    clients -- Number of clients in the room.
+    edits -- Number of edits to time.
+    timeout -- Seconds to wait for an edit before counting it as failed.
+    """
+    from somesockets import socket
+    joins, join_errors, members = [], 0, []
+    start = time.perf_counter()
+    for _ in range(clients):
+        client = socket.test_client(socket_app)
+        client.get_received()
+        began = time.perf_counter()
+        client.emit('joinRoom', {'room': code, 'diffs': True})
+        if wait_for([client], 'roomFound', timeout):
+            join_errors += 1
+        else:
+            joins.append(time.perf_counter() - began)
+        members.append(client)
+    results = [summarize('socket_join', joins, join_errors, time.perf_counter() - start, clients=clients)]
+    print(json.dumps(results[-1]))
+
+    editor = members[0]
+    fan_outs, fan_out_errors = [], 0
+    start = time.perf_counter()
+    for number in range(edits):
+        color = "#000" if number % 2 else "#fff"
+        began = time.perf_counter()
+        editor.emit('editMap', {'room': code, 'auth_token': auth_token, 'changes': {
+            'add': [{'type': 'wall', 'color': color, 'position': {'x': 0, 'y': 0, 'z': 0}}]}})
+        if wait_for(members, 'mapDiff', timeout):
+            fan_out_errors += 1
+        else:
+            fan_outs.append(time.perf_counter() - began)
+    results.append(summarize('socket_fan_out', fan_outs, fan_out_errors, time.perf_counter() - start,
+                             clients=clients))
+    print(json.dumps(results[-1]))
+    for client in members:
+        client.disconnect()
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="Measures throughput and latency of the REST api and socket server")
+    parser.add_argument("--mongo", metavar="HOST",
+                        help="Use the mongod and redis on this host instead of in-process stand-ins")
+    parser.add_argument("--sizes", type=int, nargs='+', default=[0, 1000, 10000, 100000],
+                        help="Voxel counts of the seeded maps")
+    parser.add_argument("--requests", type=int, default=50, help="Calls per scenario")
+    parser.add_argument("--concurrency", type=int, default=1, help="REST calls in flight at once")
+    parser.add_argument("--clients", type=int, nargs='+', default=[1, 10, 100],
+                        help="Clients in the room for the socket scenarios")
+    parser.add_argument("--bcrypt-rounds", type=int, default=12)
+    parser.add_argument("--timeout", type=float, default=10, help="Seconds to wait for a socket event")
+    parser.add_argument("--output", default="benchmark-report.json")
+    args = parser.parse_args()
+
+    if args.mongo is None:
+        use_stand_ins()
+        settings = dict(MONGODB_HOST='mongomock://localhost')
+    else:
+        settings = dict(MONGODB_HOST=args.mongo, REDIS_HOST=args.mongo)
+    settings.update(MONGODB_DB='benchmark', BCRYPT_ROUNDS=args.bcrypt_rounds, EMITTER_ASYNC=False,
+                    SOCKET_LOGGER=False, SOCKET_ASYNC_MODE='threading', TESTING=True,
+                    # Socket.IO test clients only work with a lone worker.
+                    SOCKET_MESSAGE_QUEUE=False)
+
+    from server import create_app
+    from somesockets import create_socket_app
+    app = create_app(**settings)
+    socket_app = create_socket_app(port=0, **settings)
+    app.logger.disabled = socket_app.logger.disabled = True
+
+    from models import GameMap, Session
+    GameMap.objects.delete()
+    Session.objects.delete()
+    bench = RestBenchmark(app)
+
+    results = [measure('auth', bench.authenticate, args.requests, args.concurrency)]
+    for voxels in args.sizes:
+        map_id = bench.seed_map(voxels)
+        results.append(measure('read_map', bench.read_map(map_id), args.requests, args.concurrency, voxels=voxels))
+        results.append(measure('update_map', bench.update_map(map_id, voxels), args.requests, args.concurrency,
+                               voxels=voxels))
+        results.append(measure('create_session', bench.create_session(map_id), args.requests, args.concurrency,
+                               voxels=voxels))
+
+    for voxels in args.sizes:
+        map_id = bench.seed_map(voxels)
+        session = Session(user_id=bench.user.id, game_map_id=GameMap.objects(id=map_id).first().id)
+        with app.app_context():
+            session.save()
+        for clients in args.clients:
+            for result in socket_fan_out(socket_app, session.code, bench.auth_token, clients, args.requests,
+                                         args.timeout):
+                results.append(dict(result, voxels=voxels))
+
+    report = {
+        'started': datetime.utcnow().isoformat() + 'Z',
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'backend': 'stand-ins' if args.mongo is None else args.mongo,
+        'settings': vars(args),
+        'results': results,
+    }
+    with open(args.output, 'w') as output:
+        json.dump(report, output, indent=2)
+    print("Wrote " + args.output)
+    sys.exit(1 if any(result['errors'] for result in results) else 0)
@@ -0,0 +1,364 @@
+import hashlib
+import time
+from collections import OrderedDict
+from threading import Lock
+
+import redis
+
+from metrics import map_cache_bytes, map_cache_evictions_total, map_cache_lookups_total
+
+
+class TTLCache():
+    """ A bounded, thread safe, least recently used cache whose entries expire. """
+
+    def __init__(self, max_entries=1024, ttl=60):
+        """Init function for TTLCache class.
+
+        Keyword arguments:
+        max_entries -- Entries past this count evict the least recently used one.
+        ttl -- Default lifetime of an entry in seconds.
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, key):
+        """ Return the live value for key, or None. """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires <= time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        """ Store value for key for ttl seconds, or the default lifetime. """
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        if ttl <= 0 or self.max_entries <= 0:
+            return
+        with self.lock:
+            self.entries[key] = (value, time.monotonic() + ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def delete_where(self, predicate):
+        """ Remove every entry whose value matches predicate. """
+        with self.lock:
+            for key in [key for key, (value, _) in self.entries.items() if predicate(value)]:
+                del self.entries[key]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class SizedCache():
+    """ A thread safe, least recently used cache of byte strings, bounded by their total size. """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        """Init function for SizedCache class.
+
+        Keyword arguments:
+        max_bytes -- Entries past this total size evict the least recently used ones.
+        """
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, key):
+        """ Return the value for key, or None. """
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        """Store value for key.
+
+        Returns the number of entries evicted to make room. Values larger
+        than the whole cache are not stored.
+        """
+        if len(value) > self.max_bytes:
+            return 0
+        evicted = 0
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self.entries[key] = value
+            self.size += len(value)
+            while self.size > self.max_bytes:
+                _, dropped = self.entries.popitem(last=False)
+                self.size -= len(dropped)
+                evicted += 1
+        return evicted
+
+    def delete_where(self, predicate):
+        """ Remove every entry whose key matches predicate. Returns the number removed. """
+        with self.lock:
+            keys = [key for key in self.entries if predicate(key)]
+            for key in keys:
+                self.size -= len(self.entries.pop(key))
+        return len(keys)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+
+class MapCache():
+    """ Cache of encoded map payloads, ready to send.
+
+    Entries are keyed by map id, revision and kind, e.g. 'payload' for the
+    JSON sent to socket clients or 'document.gzip' for a compressed REST
+    body. A revision never changes once written, so entries cannot go stale;
+    writes still invalidate a map to free its old revisions.
+
+    Entries live in a local SizedCache and, when MAP_CACHE_REDIS is set, in
+    the shared Redis so other processes skip the encoding too. Concurrent
+    misses for the same entry in one process wait for a single build.
+    """
+
+    prefix = 'mapcache:'
+
+    def __init__(self, app=None):
+        """Init function for MapCache class.
+
+        Keyword arguments:
+        app -- Optional Flask app to bind to immediately.
+        """
+        self.local = SizedCache()
+        self.redis = None
+        self.ttl = 3600
+        self.lock = Lock()
+        self.building = {}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Configure the cache from the app.
+
+        Keyword arguments:
+        app -- The Flask app. Uses MAP_CACHE_BYTES, MAP_CACHE_REDIS, MAP_CACHE_TTL and REDIS_HOST.
+        """
+        self.local = SizedCache(app.config.get('MAP_CACHE_BYTES', 64 * 1024 * 1024))
+        self.ttl = app.config.get('MAP_CACHE_TTL', 3600)
+        self.redis = None
+        if app.config.get('MAP_CACHE_REDIS', False):
+            self.redis = redis.StrictRedis(host=app.config.get('REDIS_HOST') or 'localhost')
+        app.extensions['map_cache'] = self
+
+    @staticmethod
+    def key(map_id, revision, kind):
+        return str(map_id) + ':' + str(revision) + ':' + kind
+
+    def get(self, map_id, revision, kind, build, shared=True):
+        """Return an encoded map payload, building it on a miss.
+
+        Keyword arguments:
+        map_id -- The map's id.
+        revision -- The revision of the map the payload is built from.
+        kind -- Name of the payload, part of the key.
+        build -- Function returning the encoded bytes.
+        shared -- False to keep the entry out of Redis, for revisions not written to Mongo yet.
+        """
+        key = self.key(map_id, revision, kind)
+        value = self.lookup(key, kind, shared)
+        if value is not None:
+            return value
+        with self.lock:
+            building = self.building.setdefault(key, Lock())
+        try:
+            with building:
+                # Another thread may have built it while this one waited.
+                value = self.local.get(key)
+                if value is not None:
+                    map_cache_lookups_total.labels(kind, 'local').inc()
+                    return value
+                map_cache_lookups_total.labels(kind, 'miss').inc()
+                value = build()
+                self.store(map_id, key, value, shared)
+                return value
+        finally:
+            with self.lock:
+                if self.building.get(key) is building:
+                    del self.building[key]
+
+    def lookup(self, key, kind, shared):
+        value = self.local.get(key)
+        if value is not None:
+            map_cache_lookups_total.labels(kind, 'local').inc()
+            return value
+        if self.redis is None or not shared:
+            return None
+        try:
+            value = self.redis.get(self.prefix + key)
+        except redis.RedisError:
+            return None
+        if value is not None:
+            map_cache_lookups_total.labels(kind, 'redis').inc()
+            self.store_local(key, value)
+        return value
+
+    def store_local(self, key, value):
+        evicted = self.local.set(key, value)
+        if evicted:
+            map_cache_evictions_total.labels('size').inc(evicted)
+        map_cache_bytes.set(self.local.size)
+
+    def store(self, map_id, key, value, shared):
+        self.store_local(key, value)
+        if self.redis is None or not shared:
+            return
+        try:
+            pipe = self.redis.pipeline()
+            pipe.setex(self.prefix + key, self.ttl, value)
+            pipe.sadd(self.prefix + str(map_id), key)
+            pipe.expire(self.prefix + str(map_id), self.ttl)
+            pipe.execute()
+        except redis.RedisError:
+            pass
+
+    def invalidate(self, map_id):
+        """ Drop every cached payload of a map. """
+        start = str(map_id) + ':'
+        dropped = self.local.delete_where(lambda key: key.startswith(start))
+        if dropped:
+            map_cache_evictions_total.labels('invalidated').inc(dropped)
+        map_cache_bytes.set(self.local.size)
+        if self.redis is not None:
+            try:
+                keys = self.redis.smembers(self.prefix + str(map_id))
+                self.redis.delete(self.prefix + str(map_id),
+                                  *[self.prefix + key.decode('utf-8') for key in keys])
+            except redis.RedisError:
+                pass
+
+    def clear(self):
+        self.local.clear()
+        map_cache_bytes.set(0)
+
+
+class AuthCache():
+    """ Cache of verified auth tokens to the user they belong to.
+
+    Entries live in a local TTLCache and, when AUTH_CACHE_REDIS is set, in the
+    shared Redis so other processes skip checking the token too. Redis only
+    holds the user's id, until the token expires, and other processes load the
+    user by id. Other processes only see an invalidation once their local copy
+    expires, so AUTH_CACHE_TTL bounds how long a stale user can be served.
+    """
+
+    prefix = 'auth:'
+
+    def __init__(self, app=None):
+        """Init function for AuthCache class.
+
+        Keyword arguments:
+        app -- Optional Flask app to bind to immediately.
+        """
+        self.local = TTLCache()
+        self.redis = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Configure the cache from the app.
+
+        Keyword arguments:
+        app -- The Flask app. Uses AUTH_CACHE_SIZE, AUTH_CACHE_TTL, AUTH_CACHE_REDIS and REDIS_HOST.
+        """
+        self.local = TTLCache(app.config.get('AUTH_CACHE_SIZE', 1024),
+                              app.config.get('AUTH_CACHE_TTL', 60))
+        self.redis = None
+        if app.config.get('AUTH_CACHE_REDIS', False):
+            self.redis = redis.StrictRedis(host=app.config.get('REDIS_HOST') or 'localhost')
+        app.extensions['auth_cache'] = self
+
+    @staticmethod
+    def key(token):
+        """ Hash tokens so they are never stored in Redis as is. """
+        if type(token) is str:
+            token = token.encode()
+        return hashlib.sha256(token).hexdigest()
+
+    def get(self, token, load):
+        """Return the cached user for a token.
+
+        Keyword arguments:
+        token -- The auth token sent by the client.
+        load -- Function that loads a user by the id stored in Redis, or returns None.
+
+        Returns None on a miss.
+        """
+        key = self.key(token)
+        user = self.local.get(key)
+        if user is not None or self.redis is None:
+            return user
+        try:
+            raw = self.redis.get(self.prefix + key)
+        except redis.RedisError:
+            return None
+        if raw is None:
+            return None
+        user = load(raw.decode('utf-8'))
+        if user is not None:
+            self.local.set(key, user)
+        return user
+
+    def set(self, token, user, expires_at=None):
+        """Cache the user a token was verified for.
+
+        Keyword arguments:
+        token -- The auth token sent by the client.
+        user -- The verified user document.
+        expires_at -- Unix time the token expires, entries never outlive it.
+        """
+        ttl = self.local.ttl
+        if expires_at is not None:
+            ttl = min(ttl, int(expires_at - time.time()))
+        if ttl <= 0:
+            return
+        key = self.key(token)
+        self.local.set(key, user, ttl)
+        if self.redis is not None:
+            try:
+                pipe = self.redis.pipeline()
+                pipe.setex(self.prefix + key, ttl, str(user.id))
+                pipe.sadd(self.prefix + str(user.id), key)
+                pipe.expire(self.prefix + str(user.id), self.local.ttl)
+                pipe.execute()
+            except redis.RedisError:
+                pass
+
+    def invalidate_user(self, user_id):
+        """ Drop every cached token of a user, e.g. when it is updated or deactivated. """
+        user_id = str(user_id)
+        self.local.delete_where(lambda user: str(user.id) == user_id)
+        if self.redis is not None:
+            try:
+                keys = self.redis.smembers(self.prefix + user_id)
+                self.redis.delete(self.prefix + user_id,
+                                  *[self.prefix + key.decode('utf-8') for key in keys])
+            except redis.RedisError:
+                pass
+
+    def clear(self):
+        self.local.clear()
+
+
+auth_cache = AuthCache()
+map_cache = MapCache()
@@ -0,0 +1,172 @@
+from bson import Binary
+from mongoengine import BinaryField, DictField, Document, IntField, ObjectIdField
+from pymongo import DeleteOne, ReplaceOne
+
+from codec import pack_models, unpack_models
+from voxels import position_key, summarize
+
+# Maps stored with MAP_STORAGE = 'chunked' keep their models in MapChunk
+# documents, one per chunk_size cube of cells that holds any model. A chunk
+# is keyed by its map and chunk coordinates, a cell's position // chunk_size,
+# so an edit only rewrites the chunks it touches and a region of the map is
+# read without loading the rest.
+chunk_size = 16
+axes = ('x', 'y', 'z')
+
+
+class MapChunk(Document):
+    """ Models of one chunk of a chunked map. """
+    meta = {
+        'indexes': [
+            {'fields': ('map_id', 'x', 'y', 'z'), 'unique': True},
+        ]
+    }
+
+    map_id = ObjectIdField(required=True)
+    x = IntField(required=True)
+    y = IntField(required=True)
+    z = IntField(required=True)
+    # Models packed by codec.pack_models, positions relative to the chunk's corner.
+    voxels = BinaryField()
+    # Voxel count and bounding box of the chunk in map coordinates, see voxels.summarize.
+    summary = DictField()
+
+
+def chunk_of(key):
+    """ Return the (x, y, z) chunk coordinates holding a position key. """
+    return tuple(coordinate // chunk_size for coordinate in key)
+
+
+def split(models):
+    """ Group a list of model dicts by the chunk coordinates they fall in. """
+    chunks = {}
+    for model in models:
+        chunks.setdefault(chunk_of(position_key(model['position'])), []).append(model)
+    return chunks
+
+
+def chunk_query(map_id, coordinates):
+    return {'map_id': map_id, 'x': coordinates[0], 'y': coordinates[1], 'z': coordinates[2]}
+
+
+def pack_chunk(map_id, coordinates, models):
+    """Return the stored document of one chunk.
+
+    Keyword arguments:
+    map_id -- ObjectId of the map.
+    coordinates -- (x, y, z) chunk coordinates.
+    models -- Model dicts inside the chunk, in map coordinates.
+    """
+    corner = [coordinate * chunk_size for coordinate in coordinates]
+    local = [dict(model, position={axis: model['position'][axis] - corner[i] for i, axis in enumerate(axes)})
+             for model in models]
+    document = chunk_query(map_id, coordinates)
+    document['voxels'] = Binary(pack_models(local, chunk_size, chunk_size, chunk_size))
+    document['summary'] = summarize(models)
+    return document
+
+
+def unpack_chunk(document):
+    """ Return the model dicts of a stored chunk, in map coordinates. """
+    corner = [document[axis] * chunk_size for axis in axes]
+    models = unpack_models(document['voxels'])
+    for model in models:
+        position = model['position']
+        for i, axis in enumerate(axes):
+            position[axis] += corner[i]
+    return models
+
+
+def read_chunks(map_id, low=None, high=None):
+    """Read the stored chunks of a map, in (x, y, z) order.
+
+    Keyword arguments:
+    map_id -- ObjectId of the map.
+    low, high -- Optional (x, y, z) chunk coordinates bounding the chunks to read, both included.
+
+    Returns a list of ((x, y, z), models) pairs. Chunks without models are not stored and not returned.
+    """
+    query = {'map_id': map_id}
+    for i, axis in enumerate(axes):
+        bounds = {}
+        if low is not None:
+            bounds['$gte'] = low[i]
+        if high is not None:
+            bounds['$lte'] = high[i]
+        if bounds:
+            query[axis] = bounds
+    cursor = MapChunk._get_collection().find(query).sort([(axis, 1) for axis in axes])
+    return [(tuple(document[axis] for axis in axes), unpack_chunk(document)) for document in cursor]
+
+
+def read_models(map_id):
+    """ Return every model of a chunked map. """
+    models = []
+    for _, chunk_models in read_chunks(map_id):
+        models.extend(chunk_models)
+    return models
+
+
+def write_chunks(map_id, models, touched=None):
+    """Store the models of a map as chunks.
+
+    Keyword arguments:
+    map_id -- ObjectId of the map.
+    models -- Model dicts of the chunks being written. May hold the whole map.
+    touched -- Optional set of chunk coordinates that changed. Only these are
+    written, and those left without models deleted. By default every chunk is
+    rewritten and stale chunks removed.
+    """
+    chunks = split(models)
+    collection = MapChunk._get_collection()
+    if touched is None:
+        stored = collection.find({'map_id': map_id}, projection={'_id': 0, 'x': 1, 'y': 1, 'z': 1})
+        touched = set(chunks) | {tuple(document[axis] for axis in axes) for document in stored}
+    requests = []
+    for coordinates in sorted(touched):
+        query = chunk_query(map_id, coordinates)
+        if coordinates in chunks:
+            requests.append(ReplaceOne(query, pack_chunk(map_id, coordinates, chunks[coordinates]), upsert=True))
+        else:
+            requests.append(DeleteOne(query))
+    if requests:
+        collection.bulk_write(requests, ordered=False)
+
+
+def patch_chunks(map_id, changes):
+    """Apply a batch of edits to a chunked map, reading and writing only the chunks it touches.
+
+    Keyword arguments:
+    map_id -- ObjectId of the map.
+    changes -- A MapChanges batch.
+    """
+    touched = {chunk_of(key) for key in changes.keys()}
+    if not touched:
+        return
+    query = {'map_id': map_id, '$or': [{'x': x, 'y': y, 'z': z} for x, y, z in sorted(touched)]}
+    models = {}
+    for document in MapChunk._get_collection().find(query):
+        for model in unpack_chunk(document):
+            models[position_key(model['position'])] = model
+    changes.apply_by_position(models)
+    write_chunks(map_id, list(models.values()), touched)
+
+
+def chunks_summary(map_id):
+    """ Return the summary of a chunked map, added up from the summaries of its chunks. """
+    group = {'_id': None, 'voxel_count': {'$sum': '$summary.voxel_count'}}
+    for axis in axes:
+        group['min_' + axis] = {'$min': '$summary.min.' + axis}
+        group['max_' + axis] = {'$max': '$summary.max.' + axis}
+    result = list(MapChunk._get_collection().aggregate([{'$match': {'map_id': map_id}}, {'$group': group}]))
+    if len(result) == 0 or result[0]['voxel_count'] == 0:
+        return {'voxel_count': 0}
+    result = result[0]
+    return {'voxel_count': result['voxel_count'],
+            'min': {axis: result['min_' + axis] for axis in axes},
+            'max': {axis: result['max_' + axis] for axis in axes}}
+
+
+def delete_chunks(map_id):
+    """ Delete every chunk of a map. """
+    MapChunk._get_collection().delete_many({'map_id': map_id})
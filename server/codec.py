@@ -0,0 +1,164 @@
+import struct
+
+from constants import model_types
+
+# Packed voxel format, all integers little endian:
+#
+#   header   magic, width, height, depth, palette size   '<4sHHHH'
+#   palette  per entry: type index, color length, color  '<BB' + ascii
+#   mode     SPARSE or RUNS                              '<B'
+#   body     SPARSE: voxel count, then per voxel the gap to the previous
+#            cell index and its palette index
+#            RUNS: (palette index + 1 or 0 for empty, run length) pairs
+#            covering every cell of the grid
+#
+# Body values are varints. Cell indexes run x fastest, then y, then z.
+magic = b'ARV1'
+header = struct.Struct('<4sHHHH')
+SPARSE = 0
+RUNS = 1
+
+
+def write_varint(out, value):
+    while value >= 0x80:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def read_varint(data, offset):
+    value, shift = 0, 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
+
+
+def pack_models(models, width=1, height=1, depth=1):
+    """Pack a list of model dicts into a compact binary blob.
+
+    Keyword arguments:
+    models -- List of dicts with type, position and color keys.
+    width, height, depth -- Size of the map. The grid grows to fit out of bounds models.
+
+    Returns bytes. A later model at an occupied position replaces the earlier one.
+    """
+    for model in models:
+        position = model['position']
+        width = max(width, position['x'] + 1)
+        height = max(height, position['y'] + 1)
+        depth = max(depth, position['z'] + 1)
+
+    palette, cells = {}, {}
+    for model in models:
+        entry = (model_types.index(model['type']), model['color'])
+        index = palette.setdefault(entry, len(palette))
+        position = model['position']
+        cells[position['x'] + width * (position['y'] + height * position['z'])] = index
+
+    out = bytearray(header.pack(magic, width, height, depth, len(palette)))
+    for type_index, color in palette:
+        color = color.encode('ascii')
+        out += struct.pack('<BB', type_index, len(color)) + color
+
+    order = sorted(cells)
+    sparse = bytearray()
+    write_varint(sparse, len(order))
+    previous = -1
+    for cell in order:
+        write_varint(sparse, cell - previous - 1)
+        write_varint(sparse, cells[cell])
+        previous = cell
+
+    runs = bytearray()
+    position, run_value, run_length = 0, None, 0
+    for cell in order:
+        if cell > position:
+            if run_value == 0:
+                run_length += cell - position
+            else:
+                if run_length:
+                    write_varint(runs, run_value)
+                    write_varint(runs, run_length)
+                run_value, run_length = 0, cell - position
+        value = cells[cell] + 1
+        if value == run_value:
+            run_length += 1
+        else:
+            if run_length:
+                write_varint(runs, run_value)
+                write_varint(runs, run_length)
+            run_value, run_length = value, 1
+        position = cell + 1
+    if run_length:
+        write_varint(runs, run_value)
+        write_varint(runs, run_length)
+    if position < width * height * depth:
+        write_varint(runs, 0)
+        write_varint(runs, width * height * depth - position)
+
+    if len(runs) < len(sparse):
+        out.append(RUNS)
+        out += runs
+    else:
+        out.append(SPARSE)
+        out += sparse
+    return bytes(out)
+
+
+def unpack_models(data):
+    """Unpack a blob made by pack_models.
+
+    Keyword arguments:
+    data -- The packed bytes.
+
+    Returns a list of model dicts ordered by cell index.
+    Raises ValueError if the blob is not a packed voxel blob.
+    """
+    data = bytes(data)
+    if len(data) < header.size:
+        raise ValueError("Not a packed voxel blob")
+    tag, width, height, depth, palette_size = header.unpack_from(data, 0)
+    if tag != magic:
+        raise ValueError("Not a packed voxel blob")
+    offset = header.size
+    palette = []
+    for _ in range(palette_size):
+        type_index, length = struct.unpack_from('<BB', data, offset)
+        offset += 2
+        palette.append((model_types[type_index], data[offset:offset + length].decode('ascii')))
+        offset += length
+
+    mode = data[offset]
+    offset += 1
+    plane = width * height
+    models = []
+
+    def add(cell, index):
+        model_type, color = palette[index]
+        models.append({'type': model_type, 'color': color, 'position': {
+            'x': cell % width, 'y': (cell // width) % height, 'z': cell // plane}})
+
+    if mode == SPARSE:
+        count, offset = read_varint(data, offset)
+        cell = -1
+        for _ in range(count):
+            gap, offset = read_varint(data, offset)
+            index, offset = read_varint(data, offset)
+            cell += gap + 1
+            add(cell, index)
+    elif mode == RUNS:
+        cell = 0
+        while offset < len(data):
+            value, offset = read_varint(data, offset)
+            length, offset = read_varint(data, offset)
+            if value:
+                for run_cell in range(cell, cell + length):
+                    add(run_cell, value - 1)
+            cell += length
+    else:
+        raise ValueError("Unknown packed voxel mode")
+    return models
@@ -0,0 +1,53 @@
+import hashlib
+import hmac
+
+import secrets
+from constants import session_code_choices
+
+# Session codes are every 5 character string over session_code_choices.
+# The n-th session gets the code at position permute(n), where permute is
+# a keyed Feistel permutation of the code space: codes never repeat until
+# the space is used up, and consecutive sessions get unrelated codes.
+code_length = 5
+code_space = len(session_code_choices) ** code_length
+half_bits = ((code_space - 1).bit_length() + 1) // 2
+half_mask = (1 << half_bits) - 1
+rounds = 4
+key = hashlib.sha256(('session codes' + secrets.SECRET_KEY).encode()).digest()
+
+
+def round_value(round_number, value):
+    digest = hmac.new(key, bytes([round_number]) + value.to_bytes(4, 'little'), hashlib.sha256).digest()
+    return int.from_bytes(digest[:4], 'little') & half_mask
+
+
+def permute(index):
+    """Map an index in the code space to a unique position in the code space.
+
+    Keyword arguments:
+    index -- Integer from 0 to code_space - 1.
+
+    A Feistel network over 2 * half_bits bits is a permutation of a slightly
+    larger space; values that land outside the code space are encrypted again
+    until they fall inside it, which keeps the result a permutation.
+    """
+    if not 0 <= index < code_space:
+        raise ValueError("Session code space exhausted")
+    value = index
+    while True:
+        left, right = value >> half_bits, value & half_mask
+        for round_number in range(rounds):
+            left, right = right, left ^ round_value(round_number, right)
+        value = (left << half_bits) | right
+        if value < code_space:
+            return value
+
+
+def session_code(index):
+    """ Return the session code for the index-th session ever created. """
+    value = permute(index)
+    code = ''
+    for _ in range(code_length):
+        value, digit = divmod(value, len(session_code_choices))
+        code += session_code_choices[digit]
+    return code
@@ -11,6 +11,64 @@ MONGODB_PORT = 27017
 
 REDIS_HOST = ''
 
+# Settings that point the servers at the docker-compose services.
+deploy_config = {'REDIS_HOST': 'redis', 'MONGODB_HOST': 'mongo', 'MAP_CACHE_REDIS': True}
+
+# How GameMap models are stored: 'documents' (one sub-document per model),
+# 'packed' (one binary blob, see codec.py) or 'chunked' (one packed blob per
+# 16x16x16 chunk, see chunks.py, so edits only rewrite the chunks they touch).
+# Convert existing maps with migrate_maps.py.
+MAP_STORAGE = 'documents'
+
+# Socket.IO emitter config
+EMITTER_ASYNC = True  # Publish from a background thread so Redis never blocks a request
+EMITTER_BATCH_WINDOW = 0.01  # Seconds to gather emits into one batch
+EMITTER_QUEUE_SIZE = 1000  # Emits waiting beyond this are dropped
+
+# Map payload encoding config
+JSON_ENCODER = 'auto'  # 'orjson', 'ujson', 'json', or 'auto' for the fastest installed
+COMPRESS_MIN_SIZE = 1024  # Bytes below which payloads are sent uncompressed
+COMPRESS_LEVEL = 6
+
+# Production REST server config, see gunicorn_config.py
+WEB_BIND = '0.0.0.0:8443'
+WEB_WORKERS = 0  # Worker processes, 0 for one per core
+WEB_THREADS = 8  # Request threads per worker
+WEB_KEEPALIVE = 5  # Seconds an idle keep-alive connection stays open
+WEB_TIMEOUT = 30  # Seconds a request may run before its worker is restarted
+WEB_MAX_REQUESTS = 10000  # Requests a worker serves before it is recycled
+WEB_CERTFILE = '/app/cert.pem'
+WEB_KEYFILE = '/app/privkey.pem'
+METRICS_DIR = '/tmp/artop-metrics'  # Where gunicorn workers share their /metrics counts
+
+# Socket server map state config
+ROOM_FLUSH_INTERVAL = 1.0  # Seconds between writes of maps edited over the socket
+SOCKET_LEASE_TTL = 10  # Seconds a dead worker keeps ownership of its maps
+SOCKET_MESSAGE_QUEUE = True  # Share emits between workers through Redis. Only a lone worker can do without
+SOCKET_LOGGER = True  # Log every Socket.IO and Engine.IO packet
+SOCKET_ASYNC_MODE = None  # Socket.IO async mode, None to pick eventlet when installed
+STREAM_CHUNK_VOXELS = 2048  # Most models in one mapChunk message of a streamed join
+
+# Password hashing config
+BCRYPT_ROUNDS = 12  # Cost factor of new password hashes
+# Every hash running or queued holds a request thread while it waits, so
+# BCRYPT_WORKERS + BCRYPT_QUEUE_SIZE is capped at WEB_THREADS minus
+# BCRYPT_RESERVED_THREADS, leaving threads free to serve maps in a login storm.
+BCRYPT_WORKERS = 2  # Threads running bcrypt at once
+BCRYPT_QUEUE_SIZE = 2  # Hashes waiting beyond this are refused with a 503
+BCRYPT_RESERVED_THREADS = 4  # Request threads of a worker that never wait on bcrypt
+BCRYPT_RETRY_AFTER = 1  # Seconds sent in Retry-After with that 503
+
+# Auth token cache config
+AUTH_CACHE_SIZE = 1024  # Most tokens held in process
+AUTH_CACHE_TTL = 60  # Seconds a verified token skips the user lookup
+AUTH_CACHE_REDIS = False  # Share verified tokens between processes through Redis
+
+# Encoded map payload cache config
+MAP_CACHE_BYTES = 64 * 1024 * 1024  # Most bytes of payloads held in process
+MAP_CACHE_REDIS = False  # Share payloads between processes through Redis
+MAP_CACHE_TTL = 3600  # Seconds a payload stays in Redis
+
 # CORS Config
 
 # Email Config
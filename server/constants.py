@@ -3,16 +3,41 @@ import re
 from flask import jsonify
 
 email_pattern = re.compile('[\\w.]+@[\\w]+.[\\w]+', re.IGNORECASE)
+color_pattern = re.compile('^#([A-Fa-f0-9]{6}|[A-Fa-f0-9]{3})$')
 json_tag = {'Content-Type': 'application/json'}
 max_email_length = 255
 max_password_length = 255
 max_size = 48
+max_page_size = 100
+model_types = ['voxel', 'floor', 'wall', 'fighter', 'ranger', 'knight', 'goblin']
 # list containing a-z,0-9
-session_code_choices = list(map(chr, range(97, 123))) + list(map(chr, range(48, 57)))
+session_code_choices = list(map(chr, range(97, 123))) + list(map(chr, range(48, 58)))
+
+
+# Every session room has three sub-rooms: clients that joined with "diffs"
+# get mapDiff events, the others get the whole map as update events, with
+# merged boxes in the mesh room for clients that joined with "mesh".
+def diff_room(code): return code + ':diffs'
+
+
+def update_room(code, mesh=False): return code + (':updates.mesh' if mesh else ':updates')
+
+
+def is_diff_room(room): return room.endswith(':diffs')
+
+
+def is_mesh_room(room): return room.endswith('.mesh')
+
+
+def session_rooms(code): return [code, diff_room(code), update_room(code), update_room(code, True)]
 
 
 def malformed_request(): return jsonify(
     error="Malformed request"), 422, json_tag
 
 
+def server_busy(retry_after): return jsonify(
+    error="Server busy, please retry shortly"), 503, dict(json_tag, **{'Retry-After': str(retry_after)})
+
+
 def internal_error(): return jsonify(error="Internal server error"), 500, json_tag
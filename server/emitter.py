@@ -0,0 +1,152 @@
+import time
+from json import dumps
+from queue import Empty, Full, Queue
+from threading import Lock, Thread
+
+import redis
+from flask_socketio import SocketIO
+
+from metrics import emit_failures_total, emit_seconds
+from workers import maps_channel
+
+# Events that carry a full snapshot, so only the newest one per room matters.
+coalesced_events = ('update',)
+
+
+class Emitter():
+    """ Long-lived Socket.IO emitter that publishes through the Redis message queue.
+
+    One instance is created per process and bound to the app with init_app.
+    The underlying SocketIO object keeps a single Redis client, and with it a
+    single connection pool, for the life of the process.
+    """
+
+    def __init__(self, app=None):
+        """Init function for Emitter class.
+
+        Keyword arguments:
+        app -- Optional Flask app to bind to immediately.
+        """
+        self.socketio = None
+        self.redis = None
+        self.logger = None
+        self.queue = None
+        self.worker = None
+        self.lock = Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Connect the emitter to the message queue configured for the app.
+
+        Keyword arguments:
+        app -- The Flask app. Uses REDIS_HOST and the EMITTER_* settings.
+        """
+        redis_host = app.config.get('REDIS_HOST') or ''
+        self.socketio = SocketIO(message_queue='redis://' + redis_host)
+        self.redis = redis.StrictRedis(host=redis_host or 'localhost')
+        self.logger = app.logger
+        self.blocking = not app.config.get('EMITTER_ASYNC', True)
+        self.batch_window = app.config.get('EMITTER_BATCH_WINDOW', 0)
+        self.queue = Queue(maxsize=app.config.get('EMITTER_QUEUE_SIZE', 1000))
+        app.extensions['emitter'] = self
+
+    def emit(self, event, data, room=None):
+        """Publish an event to the socket servers.
+
+        Keyword arguments:
+        event -- Name of the Socket.IO event.
+        data -- JSON serializable payload.
+        room -- Optional room to address. Broadcasts to everyone when None.
+
+        Returns without waiting on Redis unless EMITTER_ASYNC is disabled.
+        """
+        self._submit(event, data, room)
+
+    def close_room(self, room):
+        """Remove every client from a room, on every socket server.
+
+        Keyword arguments:
+        room -- The room to close.
+
+        Goes through the same queue as emit, so events emitted to the room
+        before it is closed still reach its clients.
+        """
+        self._submit(None, None, room, 'close_room')
+
+    def publish(self, message):
+        """Send a message to every socket worker, see workers.maps_channel.
+
+        Keyword arguments:
+        message -- JSON serializable dict.
+
+        Goes through the same queue as emit.
+        """
+        self._submit(None, dumps(message), maps_channel, 'publish')
+
+    def _submit(self, event, data, room, action='emit'):
+        """ Publish now or queue for the background thread. """
+        if self.socketio is None:
+            raise RuntimeError("Emitter has not been initialized with an app")
+        if self.blocking:
+            self._publish(event, data, room, action)
+            return
+        self._start_worker()
+        try:
+            self.queue.put_nowait((event, data, room, action))
+        except Full:
+            name = event or action
+            emit_failures_total.labels(name, 'queue_full').inc()
+            self.logger.error("Dropped '" + name + "' event, emitter queue is full")
+
+    def _start_worker(self):
+        """ Start the background publishing thread once per process. """
+        if self.worker is not None and self.worker.is_alive():
+            return
+        with self.lock:
+            if self.worker is None or not self.worker.is_alive():
+                self.worker = Thread(target=self._run, name='emitter', daemon=True)
+                self.worker.start()
+
+    def _run(self):
+        """ Drain the queue, publishing everything that arrives within the batch window together. """
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.batch_window
+            while True:
+                remaining = deadline - time.monotonic()
+                try:
+                    batch.append(self.queue.get(timeout=remaining) if remaining > 0 else self.queue.get_nowait())
+                except Empty:
+                    break
+            for event, data, room, action in self._coalesce(batch):
+                self._publish(event, data, room, action)
+
+    @staticmethod
+    def _coalesce(batch):
+        """ Drop snapshot events superseded by a newer snapshot for the same room. """
+        latest = {}
+        for i, (event, _, room, _) in enumerate(batch):
+            if event in coalesced_events:
+                latest[(event, room)] = i
+        return [item for i, item in enumerate(batch)
+                if item[0] not in coalesced_events or latest[(item[0], item[2])] == i]
+
+    def _publish(self, event, data, room, action='emit'):
+        name = event or action
+        start = time.perf_counter()
+        try:
+            if action == 'close_room':
+                self.socketio.close_room(room)
+            elif action == 'publish':
+                self.redis.publish(room, data)
+            else:
+                self.socketio.emit(event, data, room=room)
+        except Exception as e:
+            emit_failures_total.labels(name, 'error').inc()
+            self.logger.error("Failed to emit '" + name + "'\n" + str(e))
+            return
+        emit_seconds.labels(name).observe(time.perf_counter() - start)
+
+
+emitter = Emitter()
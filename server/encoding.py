@@ -0,0 +1,197 @@
+import gzip
+import json
+import zlib
+
+from bson import json_util
+from flask import current_app, request
+
+from metrics import payload_bytes, sized_events
+
+# Optional faster encoders and compressors, used when installed.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import ujson
+except ImportError:
+    ujson = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+def _orjson_encode(obj):
+    # Leave dates to json_util so they match mongoengine's to_json.
+    return orjson.dumps(obj, default=json_util.default, option=orjson.OPT_PASSTHROUGH_DATETIME)
+
+
+def _ujson_encode(obj):
+    return ujson.dumps(obj, default=json_util.default, ensure_ascii=False).encode('utf-8')
+
+
+def _json_encode(obj):
+    return json.dumps(obj, default=json_util.default, separators=(',', ':')).encode('utf-8')
+
+
+encoders = {
+    'orjson': (_orjson_encode, orjson.loads if orjson else None),
+    'ujson': (_ujson_encode, ujson.loads if ujson else None),
+    'json': (_json_encode, json.loads),
+}
+
+
+class Encoded():
+    """ A payload already encoded to JSON, sent as is in Socket.IO packets.
+
+    Emitting one to a room encodes the payload once instead of once per client.
+    """
+
+    __slots__ = ('text',)
+
+    def __init__(self, body):
+        """Init function for Encoded class.
+
+        Keyword arguments:
+        body -- The JSON, as bytes from Encoder.encode.
+        """
+        self.text = body.decode('utf-8')
+
+    def __getstate__(self):
+        return self.text
+
+    def __setstate__(self, text):
+        self.text = text
+
+
+class Encoder():
+    """ JSON encoding and compression shared by the REST and socket servers.
+
+    Raw pymongo documents are encoded with bson's extended JSON, so ObjectIds
+    and dates come out exactly as mongoengine's to_json writes them.
+    """
+
+    def __init__(self, app=None):
+        """Init function for Encoder class.
+
+        Keyword arguments:
+        app -- Optional Flask app to bind to immediately.
+        """
+        self.configure('auto')
+        self.compress_min_size = 1024
+        self.compress_level = 6
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Configure the encoder from the app.
+
+        Keyword arguments:
+        app -- The Flask app. Uses JSON_ENCODER, COMPRESS_MIN_SIZE and COMPRESS_LEVEL.
+        """
+        self.configure(app.config.get('JSON_ENCODER', 'auto'))
+        self.compress_min_size = app.config.get('COMPRESS_MIN_SIZE', 1024)
+        self.compress_level = app.config.get('COMPRESS_LEVEL', 6)
+        app.extensions['encoder'] = self
+
+    def configure(self, name):
+        """Select an encoder by name.
+
+        Keyword arguments:
+        name -- 'orjson', 'ujson', 'json' or 'auto' for the fastest one installed.
+
+        Raises ValueError if the named encoder is not installed.
+        """
+        if name == 'auto':
+            name = 'orjson' if orjson else 'ujson' if ujson else 'json'
+        if name not in encoders or encoders[name][1] is None:
+            raise ValueError("JSON encoder " + str(name) + " is not available")
+        self.name = name
+        self.encode, self._loads = encoders[name]
+
+    def dumps(self, obj, *args, **kwargs):
+        """ Drop-in for json.dumps, so it can be handed to SocketIO as its json module. """
+        # Socket.IO packets are [event, payload].
+        if type(obj) is list and len(obj) == 2 and type(obj[1]) is Encoded:
+            text = '[' + self.encode(obj[0]).decode('utf-8') + ',' + obj[1].text + ']'
+        else:
+            text = self.encode(obj).decode('utf-8')
+        # zlib payloads are sized in socket_payload.
+        if type(obj) is list and len(obj) == 2 and obj[0] in sized_events \
+                and (type(obj[1]) is Encoded or isinstance(obj[1], dict) and 'compression' not in obj[1]):
+            payload_bytes.labels(obj[0], 'json').observe(len(text))
+        return text
+
+    def loads(self, data, *args, **kwargs):
+        return self._loads(data)
+
+    def compress(self, body, accept_encoding):
+        """Compress a body with the best encoding the client accepts.
+
+        Keyword arguments:
+        body -- The encoded bytes.
+        accept_encoding -- The request's parsed Accept-Encoding header.
+
+        Returns the (possibly compressed) bytes and the Content-Encoding, or None.
+        """
+        encoding = self.choose_encoding(len(body), accept_encoding)
+        return self.compress_as(body, encoding), encoding
+
+    def choose_encoding(self, size, accept_encoding):
+        """ Return the Content-Encoding for a body of size bytes, or None to send it uncompressed. """
+        if size < self.compress_min_size:
+            return None
+        offered = (['br'] if brotli else []) + ['gzip']
+        return accept_encoding.best_match(offered)
+
+    def compress_as(self, body, encoding):
+        """ Compress a body with an encoding from choose_encoding. """
+        if encoding == 'br':
+            return brotli.compress(body, quality=min(self.compress_level, 11))
+        if encoding == 'gzip':
+            return gzip.compress(body, compresslevel=self.compress_level)
+        return body
+
+    def response(self, document):
+        """Build a JSON response for a document, compressed if the request allows it.
+
+        Keyword arguments:
+        document -- Dict to encode, may hold ObjectIds and dates.
+        """
+        return self.body_response(*self.compress(self.encode(document), request.accept_encodings))
+
+    def body_response(self, body, encoding=None):
+        """Build a JSON response for an encoded body.
+
+        Keyword arguments:
+        body -- The encoded, possibly compressed, bytes.
+        encoding -- The Content-Encoding body is compressed with, if any.
+        """
+        response = current_app.response_class(body, mimetype='application/json')
+        response.vary.add('Accept-Encoding')
+        if encoding is not None:
+            response.headers['Content-Encoding'] = encoding
+        return response
+
+    def socket_payload(self, body, compression=None, event=None, deflate=None):
+        """Wrap an encoded socket payload, deflating it if the client asked for zlib and it is large.
+
+        Keyword arguments:
+        body -- The payload, as bytes from encode.
+        compression -- The compression the client announced when joining, if any.
+        event -- Name of the event sending the payload, to record the compressed size.
+        deflate -- Optional function returning the deflated body, e.g. from a cache.
+        """
+        if compression != 'zlib' or len(body) < self.compress_min_size:
+            return Encoded(body)
+        data = self.deflate(body) if deflate is None else deflate()
+        if event is not None:
+            payload_bytes.labels(event, 'zlib').observe(len(data))
+        return {'compression': 'zlib', 'data': data}
+
+    def deflate(self, body):
+        return zlib.compress(body, self.compress_level)
+
+
+encoder = Encoder()
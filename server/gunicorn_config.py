@@ -0,0 +1,37 @@
+import multiprocessing
+import os
+import shutil
+
+import config
+
+# gunicorn settings for the REST api, read from config.py.
+# Run with: gunicorn -c gunicorn_config.py wsgi:app
+bind = config.WEB_BIND
+workers = config.WEB_WORKERS or multiprocessing.cpu_count()
+# Real threads, so bcrypt and the emitter keep working off the request threads.
+worker_class = 'gthread'
+threads = config.WEB_THREADS
+keepalive = config.WEB_KEEPALIVE
+timeout = config.WEB_TIMEOUT
+graceful_timeout = config.WEB_TIMEOUT
+max_requests = config.WEB_MAX_REQUESTS
+max_requests_jitter = config.WEB_MAX_REQUESTS // 10
+
+if os.path.exists(config.WEB_CERTFILE):
+    certfile = config.WEB_CERTFILE
+    keyfile = config.WEB_KEYFILE
+
+# Workers write their metrics to files in this directory so /metrics
+# reports every worker, see metrics.py. Must be set before workers import it.
+os.environ.setdefault('prometheus_multiproc_dir', config.METRICS_DIR)
+
+
+def on_starting(server):
+    """ Start from an empty metrics directory, dropping counts of an earlier run. """
+    shutil.rmtree(os.environ['prometheus_multiproc_dir'], ignore_errors=True)
+    os.makedirs(os.environ['prometheus_multiproc_dir'])
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,101 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import BoundedSemaphore
+
+import bcrypt
+
+from metrics import bcrypt_queue_seconds, bcrypt_rejected_total, bcrypt_seconds
+
+
+class HasherBusy(Exception):
+    """ Raised when every bcrypt worker is busy and the queue is full. """
+
+    def __init__(self, retry_after):
+        super(HasherBusy, self).__init__("Password hashing queue is full")
+        self.retry_after = retry_after
+
+
+class PasswordHasher():
+    """ Runs bcrypt on a bounded pool of worker threads.
+
+    bcrypt releases the GIL while it works, so hashing on a few threads keeps
+    a login storm from pinning the request threads that serve maps. Requests
+    beyond the pool and its queue are refused with HasherBusy instead of
+    piling up.
+    """
+
+    def __init__(self, app=None):
+        """Init function for PasswordHasher class.
+
+        Keyword arguments:
+        app -- Optional Flask app to bind to immediately.
+        """
+        self.configure()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Size the pool from the app.
+
+        Keyword arguments:
+        app -- The Flask app. Uses the BCRYPT_* settings and WEB_THREADS.
+
+        The pool and its queue are cut down to fit in the request threads left
+        after BCRYPT_RESERVED_THREADS, keeping at least one worker.
+        """
+        threads = app.config.get('WEB_THREADS', 8) - app.config.get('BCRYPT_RESERVED_THREADS', 4)
+        workers = max(1, min(app.config.get('BCRYPT_WORKERS', 2), threads))
+        queue_size = max(0, min(app.config.get('BCRYPT_QUEUE_SIZE', 2), threads - workers))
+        self.configure(app.config.get('BCRYPT_ROUNDS', 12), workers, queue_size,
+                       app.config.get('BCRYPT_RETRY_AFTER', 1))
+        app.extensions['hasher'] = self
+
+    def configure(self, rounds=12, workers=2, queue_size=2, retry_after=1):
+        """Replace the pool.
+
+        Keyword arguments:
+        rounds -- bcrypt cost factor used for new hashes.
+        workers -- Threads hashing at once.
+        queue_size -- Hashes allowed to wait for a thread.
+        retry_after -- Seconds clients are told to wait when the queue is full.
+        """
+        self.rounds = rounds
+        self.retry_after = retry_after
+        self.slots = BoundedSemaphore(workers + queue_size)
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+
+    def run(self, function, *args):
+        """Run a bcrypt call on the pool and wait for its result.
+
+        Raises HasherBusy without waiting if the pool and its queue are full.
+        """
+        if not self.slots.acquire(blocking=False):
+            bcrypt_rejected_total.inc()
+            raise HasherBusy(self.retry_after)
+        try:
+            future = self.pool.submit(self.timed, time.perf_counter(), function, *args)
+        except Exception:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda _: self.slots.release())
+        return future.result()
+
+    @staticmethod
+    def timed(queued, function, *args):
+        start = time.perf_counter()
+        bcrypt_queue_seconds.observe(start - queued)
+        try:
+            return function(*args)
+        finally:
+            bcrypt_seconds.observe(time.perf_counter() - start)
+
+    def hash(self, password):
+        """ Hash and salt a password string with the configured cost. Returns bytes. """
+        return self.run(lambda: bcrypt.hashpw(password.encode(), bcrypt.gensalt(self.rounds)))
+
+    def check(self, password, hashed):
+        """ Return True if a password string matches a stored hash string. """
+        return self.run(bcrypt.checkpw, password.encode(), hashed.encode())
+
+
+hasher = PasswordHasher()
@@ -1,11 +1,17 @@
 import base64
+from datetime import datetime, timedelta
 
-import bcrypt
 import jwt
 import secrets
-from flask import current_app
+from bson import ObjectId
+from flask import current_app, request
+from werkzeug.http import http_date, quote_etag
 from flask_mail import Mail, Message
 
+from cache import map_cache
+from emitter import emitter
+from encoding import encoder
+from hashing import HasherBusy, hasher
 from constants import email_pattern, max_email_length, max_password_length
 from models import User
 
@@ -58,6 +64,7 @@ class Helper():
         password -- Password that will be used to verify against salted and hashed password in database.
 
         Returns valid truthness, error message if applicable, and authorization token if valid auth attempt.
+        Raises HasherBusy if the password can't be checked right now.
         """
         message = None
         invalid = False
@@ -68,8 +75,10 @@ class Helper():
                 message = "Incorrect email or password"
                 invalid = True
             else:
-                if bcrypt.checkpw(password.encode(), user.password.encode()):
+                if hasher.check(password, user.password):
                     auth_token = user.generate_auth_token().decode('utf-8')
+        except HasherBusy:
+            raise
         except Exception as e:
             current_app.logger.error(e)
         return invalid, message, auth_token
@@ -90,10 +99,110 @@ class Helper():
                 secrets.JWT_KEY.encode()), algorithm=['HS512'])['data']
         return claims
 
+    @staticmethod
+    def mongo_json(document):
+        """Encode a raw pymongo document as a JSON response body.
+
+        Keyword arguments:
+        document -- Dict straight from pymongo, may hold ObjectIds and dates.
+
+        Returns a response using the same extended JSON as mongoengine's to_json,
+        compressed when the client accepts it.
+        """
+        return encoder.response(document)
+
+    @staticmethod
+    def map_json(map_id, revision, load, kind='document'):
+        """Encode a map as a JSON response body, once per revision.
+
+        Keyword arguments:
+        map_id -- The map's id.
+        revision -- The revision of the map load returns.
+        load -- Function returning the map as a raw pymongo document.
+        kind -- Map cache kind of the body, for maps encoded in more than one form.
+
+        The encoded and compressed bodies come from the map cache, so load is
+        only called when neither tier holds this revision.
+        """
+        body = map_cache.get(map_id, revision, kind, lambda: encoder.encode(load()))
+        encoding = encoder.choose_encoding(len(body), request.accept_encodings)
+        if encoding is not None:
+            body = map_cache.get(map_id, revision, kind + '.' + encoding,
+                                 lambda: encoder.compress_as(body, encoding))
+        return encoder.body_response(body, encoding)
+
+    @staticmethod
+    def not_modified(etag, last_modified=None):
+        """Check the request's conditional headers against the current version of a resource.
+
+        Keyword arguments:
+        etag -- The resource's current (weak) entity tag.
+        last_modified -- Optional datetime the resource last changed.
+
+        Returns True when the client's copy is current and a 304 can be sent.
+        """
+        if request.if_none_match:
+            return request.if_none_match.contains_weak(etag)
+        since = request.if_modified_since
+        if last_modified is not None and since is not None:
+            # HTTP dates have no sub-second part or zone; stored dates have no zone either.
+            return last_modified.replace(microsecond=0) <= since.replace(tzinfo=None)
+        return False
+
+    @staticmethod
+    def cache_headers(etag, last_modified=None):
+        """Return the ETag and Last-Modified headers for a resource.
+
+        Keyword arguments:
+        etag -- The resource's current entity tag, sent as weak since bodies may be compressed.
+        last_modified -- Optional datetime the resource last changed.
+        """
+        headers = {'ETag': quote_etag(etag, weak=True)}
+        if last_modified is not None:
+            headers['Last-Modified'] = http_date(last_modified)
+        return headers
+
+    @staticmethod
+    def encode_cursor(key):
+        """ Encode the (updated, _id) of the last map on a page as an opaque cursor. """
+        updated, map_id = key
+        millis = (updated - datetime(1970, 1, 1)) // timedelta(milliseconds=1)
+        return base64.urlsafe_b64encode((str(millis) + ':' + str(map_id)).encode()).decode()
+
+    @staticmethod
+    def decode_cursor(cursor):
+        """Decode a cursor made by encode_cursor.
+
+        Raises ValueError if the cursor was tampered with.
+        """
+        try:
+            millis, map_id = base64.urlsafe_b64decode(cursor.encode()).decode().split(':')
+            return datetime(1970, 1, 1) + timedelta(milliseconds=int(millis)), ObjectId(map_id)
+        except Exception:
+            raise ValueError("Malformed cursor")
+
     @staticmethod
     def hashpw(password):
-        """ Hash and salt the incoming string. """
-        return bcrypt.hashpw(password.encode(), bcrypt.gensalt())
+        """ Hash and salt the incoming string. Raises HasherBusy when the hashing pool is full. """
+        return hasher.hash(password)
+
+    @staticmethod
+    def broadcast_map_diff(map_id, game_map, diff):
+        """Announce an edited map to the socket workers.
+
+        Keyword arguments:
+        map_id -- The ID of the map that was edited.
+        game_map -- Dict of the map after the edit. Must include revision, name, color and dimensions.
+        diff -- Dict of added, removed and changed models.
+
+        Only the diff is published. Each worker sends it as mapDiff to its
+        clients that joined with "diffs", which should ask for a resync when
+        they see a gap in revisions, and the whole map as update to its
+        other clients of the map's sessions, see somesockets.announced.
+        """
+        payload = dict(diff, revision=game_map['revision'], name=game_map['name'], color=game_map['color'],
+                       width=game_map['width'], height=game_map['height'], depth=game_map['depth'])
+        emitter.publish({'map_id': str(map_id), 'diff': encoder.encode(payload).decode('utf-8'), 'update': True})
 
     @staticmethod
     def send_email(text, recipients, subject="AR-top"):
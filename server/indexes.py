@@ -0,0 +1,78 @@
+import sys
+from argparse import ArgumentParser
+from datetime import datetime
+
+from bson import ObjectId
+from mongoengine import Q, connect
+
+from chunks import MapChunk
+from models import GameMap, Role, Session, User
+
+indexed_models = [Role, User, GameMap, MapChunk, Session]
+
+
+def ensure_indexes():
+    """ Create the indexes declared in every model's meta. Safe to call on every startup. """
+    for model in indexed_models:
+        model.ensure_indexes()
+
+
+def query_shapes():
+    """ Return a (name, queryset) pair for every query shape the servers run. """
+    oid = ObjectId()
+    now = datetime.now()
+    page = GameMap.objects(owner=oid).exclude('models').order_by('-updated', '-id')
+    return [
+        ("GameMap by id and owner", GameMap.objects(id=oid, owner=oid)),
+        ("GameMap ownership check", GameMap.owned_query(oid, oid)),
+        ("GameMap page by owner", page),
+        ("GameMap page by owner after a cursor",
+         page.filter(Q(updated__lt=now) | Q(updated=now, id__lt=oid))),
+        ("GameMap by id", GameMap.objects(id=oid)),
+        ("MapChunk range of a map", MapChunk.objects(map_id=oid, x__gte=0, x__lte=1, y__gte=0, z__lte=1)),
+        ("Session by code", Session.objects(code='aaaaa')),
+        ("Session by id and user_id", Session.objects(id=oid, user_id=oid)),
+        ("Session by user_id", Session.objects(user_id=oid)),
+        ("Session by game_map_id", Session.objects(game_map_id=oid)),
+        ("User by email", User.objects(email='report@example.com')),
+    ]
+
+
+def plan_stages(plan):
+    """ Yield every stage name in an explain() winning plan. """
+    yield plan.get('stage')
+    for key in ('inputStage', 'queryPlan'):
+        if key in plan:
+            yield from plan_stages(plan[key])
+    for child in plan.get('inputStages', []):
+        yield from plan_stages(child)
+
+
+def report():
+    """Explain every query shape and flag the ones that scan a collection.
+
+    Returns the number of query shapes that use a collection scan.
+    """
+    scans = 0
+    for name, queryset in query_shapes():
+        plan = queryset.explain()['queryPlanner']['winningPlan']
+        stages = [stage for stage in plan_stages(plan) if stage is not None]
+        flag = 'COLLSCAN' in stages
+        scans += flag
+        print(('SCAN ' if flag else 'OK   ') + name + ': ' + ' <- '.join(stages))
+    return scans
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="Creates MongoDB indexes and reports query plans")
+    parser.add_argument("--deploy", action='store_true')
+    parser.add_argument("--report", action='store_true',
+                        help="Run explain() on every query shape and flag collection scans")
+    args = parser.parse_args()
+
+    import config
+    connect(config.MONGODB_DB, host='mongo' if args.deploy else config.MONGODB_HOST,
+            port=config.MONGODB_PORT)
+    ensure_indexes()
+    if args.report:
+        sys.exit(1 if report() else 0)
@@ -0,0 +1,78 @@
+import numpy as np
+
+from voxels import position_key
+
+# Model types that fill their cell and can be merged into boxes. Every other
+# type, like fighter or goblin, is an entity and stays a single placement.
+mesh_types = ('voxel', 'floor', 'wall')
+
+
+def merge(start, size, label, axis):
+    """Merge boxes that touch along an axis and match on the others.
+
+    Keyword arguments:
+    start, size -- (n, 3) arrays of the x, y, z corner and extent of every box.
+    label -- Array of the palette index of every box.
+    axis -- 0, 1 or 2 for x, y or z.
+
+    Returns the merged start, size and label arrays.
+    """
+    if len(label) == 0:
+        return start, size, label
+    others = [other for other in range(3) if other != axis]
+    # Sort by label, then the other axes, then along the axis, so boxes that
+    # can merge end up next to each other. lexsort takes the last key first.
+    keys = [start[:, axis]] + [size[:, other] for other in others] + [start[:, other] for other in others] + [label]
+    order = np.lexsort(keys)
+    start, size, label = start[order], size[order], label[order]
+
+    same = (label[1:] == label[:-1]) & (start[1:, axis] == start[:-1, axis] + size[:-1, axis])
+    for other in others:
+        same &= (start[1:, other] == start[:-1, other]) & (size[1:, other] == size[:-1, other])
+    first = np.flatnonzero(np.concatenate(([True], ~same)))
+
+    merged_size = size[first].copy()
+    merged_size[:, axis] = np.add.reduceat(size[:, axis], first)
+    return start[first], merged_size, label[first]
+
+
+def mesh_models(models):
+    """Merge adjacent voxel, floor and wall models of the same type and color into boxes.
+
+    Keyword arguments:
+    models -- List of model dicts, at most one per position.
+
+    Cells are merged into runs along x, then runs matching on x into
+    rectangles along y, then rectangles matching on x and y into boxes along z.
+
+    Returns a dict with the palette of (type, color) entries, the boxes as
+    [x, y, z, width, height, depth, palette index] lists, and the models
+    that are not merged.
+    """
+    cells = [model for model in models if model['type'] in mesh_types]
+    entities = [model for model in models if model['type'] not in mesh_types]
+
+    palette, labels = {}, []
+    for model in cells:
+        labels.append(palette.setdefault((model['type'], model['color']), len(palette)))
+    start = np.array([position_key(model['position']) for model in cells], dtype=np.int64).reshape(-1, 3)
+    size = np.ones_like(start)
+    label = np.array(labels, dtype=np.int64)
+    for axis in range(3):
+        start, size, label = merge(start, size, label, axis)
+
+    boxes = np.column_stack((start, size, label)).tolist()
+    return {'palette': [{'type': model_type, 'color': color} for model_type, color in palette],
+            'boxes': boxes, 'models': entities}
+
+
+def meshed(game_map):
+    """Return a map dict with its voxel, floor and wall models replaced by merged boxes.
+
+    Keyword arguments:
+    game_map -- Map dict with a models list.
+
+    The models list keeps only the entities; the boxes go under mesh.
+    """
+    result = mesh_models(game_map['models'])
+    return dict(game_map, models=result.pop('models'), mesh=result)
@@ -0,0 +1,212 @@
+import os
+import time
+from functools import wraps
+
+from flask import Response, g, has_app_context, request
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram,
+                               generate_latest, multiprocess)
+from prometheus_client.core import GaugeMetricFamily, HistogramMetricFamily
+from pymongo import monitoring
+
+# Prometheus metrics of the REST and socket servers, served on /metrics.
+#
+# Under gunicorn every worker process keeps its own metrics. When the
+# prometheus_multiproc_dir environment variable is set (gunicorn_config.py
+# sets it), workers write them to files there and /metrics adds them up.
+
+namespace = 'artop'
+
+# Events whose payload sizes are recorded, see Encoder.dumps and Encoder.socket_payload.
+sized_events = ('update', 'roomFound', 'mapChunk')
+
+size_buckets = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+query_buckets = (0, 1, 2, 3, 5, 8, 13, 21, 50, 100)
+room_size_buckets = (1, 2, 5, 10, 20, 50, 100)
+
+requests_total = Counter('requests_total', "HTTP requests by route, method and status",
+                         ['route', 'method', 'status'], namespace=namespace)
+request_seconds = Histogram('request_seconds', "Time spent serving HTTP requests",
+                            ['route', 'method'], namespace=namespace)
+socket_event_seconds = Histogram('socket_event_seconds', "Time spent handling Socket.IO events",
+                                 ['event'], namespace=namespace)
+mongo_command_seconds = Histogram('mongo_command_seconds', "Time spent on Mongo commands, as pymongo measures it",
+                                  ['command'], namespace=namespace)
+mongo_command_failures_total = Counter('mongo_command_failures_total', "Mongo commands that failed",
+                                       ['command'], namespace=namespace)
+handler_mongo_queries = Histogram('handler_mongo_queries', "Mongo commands run by one request or socket event",
+                                  ['handler'], namespace=namespace, buckets=query_buckets)
+handler_mongo_seconds = Histogram('handler_mongo_seconds', "Time one request or socket event spent on Mongo",
+                                  ['handler'], namespace=namespace)
+bcrypt_seconds = Histogram('bcrypt_seconds', "Time spent hashing or checking one password",
+                           namespace=namespace, buckets=(.01, .025, .05, .1, .25, .5, 1, 2.5, 5))
+bcrypt_queue_seconds = Histogram('bcrypt_queue_seconds', "Time a password waited for a bcrypt thread",
+                                 namespace=namespace)
+bcrypt_rejected_total = Counter('bcrypt_rejected_total', "Passwords refused because the bcrypt queue was full",
+                                namespace=namespace)
+emit_seconds = Histogram('emit_seconds', "Time spent publishing one event to Redis", ['event'],
+                         namespace=namespace)
+emit_failures_total = Counter('emit_failures_total', "Events that could not be published or were dropped",
+                              ['event', 'reason'], namespace=namespace)
+payload_bytes = Histogram('payload_bytes', "Size of map payloads sent to socket clients",
+                          ['event', 'encoding'], namespace=namespace, buckets=size_buckets)
+map_cache_lookups_total = Counter('map_cache_lookups_total', "Map cache lookups by the tier that answered, or miss",
+                                  ['kind', 'result'], namespace=namespace)
+map_cache_evictions_total = Counter('map_cache_evictions_total', "Entries dropped from the in-process map cache",
+                                    ['reason'], namespace=namespace)
+map_cache_bytes = Gauge('map_cache_bytes', "Size of the in-process map cache", namespace=namespace,
+                        multiprocess_mode='livesum')
+
+
+def start_handler():
+    """ Start counting the Mongo commands of the current request or socket event. """
+    g.metrics_start = time.perf_counter()
+    g.mongo_queries = 0
+    g.mongo_seconds = 0.0
+
+
+def finish_handler(handler):
+    """ Record the Mongo commands of the current request or socket event. Returns its duration in seconds. """
+    handler_mongo_queries.labels(handler).observe(g.mongo_queries)
+    handler_mongo_seconds.labels(handler).observe(g.mongo_seconds)
+    return time.perf_counter() - g.metrics_start
+
+
+class MongoListener(monitoring.CommandListener):
+    """ Times every Mongo command and adds it to the request or socket event running it. """
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self.record(event)
+
+    def failed(self, event):
+        mongo_command_failures_total.labels(event.command_name).inc()
+        self.record(event)
+
+    @staticmethod
+    def record(event):
+        seconds = event.duration_micros / 1e6
+        mongo_command_seconds.labels(event.command_name).observe(seconds)
+        if has_app_context() and getattr(g, 'mongo_queries', None) is not None:
+            g.mongo_queries += 1
+            g.mongo_seconds += seconds
+
+
+# Only clients created after this see the listener, so register it on import.
+monitoring.register(MongoListener())
+
+
+class RoomCollector():
+    """ Reports the clients connected to this socket worker and the size of its rooms when scraped. """
+
+    def __init__(self, memberships):
+        """Init function for RoomCollector class.
+
+        Keyword arguments:
+        memberships -- Function returning a dict of every connected socket id to the set of rooms it is in.
+        """
+        self.memberships = memberships
+
+    def collect(self):
+        memberships = dict(self.memberships())
+        sizes = {}
+        for codes in memberships.values():
+            for code in codes:
+                sizes[code] = sizes.get(code, 0) + 1
+        yield GaugeMetricFamily(namespace + '_socket_clients', "Clients connected to this worker",
+                                value=len(memberships))
+        yield GaugeMetricFamily(namespace + '_socket_rooms', "Rooms with a client on this worker",
+                                value=len(sizes))
+        buckets = [(str(bound), sum(size <= bound for size in sizes.values())) for bound in room_size_buckets]
+        yield HistogramMetricFamily(namespace + '_socket_room_clients', "Clients of this worker in each room",
+                                    buckets=buckets + [('+Inf', len(sizes))], sum_value=sum(sizes.values()))
+
+
+def timed_event(event):
+    """Decorator recording the latency and Mongo commands of a Socket.IO handler.
+
+    Keyword arguments:
+    event -- Name of the event, used as the metric label.
+
+    Goes below socket.on, so Flask-SocketIO registers the timed handler.
+    """
+    def decorator(handler):
+        @wraps(handler)
+        def timed(*args, **kwargs):
+            start_handler()
+            try:
+                return handler(*args, **kwargs)
+            finally:
+                socket_event_seconds.labels(event).observe(finish_handler('socket:' + event))
+        return timed
+    return decorator
+
+
+class Metrics():
+    """ Records per-route request metrics for an app and serves every metric on /metrics. """
+
+    def __init__(self, app=None):
+        """Init function for Metrics class.
+
+        Keyword arguments:
+        app -- Optional Flask app to bind to immediately.
+        """
+        self.rooms = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Time every request of the app and add the /metrics route.
+
+        Keyword arguments:
+        app -- The Flask app.
+        """
+        app.before_request(start_handler)
+        app.after_request(self.after_request)
+        app.teardown_request(self.teardown_request)
+        app.add_url_rule('/metrics', 'metrics', self.serve)
+        app.extensions['metrics'] = self
+
+    def track_rooms(self, memberships):
+        """Report connected clients and room sizes of a socket worker.
+
+        Keyword arguments:
+        memberships -- Function returning a dict of every connected socket id to the set of rooms it is in.
+        """
+        if self.rooms is None:
+            self.rooms = RoomCollector(memberships)
+            REGISTRY.register(self.rooms)
+        self.rooms.memberships = memberships
+
+    @staticmethod
+    def record(status):
+        if getattr(g, 'metrics_start', None) is None:
+            return
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        seconds = finish_handler(route)
+        g.metrics_start = None
+        requests_total.labels(route, request.method, str(status)).inc()
+        request_seconds.labels(route, request.method).observe(seconds)
+
+    def after_request(self, response):
+        self.record(response.status_code)
+        return response
+
+    def teardown_request(self, exception):
+        # Requests that raised never reach after_request; Flask answers them with a 500.
+        if exception is not None:
+            self.record(500)
+
+    @staticmethod
+    def serve():
+        """ Return every metric in the Prometheus text format. """
+        if os.environ.get('prometheus_multiproc_dir'):
+            registry = CollectorRegistry()
+            multiprocess.MultiProcessCollector(registry)
+        else:
+            registry = REGISTRY
+        return Response(generate_latest(registry), content_type=CONTENT_TYPE_LATEST)
+
+
+metrics = Metrics()
@@ -0,0 +1,45 @@
+import sys
+from argparse import ArgumentParser
+
+from mongoengine import connect
+
+import chunks
+import config
+from models import GameMap
+
+
+def convert(map_id, storage):
+    """Rewrite the models of a map in another storage, keeping its revision and updated time.
+
+    Keyword arguments:
+    map_id -- ObjectId of the map.
+    storage -- 'documents', 'packed' or 'chunked'.
+
+    Retries until the write lands on the revision it read. Returns False if the map was deleted.
+    """
+    while True:
+        stored = GameMap._get_collection().find_one({'_id': map_id}, projection={'revision': 1, 'chunked': 1})
+        game_map = GameMap.find_raw(id=map_id, projection={'models': 1, 'voxels': 1, 'chunked': 1})
+        if stored is None or game_map is None:
+            return False
+        guard = {'revision': stored.get('revision'), 'chunked': stored.get('chunked')}
+        if GameMap.write(map_id, game_map['models'], guard=guard, storage=storage):
+            if stored.get('chunked') and storage != 'chunked':
+                chunks.delete_chunks(map_id)
+            return True
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="Converts stored maps between storage formats")
+    parser.add_argument("storage", choices=['documents', 'packed', 'chunked'],
+                        help="Storage format to convert every map to, see MAP_STORAGE in config.py")
+    parser.add_argument("--deploy", action='store_true')
+    args = parser.parse_args()
+
+    connect(config.MONGODB_DB, host='mongo' if args.deploy else config.MONGODB_HOST,
+            port=config.MONGODB_PORT)
+
+    map_ids = [game_map.id for game_map in GameMap.objects.only('id')]
+    for i, map_id in enumerate(map_ids):
+        convert(map_id, args.storage)
+        print("Converted " + str(i + 1) + "/" + str(len(map_ids)) + " maps", end='\r')
+    print()
@@ -1,21 +1,43 @@
-import random
 import secrets
 import sys
 from json import dumps, loads
 from datetime import datetime as dt
-from bson import ObjectId
-from flask import current_app
+from datetime import timedelta
+from bson import Binary, ObjectId
+from pymongo import ReturnDocument
+from flask import current_app, has_app_context
 from flask_security import (MongoEngineUserDatastore, RoleMixin, Security,
                             UserMixin, login_required)
 from itsdangerous import TimedJSONWebSignatureSerializer as Serializer
 from itsdangerous import BadSignature, SignatureExpired
-from mongoengine import (BooleanField, DateTimeField, Document, DoesNotExist,
+from mongoengine import (BinaryField, BooleanField, DateTimeField, DictField, Document, DoesNotExist,
                          EmailField, EmbeddedDocument, EmbeddedDocumentField,
-                         EmbeddedDocumentListField, IntField, ListField,
-                         ObjectIdField, ReferenceField, StringField)
+                         EmbeddedDocumentListField, IntField, ListField, NotUniqueError,
+                         ObjectIdField, OperationError, Q, ReferenceField, StringField, ValidationError)
 
-from constants import max_size, session_code_choices
-from flask_socketio import SocketIO
+import chunks
+from cache import auth_cache, map_cache
+from codec import pack_models, unpack_models
+from codes import session_code
+from constants import max_size, model_types, session_rooms
+from emitter import emitter
+from encoding import encoder
+from mesh import meshed
+from voxels import position_key, summarize
+
+
+# Key of the GameMap index ownership checks are answered from.
+owner_index = [('_id', 1), ('owner', 1)]
+
+# A claim on a map older than this is taken to belong to a writer that died, see GameMap.claim.
+write_timeout = timedelta(seconds=30)
+
+
+def map_storage():
+    """ Return the configured MAP_STORAGE, documents outside of an app. """
+    if has_app_context():
+        return current_app.config.get('MAP_STORAGE', 'documents')
+    return 'documents'
 
 
 class Role(Document, RoleMixin):
@@ -50,15 +72,7 @@ class GameModel(EmbeddedDocument):
     EmbeddedDocument -- Representation of a One-To-Many Relationship.
 
     """
-    type = StringField(required=True, choices=[
-        'voxel',
-        'floor',
-        'wall',
-        'fighter',
-        'ranger',
-        'knight',
-        'goblin',
-    ])
+    type = StringField(required=True, choices=model_types)
     position = EmbeddedDocumentField(Position)
     color = StringField(
         required=True, regex='^#([A-Fa-f0-9]{6}|[A-Fa-f0-9]{3})$')
@@ -71,6 +85,14 @@ class GameMap(Document):
     EmbeddedDocument -- Representation of a One-To-Many Relationship.
 
     """
+    meta = {
+        'indexes': [
+            # Ownership checks by (id, owner) and the library listing by owner.
+            ('id', 'owner'),
+            ('owner', '-updated', '-id'),
+        ]
+    }
+
     owner = ObjectIdField()
     name = StringField(max_length=255)
     width = IntField(default=16, choices=range(1, max_size + 1))
@@ -80,12 +102,353 @@ class GameMap(Document):
         required=True, regex='^#([A-Fa-f0-9]{6}|[A-Fa-f0-9]{3})$')
     private = BooleanField(default=False)
     models = EmbeddedDocumentListField(GameModel)
+    # Models packed by codec.pack_models when stored with MAP_STORAGE = 'packed'.
+    # Never exposed; loading unpacks it back into models.
+    voxels = BinaryField()
+    # Set on maps stored with MAP_STORAGE = 'chunked', whose models live in
+    # chunks.MapChunk documents. Never exposed.
+    chunked = BooleanField()
+    # When a writer claimed a chunked map, see GameMap.claim. Never exposed.
+    writing = DateTimeField()
+    # Voxel count and bounding box, kept up to date on every write so
+    # listings never have to read models.
+    summary = DictField()
+    revision = IntField(default=0)
     updated = DateTimeField(default=dt.now())
     inserted = DateTimeField(default=dt.now())
 
-    def save(self, *args, **kwargs):
+    _storage = None
+
+    def save(self, *args, storage=None, **kwargs):
+        """ Save the map with its models stored as documents, packed or chunked, see MAP_STORAGE. """
         self.updated = dt.now()
-        super(GameMap, self).save(*args, **kwargs)
+        self.revision = (self.revision or 0) + 1
+        self.summary = summarize(self.models)
+        self._storage = storage or map_storage()
+        # Always rewrite all three so a map never keeps stale voxels or chunks next to its models.
+        self._mark_as_changed('models')
+        self._mark_as_changed('voxels')
+        self._mark_as_changed('chunked')
+        was_chunked = self.chunked
+        claim = None
+        try:
+            if self._storage == 'chunked':
+                if self.id is None:
+                    # Mongoengine takes documents given an id for stored ones, so insert explicitly.
+                    self.id = ObjectId()
+                    kwargs['force_insert'] = True
+                else:
+                    # Like GameMap.write, keep other writers out while the chunks are rewritten.
+                    claimed = GameMap.claim(self.id)
+                    if claimed is None:
+                        raise OperationError("Map " + str(self.id) + " is being written")
+                    claim = claimed[0]
+                # Chunks go first, so the map never points at chunks that are not written yet.
+                chunks.write_chunks(self.id, [model if isinstance(model, dict) else model.to_mongo().to_dict()
+                                              for model in self.models])
+                self.chunked = True
+            else:
+                self.chunked = None
+            super(GameMap, self).save(*args, **kwargs)
+            if claim is not None:
+                # Mongoengine unsets emptied lists, but readers tell chunked
+                # maps from ones read without models by the empty list.
+                GameMap._get_collection().update_one({'_id': self.id, 'writing': claim},
+                                                     {'$set': {'models': []}, '$unset': {'writing': 1}})
+                claim = None
+        finally:
+            self._storage = None
+            if claim is not None:
+                GameMap.release(self.id, claim)
+        if was_chunked and not self.chunked:
+            chunks.delete_chunks(self.id)
+        map_cache.invalidate(self.id)
+
+    def update(self, **kwargs):
+        result = super(GameMap, self).update(**kwargs)
+        map_cache.invalidate(self.id)
+        return result
+
+    def delete(self, *args, **kwargs):
+        super(GameMap, self).delete(*args, **kwargs)
+        chunks.delete_chunks(self.id)
+        map_cache.invalidate(self.id)
+
+    def to_mongo(self, *args, **kwargs):
+        son = super(GameMap, self).to_mongo(*args, **kwargs)
+        son.pop('voxels', None)
+        son.pop('chunked', None)
+        son.pop('writing', None)
+        if self._storage == 'packed' and 'models' in son:
+            son['voxels'] = Binary(pack_models(son['models'], self.width or 1, self.height or 1, self.depth or 1))
+            son['models'] = []
+        elif self._storage == 'chunked' and 'models' in son:
+            son['chunked'] = True
+            son['models'] = []
+        return son
+
+    @classmethod
+    def _from_son(cls, son, *args, **kwargs):
+        """ Unpack maps stored packed or chunked so every reader sees a plain models list. """
+        if son.get('voxels') is not None:
+            son = dict(son)
+            son['models'] = unpack_models(son.pop('voxels'))
+        elif son.get('chunked') and 'models' in son:
+            son = dict(son)
+            son['models'] = chunks.read_models(son['_id'])
+        return super(GameMap, cls)._from_son(son, *args, **kwargs)
+
+    @staticmethod
+    def find_raw(projection=None, **query):
+        """Read one map straight from pymongo, skipping mongoengine hydration.
+
+        Keyword arguments:
+        projection -- Optional pymongo projection.
+        query -- Field filters, where id is the map's ObjectId.
+
+        Returns the stored dict with packed or chunked models loaded, or None.
+        """
+        if 'id' in query:
+            query['_id'] = ObjectId(query.pop('id'))
+        game_map = GameMap._get_collection().find_one(query, projection=projection)
+        if game_map is None:
+            return None
+        if game_map.get('voxels') is not None:
+            game_map['models'] = unpack_models(game_map['voxels'])
+        elif game_map.get('chunked') and 'models' in game_map:
+            game_map['models'] = chunks.read_models(game_map['_id'])
+        for field in ('voxels', 'chunked', 'writing'):
+            game_map.pop(field, None)
+        return game_map
+
+    @staticmethod
+    def owned_query(map_id, owner):
+        """ Return the queryset of the id of a map if owner owns it, covered by the (_id, owner) index. """
+        return GameMap.objects(id=map_id, owner=owner).hint(owner_index).scalar('id')
+
+    @staticmethod
+    def owned_id(map_id, owner):
+        """Check a map exists and belongs to a user without reading the map.
+
+        Keyword arguments:
+        map_id -- The map's id, as sent by the client.
+        owner -- ObjectId of the user.
+
+        Returns the map's ObjectId, or None if there is no such map of that user.
+        """
+        try:
+            return GameMap.owned_query(map_id, owner).first()
+        except ValidationError:
+            return None
+
+    @staticmethod
+    def models_update(models, storage=None):
+        """Return queryset update arguments that replace the models of a map.
+
+        Keyword arguments:
+        models -- List of model dicts.
+        storage -- 'documents' or 'packed', defaults to MAP_STORAGE.
+        """
+        if (storage or map_storage()) == 'packed':
+            return {'set__models': [], 'set__voxels': Binary(pack_models(models)), 'unset__chunked': True,
+                    'set__summary': summarize(models)}
+        return {'set__models': models, 'unset__voxels': True, 'unset__chunked': True,
+                'set__summary': summarize(models)}
+
+    @staticmethod
+    def unclaimed():
+        """ Return a query matching maps no writer holds a claim on, see GameMap.claim. """
+        return Q(writing=None) | Q(writing__lt=dt.now() - write_timeout)
+
+    @staticmethod
+    def claim(map_id, guard=None):
+        """Take the claim on a map so no other write lands while its chunks are rewritten.
+
+        Keyword arguments:
+        map_id -- ObjectId of the map.
+        guard -- Optional dict of field values the map must still have, like its revision.
+
+        Writes made of several steps, like rewriting chunks then the map or
+        patching models in place, claim the map first and release it with
+        their last step. Other writes wait for the claim, see GameMap.write.
+        Claims of writers that died run out after write_timeout.
+
+        Returns the claim and whether the map was already chunked, or None if
+        the map did not match the guard or another writer holds it.
+        """
+        now = dt.now()
+        # Mongo keeps milliseconds, so the claim must round trip.
+        now = now.replace(microsecond=now.microsecond // 1000 * 1000)
+        query = dict(guard or {}, _id=map_id)
+        query['$or'] = [{'writing': None}, {'writing': {'$lt': now - write_timeout}}]
+        claimed = GameMap._get_collection().find_one_and_update(
+            query, {'$set': {'writing': now}}, projection={'chunked': 1})
+        if claimed is None:
+            return None
+        return now, bool(claimed.get('chunked'))
+
+    @staticmethod
+    def release(map_id, claim):
+        """ Drop a claim taken by GameMap.claim without writing the map. """
+        GameMap._get_collection().update_one({'_id': map_id, 'writing': claim}, {'$unset': {'writing': 1}})
+
+    @staticmethod
+    def write(map_id, models=None, touched=None, guard=None, storage=None, **update):
+        """Update a map and its models in the configured storage.
+
+        Keyword arguments:
+        map_id -- ObjectId of the map.
+        models -- Optional full list of model dicts replacing the map's models.
+        touched -- Optional set of position keys where models changed. Chunked
+        maps only rewrite the chunks holding them.
+        guard -- Optional dict of field values the map must still have, like its revision.
+        storage -- Optional storage to write the models in, defaults to MAP_STORAGE.
+        update -- Queryset update arguments of the other fields.
+
+        Returns True if the map was written, False if it did not match the
+        guard or a writer held its claim.
+        """
+        guard = dict(guard or {})
+        if models is None:
+            return GameMap.objects(Q(id=map_id, **guard) & GameMap.unclaimed()).update_one(**update) > 0
+        storage = storage or map_storage()
+        if storage != 'chunked':
+            update.update(GameMap.models_update(models, storage))
+            return GameMap.objects(Q(id=map_id, **guard) & GameMap.unclaimed()).update_one(**update) > 0
+
+        claimed = GameMap.claim(map_id, guard)
+        if claimed is None:
+            return False
+        claim, chunked = claimed
+        try:
+            # Maps not chunked yet have no chunks to keep.
+            if touched is not None and chunked:
+                touched = {chunks.chunk_of(key) for key in touched}
+                chunks.write_chunks(map_id, [model for model in models
+                                             if chunks.chunk_of(position_key(model['position'])) in touched],
+                                    touched)
+            else:
+                chunks.write_chunks(map_id, models)
+            return GameMap.objects(id=map_id, writing=claim).update_one(
+                set__models=[], unset__voxels=True, set__chunked=True, set__summary=summarize(models),
+                unset__writing=True, **update) > 0
+        except Exception:
+            GameMap.release(map_id, claim)
+            raise
+
+    @staticmethod
+    def patch_chunks(map_id, changes):
+        """Apply a batch of edits to a chunked map, only touching the chunks they fall in.
+
+        Keyword arguments:
+        map_id -- ObjectId of the map.
+        changes -- A MapChanges batch.
+
+        Returns the map without models after the edit, or None if a writer held its claim.
+        """
+        claimed = GameMap.claim(map_id)
+        if claimed is None:
+            return None
+        claim = claimed[0]
+        try:
+            chunks.patch_chunks(map_id, changes)
+            return GameMap._get_collection().find_one_and_update(
+                {'_id': map_id, 'writing': claim},
+                {'$inc': {'revision': 1}, '$set': {'updated': dt.now(), 'summary': chunks.chunks_summary(map_id)},
+                 '$unset': {'writing': 1}},
+                projection={'models': 0, 'voxels': 0, 'chunked': 0, 'writing': 0},
+                return_document=ReturnDocument.AFTER)
+        except Exception:
+            GameMap.release(map_id, claim)
+            raise
+
+    @staticmethod
+    def refresh_summary(query):
+        """Recompute the summary of a map stored as documents inside Mongo.
+
+        Keyword arguments:
+        query -- pymongo filter matching the map.
+
+        Used after in place array updates, where the models never reach Python.
+        """
+        collection = GameMap._get_collection()
+        bounds = {}
+        for axis in ('x', 'y', 'z'):
+            bounds['min_' + axis] = {'$min': '$models.position.' + axis}
+            bounds['max_' + axis] = {'$max': '$models.position.' + axis}
+        result = list(collection.aggregate([
+            {'$match': query},
+            {'$project': dict(bounds, voxel_count={'$size': '$models'})},
+        ]))
+        if len(result) == 0:
+            return
+        result = result[0]
+        summary = {'voxel_count': result['voxel_count']}
+        if result['voxel_count'] > 0:
+            summary['min'] = {axis: result['min_' + axis] for axis in ('x', 'y', 'z')}
+            summary['max'] = {axis: result['max_' + axis] for axis in ('x', 'y', 'z')}
+        collection.update_one(query, {'$set': {'summary': summary}})
+
+    @staticmethod
+    def find_page(owner, limit, after=None, projection=None):
+        """Read one page of a user's maps, newest first, without models.
+
+        Keyword arguments:
+        owner -- ObjectId of the user.
+        limit -- Most maps to return.
+        after -- Optional (updated, _id) of the last map of the previous page.
+        projection -- Optional list of fields to return. _id and updated are always included.
+
+        Returns the page and the (updated, _id) to continue after, or None on the last page.
+        """
+        query = {'owner': owner}
+        if after is not None:
+            updated, map_id = after
+            query['$or'] = [{'updated': {'$lt': updated}},
+                            {'updated': updated, '_id': {'$lt': map_id}}]
+        if projection is None:
+            fields = {'models': 0, 'voxels': 0, 'chunked': 0, 'writing': 0}
+        else:
+            fields = dict.fromkeys(projection, 1)
+            fields['updated'] = 1
+        cursor = GameMap._get_collection().find(query, projection=fields) \
+            .sort([('updated', -1), ('_id', -1)]).limit(limit + 1)
+        page = list(cursor)
+        if len(page) <= limit:
+            return page, None
+        page = page[:limit]
+        return page, (page[-1]['updated'], page[-1]['_id'])
+
+
+def map_payload(game_map):
+    """ Return the map fields sent to socket clients from a map dict. """
+    return {'name': game_map['name'], 'color': game_map['color'], 'models': game_map['models'],
+            'width': game_map['width'], 'height': game_map['height'], 'depth': game_map['depth'],
+            'revision': game_map.get('revision', 0)}
+
+
+def encoded_map_payload(map_id, mesh=False):
+    """Return the revision and encoded payload of a map as sent to socket clients, or None if it does not exist.
+
+    Keyword arguments:
+    map_id -- ObjectId of the map.
+    mesh -- Merge voxels, floors and walls into boxes, see mesh.meshed.
+
+    Only the revision is read from Mongo when the payload is in the map cache.
+    """
+    header = GameMap.find_raw(id=map_id, projection={'revision': 1})
+    if header is None:
+        return None
+
+    def build():
+        game_map = GameMap.find_raw(id=map_id)
+        if game_map is None:
+            raise DoesNotExist("Map " + str(map_id) + " does not exist")
+        payload = map_payload(game_map)
+        return encoder.encode(meshed(payload) if mesh else payload)
+
+    revision = header.get('revision', 0)
+    return revision, map_cache.get(map_id, revision, 'payload.mesh' if mesh else 'payload', build)
 
 
 class User(Document, UserMixin):
@@ -110,6 +473,12 @@ class User(Document, UserMixin):
     def save(self, *args, **kwargs):
         self.updated = dt.now()
         super(User, self).save(*args, **kwargs)
+        # Cached tokens must not keep serving the old (possibly deactivated) user.
+        auth_cache.invalidate_user(self.id)
+
+    def delete(self, *args, **kwargs):
+        auth_cache.invalidate_user(self.id)
+        super(User, self).delete(*args, **kwargs)
 
     def verify_password(self, password):
         """ Verify password match """
@@ -123,9 +492,12 @@ class User(Document, UserMixin):
     @staticmethod
     def verify_auth_token(token):
         """ Verify token is still valid for user. """
+        user = auth_cache.get(token, lambda user_id: User.objects(id=user_id).first())
+        if user is not None:
+            return user
         s = Serializer(secrets.SECRET_KEY)
         try:
-            data = s.loads(token)
+            data, header = s.loads(token, return_header=True)
         except SignatureExpired:
             return None  # valid token, but expired
         except BadSignature:
@@ -135,6 +507,7 @@ class User(Document, UserMixin):
                 current_app.logger.error(e)
             return None
         user = User.objects.get(email=data['id'])
+        auth_cache.set(token, user, header.get('exp'))
         return user
 
 #=====================================================
@@ -142,6 +515,19 @@ class User(Document, UserMixin):
 #=====================================================
 
 
+class Counter(Document):
+    """ Named counters handing out unique, increasing numbers. """
+    name = StringField(primary_key=True)
+    value = IntField(default=0)
+
+    @staticmethod
+    def next(name):
+        """ Atomically take the next number of a counter, starting from 0. """
+        counter = Counter._get_collection().find_one_and_update(
+            {'_id': name}, {'$inc': {'value': 1}}, upsert=True, return_document=ReturnDocument.AFTER)
+        return counter['value'] - 1
+
+
 class Session(Document):
     """ Model for sessions.
 
@@ -149,42 +535,45 @@ class Session(Document):
     Model -- The base class for all in-house documents.
 
     """
+    meta = {
+        'indexes': [
+            # Lookups by (id, user_id), by user_id, and by game_map_id for broadcasts.
+            ('id', 'user_id'),
+            'user_id',
+            'game_map_id',
+        ]
+    }
+
     user_id = ObjectIdField()
     game_map_id = ObjectIdField()
     code = StringField(regex='^([A-Za-z0-9]{5})$',  unique=True)
     created_at = DateTimeField(default=dt.now())
 
     def save(self, *args, **kwargs):
-        if self.code == None:
-            code_try = ''
-            for _ in range(0, 5):
-                code_try += random.choice(session_code_choices)
-            while len(Session.objects(code=code_try)) != 0:
-                code_try = ''
-                for _ in range(0, 5):
-                    code_try += random.choice(session_code_choices)
-            self.code = code_try
-
-        game_map = GameMap.objects(id=self.game_map_id).first()
-        game_map = game_map.to_json()
-        game_map = loads(game_map)
-        name = game_map["name"]
-        color = game_map["color"]
-        models = game_map["models"]
-        depth = game_map["depth"]
-        height = game_map["height"]
-        width = game_map["width"]
-        if current_app.config['REDIS_HOST'] is None or current_app.config['REDIS_HOST'] == "":
-            socketio = SocketIO(message_queue='redis://')
-        else:
-            socketio = SocketIO(message_queue='redis://' +
-                                current_app.config['REDIS_HOST'])
-        socketio.emit(
-            'update', {'name': name, 'color': color, 'models': models, 'depth': depth, 'width': width, 'height': height})
-        super().save(*args, **kwargs)
+        generated = self.code is None
+        if generated:
+            # Every session takes the next number of a counter, and numbers map
+            # one to one to codes, so the code is free without looking it up.
+            self.code = session_code(Counter.next('session_code'))
+
+        try:
+            super().save(*args, **kwargs)
+        except NotUniqueError:
+            if not generated:
+                raise
+            # Only sessions made before codes were counted can hold a code the counter hands out.
+            self.code = session_code(Counter.next('session_code'))
+            super().save(*args, **kwargs)
+        # The socket workers send the map to the clients in this session's
+        # room. A new session's room has no clients yet.
+        if not generated:
+            emitter.publish({'session': self.code, 'map_id': str(self.game_map_id)})
 
     def delete(self, *args, **kwargs):
-        socketio = SocketIO(message_queue='redis://' + current_app.config['REDIS_HOST'])
-        socketio.emit('close_room', self.code)
-        
-        super().save(*args, **kwargs)
+        # Tell the clients the session is over, then drop them from its rooms
+        # on every socket worker.
+        emitter.emit('close_room', self.code, room=self.code)
+        for room in session_rooms(self.code):
+            emitter.close_room(room)
+        emitter.publish({'closed': self.code})
+        super().delete(*args, **kwargs)
@@ -0,0 +1,169 @@
+from datetime import datetime as dt
+
+from cache import map_cache
+from models import GameMap, map_payload
+from voxels import position_key
+
+# How many times a flush reloads and retries after losing a race with another writer.
+flush_attempts = 3
+
+
+class MapState():
+    """ Live, authoritative state of one map held by the socket server. """
+
+    def __init__(self, game_map):
+        """Init function for MapState class.
+
+        Keyword arguments:
+        game_map -- The stored map dict, as returned by GameMap.find_raw.
+        """
+        self.map_id = game_map['_id']
+        self.members = set()
+        self.pending = []
+        self.load(game_map)
+
+    def load(self, game_map):
+        """ Replace the state with a stored map, then replay edits not yet written. """
+        self.header = {key: game_map[key] for key in ('name', 'color', 'width', 'height', 'depth')}
+        self.models = {position_key(model['position']): model for model in game_map['models']}
+        self.stored_revision = game_map.get('revision', 0)
+        self.revision = self.stored_revision
+        for changes in self.pending:
+            changes.apply_by_position(self.models)
+            self.revision += 1
+
+    def payload(self):
+        return map_payload(dict(self.header, models=list(self.models.values()), revision=self.revision))
+
+    def apply(self, changes):
+        """Apply a batch of edits in memory.
+
+        Keyword arguments:
+        changes -- A MapChanges batch.
+
+        Returns the new revision. The edit is written to Mongo by the next flush.
+        """
+        changes.apply_by_position(self.models)
+        self.pending.append(changes)
+        self.revision += 1
+        return self.revision
+
+    def is_dirty(self):
+        return len(self.pending) > 0
+
+    def flush(self):
+        """Write the edits applied since the last flush as a single update.
+
+        The write only lands if nobody else changed the map since it was
+        loaded. Otherwise the map is reloaded, the pending edits replayed on
+        top of it and the write retried.
+
+        Returns True once the state is persisted.
+        """
+        for _ in range(flush_attempts):
+            if not self.is_dirty():
+                return True
+            written = len(self.pending)
+            revision = self.revision
+            touched = set()
+            for changes in self.pending:
+                touched |= changes.keys()
+            updated = GameMap.write(self.map_id, list(self.models.values()), touched,
+                                    guard={'revision': self.stored_revision},
+                                    set__revision=revision, set__updated=dt.now())
+            if updated:
+                self.stored_revision = revision
+                self.pending = self.pending[written:]
+            else:
+                # Payloads cached from memory may share a revision with the other writer's map.
+                map_cache.invalidate(self.map_id)
+                game_map = GameMap.find_raw(id=self.map_id)
+                if game_map is None:
+                    # The map was deleted, nothing left to write to.
+                    self.pending = []
+                    return True
+                self.load(game_map)
+        return not self.is_dirty()
+
+
+class MapStates():
+    """ Every map with a client connected to this socket server, keyed by map id. """
+
+    def __init__(self):
+        self.states = {}
+        self.memberships = {}
+        # Maps whose edits were written since the last call to take_flushed.
+        self.flushed = set()
+
+    def load(self, map_id):
+        """Return the state of a map, loading it if it is not held yet.
+
+        Keyword arguments:
+        map_id -- ObjectId of the map.
+
+        Returns the MapState, or None if the map does not exist.
+        """
+        state = self.states.get(map_id)
+        if state is None:
+            game_map = GameMap.find_raw(id=map_id)
+            if game_map is None:
+                return None
+            state = self.states[map_id] = MapState(game_map)
+        elif not state.is_dirty():
+            # Pick up edits made through the REST api while the state was idle.
+            stored = GameMap.find_raw(id=map_id, projection={'revision': 1})
+            if stored is not None and stored.get('revision', 0) != state.stored_revision:
+                state.load(GameMap.find_raw(id=map_id))
+        return state
+
+    def join(self, map_id, sid):
+        """Add a client to a map, loading the map on its first client.
+
+        Keyword arguments:
+        map_id -- ObjectId of the map shown in the client's room.
+        sid -- The client's socket id.
+
+        Returns the MapState, or None if the map does not exist.
+        """
+        state = self.load(map_id)
+        if state is None:
+            return None
+        state.members.add(sid)
+        self.memberships.setdefault(sid, set()).add(map_id)
+        return state
+
+    def get(self, map_id):
+        return self.states.get(map_id)
+
+    def leave(self, sid):
+        """ Remove a disconnected client, flushing and evicting maps left without clients. """
+        for map_id in self.memberships.pop(sid, set()):
+            state = self.states.get(map_id)
+            if state is None:
+                continue
+            state.members.discard(sid)
+            if len(state.members) == 0:
+                self.flush_state(state)
+                if not state.is_dirty():
+                    del self.states[map_id]
+
+    def flush_state(self, state):
+        """ Write a map if it is dirty, recording it in flushed once written. """
+        if state.is_dirty() and state.flush():
+            self.flushed.add(state.map_id)
+
+    def take_flushed(self):
+        """ Return the maps written since the last call, and start over. """
+        flushed, self.flushed = self.flushed, set()
+        return flushed
+
+    def flush(self):
+        """ Write every dirty map. Returns the number of maps still dirty. """
+        dirty = 0
+        for map_id, state in list(self.states.items()):
+            self.flush_state(state)
+            if state.is_dirty():
+                dirty += 1
+            if len(state.members) == 0 and not state.is_dirty():
+                self.states.pop(map_id, None)
+        return dirty
@@ -7,45 +7,77 @@ from flask_cors import CORS
 from flask_mongoengine import MongoEngine
 
 from api import Api
+from config import deploy_config
+from cache import auth_cache, map_cache
 from constants import internal_error, json_tag, malformed_request
 from decorators import expiration_check, protected
+from emitter import emitter
+from encoding import encoder
+from hashing import hasher
+from indexes import ensure_indexes
+from metrics import metrics
 
-parser = ArgumentParser(description="Runs flask server")
-parser.add_argument("--deploy", action='store_true')
-args = parser.parse_args()
+db = MongoEngine()
 
+# Create Blueprint
+api = Blueprint("api", "api", url_prefix="/api")
 
-# Create app
-app = Flask(__name__)
 
-# Load configuration from config file.
-app.config.from_object('config')
+def create_app(config='config', **overrides):
+    """Create and set up the Flask app.
 
-if args.deploy:
-    app.config['REDIS_HOST'] = 'redis'
-    app.config['MONGODB_HOST'] = 'mongo'
+    Keyword arguments:
+    config -- Import name of the config module, or an object holding the config.
+    overrides -- Config values replacing the ones from config.
 
+    Returns the app with the api registered. Every worker process calls this once.
+    """
+    app = Flask(__name__)
 
-# Set CORS
-CORS(app, resources={r"/api/*": {"origins": "*"}},
-     expose_headers=['Content-Type', 'Authorization'])
+    # Load configuration from config file.
+    app.config.from_object(config)
+    app.config.update(overrides)
 
-# Setup DB connection.
-db = MongoEngine(app)
+    # Set CORS
+    CORS(app, resources={r"/api/*": {"origins": "*"}},
+         expose_headers=['Content-Type', 'Authorization', 'ETag', 'X-Next-Cursor'])
 
-# Instantiate Api to use DB Connection for user_datastore.
-# To remove circular dependency.
-Api(db)
+    # Setup DB connection.
+    db.init_app(app)
+    ensure_indexes()
+
+    # Setup the long-lived Socket.IO emitter shared by every request.
+    emitter.init_app(app)
+
+    # Setup the cache of verified auth tokens.
+    auth_cache.init_app(app)
+
+    # Setup the cache of encoded map payloads.
+    map_cache.init_app(app)
+
+    # Setup JSON encoding and compression of map responses.
+    encoder.init_app(app)
+
+    # Setup the pool that runs bcrypt off the request threads.
+    hasher.init_app(app)
+
+    # Time every request and serve /metrics.
+    metrics.init_app(app)
+
+    # Instantiate Api to use DB Connection for user_datastore.
+    # To remove circular dependency.
+    Api(db)
+
+    app.add_url_rule('/', 'index', index)
+    app.register_blueprint(api)
+    return app
 
-# Create Blueprint
-api = Blueprint("api", "api", url_prefix="/api")
 
 # IS THIS BEING USED???
 # Setup Flask-Security
 # security = Security(app, user_datastore)
 
 
-@app.route('/')
 def index():
     """ Entry point to site for production. """
     return render_template('index.html')
@@ -90,11 +122,19 @@ def read_map(claims, token_user, id):
     return Api.read_map(claims, token_user, id)
 
 
+@api.route('/map/<map_id>/chunks', methods=['GET'])
+@protected
+@expiration_check
+def read_chunks(claims, token_user, map_id):
+    """ Return the models of a range of chunks of a map by id. """
+    return Api.read_chunks(claims, token_user, map_id)
+
+
 @api.route("/maps/<string:user_id>", methods=['GET'])
 @protected
 @expiration_check
 def read_list_of_maps(claims, token_user, user_id):
-    """ Get all maps for a user. """
+    """ Get a page of maps for a user. """
     return Api.read_list_of_maps(claims, token_user, user_id)
 
 
@@ -114,6 +154,14 @@ def update_map(claims, token_user, map_id):
     return Api.update_map(claims, token_user, map_id)
 
 
+@api.route('/map/<map_id>', methods=['PATCH'])
+@protected
+@expiration_check
+def patch_map(claims, token_user, map_id):
+    """ Applies a batch of voxel edits to a map by id. """
+    return Api.patch_map(claims, token_user, map_id)
+
+
 @api.route('/map/<map_id>', methods=['DELETE'])
 @protected
 @expiration_check
@@ -166,6 +214,9 @@ def update_session(claims, token_user, id):
 # Main
 #=====================================================
 if __name__ == '__main__':
+    # Development server. In production run the app with gunicorn, see wsgi.py.
+    parser = ArgumentParser(description="Runs flask server")
+    parser.add_argument("--deploy", action='store_true')
     # TODO: logic not implemented for this because we should wait
     parser.add_argument("mode", nargs='?', choices=[
                         'd', 'p'], help="Selects whether or not you want to run development or production")
@@ -175,7 +226,8 @@ if __name__ == '__main__':
                         type=str, help="Who you want to send to")
     parser.add_argument("-u", "--user", nargs=2, type=str,
                         help="Insert a new user: takes username, password")
+    args = parser.parse_args()
 
-    app.register_blueprint(api)
+    app = create_app(**(deploy_config if args.deploy else {}))
     app.run(ssl_context=('/app/cert.pem', '/app/privkey.pem'),
             host='0.0.0.0', port=8443)
@@ -0,0 +1,15 @@
+#!/bin/bash
+# Starts SOCKET_WORKERS socket server processes on consecutive ports from
+# SOCKET_BASE_PORT + 1. nginx sends each client address to one of them, see
+# the hash $remote_addr in the sockets upstream of nginx.conf. Extra arguments
+# go to somesockets.py.
+WORKERS=${SOCKET_WORKERS:-4}
+BASE_PORT=${SOCKET_BASE_PORT:-5000}
+
+for i in $(seq 1 $WORKERS); do
+    python somesockets.py --port $((BASE_PORT + i)) "$@" &
+done
+
+# Stop every worker as soon as one exits, so the container restarts them all.
+trap 'kill $(jobs -p) 2>/dev/null' EXIT
+wait -n
@@ -3,76 +3,454 @@ from argparse import ArgumentParser
 from json import loads
 from threading import Lock
 
-import eventlet
-from flask import Flask, jsonify, request
+from bson import ObjectId
+from mongoengine import DoesNotExist
+from flask import Flask, current_app, jsonify, request
 from flask_mongoengine import MongoEngine
 from flask_socketio import (SocketIO, close_room, emit, join_room, leave_room,
                             rooms, send)
+from socketio import PubSubManager
 
-from models import GameMap, Session
+from cache import map_cache
+from config import deploy_config
+from constants import diff_room, is_diff_room, is_mesh_room, session_rooms, update_room
+from encoding import Encoded, encoder
+from indexes import ensure_indexes
+from metrics import metrics, timed_event
+from models import GameMap, Session, User, encoded_map_payload
+from rooms import MapStates
+from mesh import meshed
+from voxels import MapChanges, nearest_first
+from workers import workers
 
-parser = ArgumentParser(description="Socket server")
-parser.add_argument("--deploy", action='store_true')
-args = parser.parse_args()
+db = MongoEngine()
+socket = SocketIO()
 
-eventlet.monkey_patch()
 
-app = Flask(__name__)
-app.config['MONGODB_DB'] = 'mydatabase'
-app.config['MONGODB_PORT'] = 27017
+def create_socket_app(config='config', port=80, **overrides):
+    """Create and set up the socket server app.
 
+    Keyword arguments:
+    config -- Import name of the config module, or an object holding the config.
+    port -- The port this worker listens on, used to tell workers apart.
+    overrides -- Config values replacing the ones from config.
 
-if args.deploy:
-    socket = SocketIO(app, logger=True, engineio_logger=True,
-                      message_queue="redis://redis")
-    app.config['MONGODB_HOST'] = 'mongo'
-    db = MongoEngine(app)
-else:
-    socket = SocketIO(app, logger=True, engineio_logger=True,
-                      message_queue="redis://")
-    app.config['MONGODB_HOST'] = 'localhost'
-    db = MongoEngine(app)
+    Returns the Flask app. Start it with socket.run.
+    """
+    app = Flask(__name__)
+    app.config.from_object(config)
+    app.config.update(overrides)
+    encoder.init_app(app)
+    map_cache.init_app(app)
+
+    # Large polling payloads are compressed by engine.io; websocket clients can
+    # ask for zlib compressed map payloads when they join.
+    socket.init_app(app, logger=app.config['SOCKET_LOGGER'], engineio_logger=app.config['SOCKET_LOGGER'],
+                    message_queue=('redis://' + (app.config.get('REDIS_HOST') or ''))
+                    if app.config['SOCKET_MESSAGE_QUEUE'] else None,
+                    async_mode=app.config.get('SOCKET_ASYNC_MODE'), json=encoder, http_compression=True,
+                    compression_threshold=encoder.compress_min_size)
+
+    db.init_app(app)
+    ensure_indexes()
+
+    # Every worker shares map ownership through Redis.
+    workers.init_app(app, port)
+
+    # Serve /metrics, with the clients and rooms of this worker.
+    metrics.init_app(app)
+    metrics.track_rooms(lambda: workers.memberships)
+
+    socket.start_background_task(flush_map_states, app)
+    socket.start_background_task(receive_messages, app)
+    app.add_url_rule('/health', 'health', health)
+    return app
+
+
+# Maps being edited live, held in memory and written behind to Mongo.
+# Only the worker holding a map's lease keeps it; see workers.py.
+map_states = MapStates()
+
+
+def worker_stats():
+    return {'worker': workers.worker_id, 'clients': len(workers.memberships),
+            'maps': len(map_states.states),
+            'dirty_maps': sum(state.is_dirty() for state in map_states.states.values())}
+
+
+def flush_map_states(app):
+    """ Write dirty map states to Mongo every ROOM_FLUSH_INTERVAL seconds, announce them and renew this worker's leases. """
+    while True:
+        socket.sleep(app.config['ROOM_FLUSH_INTERVAL'])
+        with app.app_context():
+            try:
+                map_states.flush()
+                # Clients without diffs get the whole map once per flush, not once per edit.
+                for map_id in map_states.take_flushed():
+                    workers.publish({'map_id': str(map_id), 'update': True})
+                workers.hold(map_states.states)
+                workers.renew()
+            except Exception as e:
+                app.logger.error(str(e))
+
+
+def receive_messages(app):
+    """ Apply the edits other workers forward for the maps this worker owns, and pass announced edits on to clients. """
+    for message in workers.listen():
+        with app.app_context():
+            try:
+                if 'changes' in message:
+                    edit(ObjectId(message['map_id']), MapChanges.from_json(message['changes']), message['changes'])
+                else:
+                    announced(message)
+            except Exception as e:
+                app.logger.error(str(e))
+
+
+def emit_here(event, data, room):
+    """ Emit to the clients of a room connected to this worker, without the message queue. """
+    local = {'ignore_queue': True} if isinstance(socket.server.manager, PubSubManager) else {}
+    socket.server.emit(event, data, room=room, namespace='/', **local)
+
+
+def announced(message):
+    """Send a message every worker got on workers.maps_channel to this worker's clients.
+
+    Keyword arguments:
+    message -- Either a map_id with the encoded diff of an edit and whether
+    the stored map changed, a session code with the map it shows now, or the
+    code of a closed session.
+
+    Clients that joined with "diffs" get the diff, the others get the whole
+    map, encoded at most once per worker and only if one of them is here.
+    """
+    if 'closed' in message:
+        workers.forget(message['closed'])
+        return
+    map_id = ObjectId(message['map_id'])
+    if 'session' in message:
+        workers.move(message['session'], map_id)
+        send_updates(map_id, workers.session_rooms(message['session']))
+        return
+    rooms = workers.rooms_showing(map_id)
+    if message.get('diff') is not None:
+        diff = Encoded(message['diff'].encode())
+        for room in rooms:
+            if is_diff_room(room):
+                emit_here('mapDiff', diff, room)
+    if message.get('update'):
+        send_updates(map_id, [room for room in rooms if not is_diff_room(room)])
+
+
+def send_updates(map_id, rooms):
+    """ Send the whole map as an update event to rooms with clients on this worker, meshed in mesh rooms. """
+    if len(rooms) == 0:
+        return
+    # A map held in memory picks up the REST edit being announced first.
+    state = map_states.load(map_id) if map_states.get(map_id) is not None else None
+    updates = {}
+    for room in rooms:
+        mesh = is_mesh_room(room)
+        if mesh not in updates:
+            payload = encoded_map(map_id, state, mesh)
+            updates[mesh] = None if payload is None else Encoded(payload[1])
+        if updates[mesh] is not None:
+            emit_here('update', updates[mesh], room)
+
+
+def map_message(map_id, sid, compression=None, event=None, mesh=False):
+    """Return a map encoded as it should be sent to a client, or None if it does not exist.
+
+    Keyword arguments:
+    map_id -- ObjectId of the map.
+    sid -- The client's socket id.
+    compression -- The compression the client announced when joining, if any.
+    event -- Name of the event the map is sent with.
+    mesh -- Merge voxels, floors and walls into boxes, see mesh.meshed.
+
+    The map is served from memory when this worker owns it, otherwise from
+    Mongo, and encoded once per revision through the map cache.
+    """
+    kind = 'payload.mesh' if mesh else 'payload'
+    state = None
+    if workers.claim(map_id) == workers.worker_id:
+        state = map_states.join(map_id, sid)
+        if state is None:
+            return None
+    payload = encoded_map(map_id, state, mesh)
+    if payload is None:
+        return None
+    revision, body, shared = payload
+    return encoder.socket_payload(body, compression, event, lambda: map_cache.get(
+        map_id, revision, kind + '.zlib', lambda: encoder.deflate(body), shared))
+
+
+def encoded_map(map_id, state=None, mesh=False):
+    """Return the revision, encoded payload and whether other processes may share it of a map, or None if it does not exist.
+
+    Keyword arguments:
+    map_id -- ObjectId of the map.
+    state -- The map's MapState when this worker holds it, else it is read from Mongo.
+    mesh -- Merge voxels, floors and walls into boxes, see mesh.meshed.
+    """
+    if state is None:
+        payload = encoded_map_payload(map_id, mesh)
+        return None if payload is None else payload + (True,)
+    # Revisions not flushed yet are not in Mongo, so other processes must not see them.
+    revision, shared = state.revision, not state.is_dirty()
+    body = map_cache.get(map_id, revision, 'payload.mesh' if mesh else 'payload', lambda: encoder.encode(
+        meshed(state.payload()) if mesh else state.payload()), shared)
+    return revision, body, shared
+
+
+def stream_body(models, header, size):
+    """Encode the models of a map as the mapChunk messages of a streamed join.
+
+    Keyword arguments:
+    models -- List of model dicts.
+    header -- The map's header, with its width, depth and revision.
+    size -- Most models in one message.
+
+    Returns the encoded messages, one per line, nearest to the floor's center first.
+    """
+    ordered = nearest_first(models, header['width'], header['depth'])
+    # Encoded JSON never holds a raw newline, so the messages can share one cache entry.
+    return b'\n'.join(encoder.encode({'revision': header['revision'], 'index': index,
+                                       'models': ordered[start:start + size]})
+                      for index, start in enumerate(range(0, len(ordered), size)))
+
+
+def map_stream(map_id, sid):
+    """Return the header of a map and a function giving its mapChunk messages, or None if it does not exist.
+
+    Keyword arguments:
+    map_id -- ObjectId of the map.
+    sid -- The client's socket id.
+
+    The header is read without the models, so it can be sent right away.
+    The messages are encoded once per revision through the map cache.
+    """
+    if workers.claim(map_id) == workers.worker_id:
+        state = map_states.join(map_id, sid)
+        if state is None:
+            return None
+        header = dict(state.header, revision=state.revision, voxel_count=len(state.models))
+        # Revisions not flushed yet are not in Mongo, so other processes must not see them.
+        models, shared = list(state.models.values()), not state.is_dirty()
+
+        def load():
+            return models
+    else:
+        stored = GameMap.find_raw(id=map_id, projection={'name': 1, 'color': 1, 'width': 1, 'height': 1,
+                                                         'depth': 1, 'revision': 1, 'summary': 1})
+        if stored is None:
+            return None
+        header = {key: stored[key] for key in ('name', 'color', 'width', 'height', 'depth')}
+        header.update(revision=stored.get('revision', 0),
+                      voxel_count=stored.get('summary', {}).get('voxel_count'))
+        shared = True
+
+        def load():
+            game_map = GameMap.find_raw(id=map_id)
+            if game_map is None:
+                raise DoesNotExist("Map " + str(map_id) + " does not exist")
+            return game_map['models']
+
+    def messages():
+        size = current_app.config.get('STREAM_CHUNK_VOXELS', 2048)
+        body = map_cache.get(map_id, header['revision'], 'stream',
+                             lambda: stream_body(load(), header, size), shared)
+        return body.split(b'\n') if body else []
+    return header, messages
+
+
+def join_map_room(room, map_id, diffs, mesh=False):
+    """Join the client to a session room and to the sub-room of the edits it wants.
+
+    Keyword arguments:
+    room -- Code of the room, lower case.
+    map_id -- ObjectId of the map shown in the room.
+    diffs -- True for edits as mapDiff events, False for the whole map as update events.
+    mesh -- True for updates with merged boxes, see mesh.meshed.
+    """
+    sub_room = diff_room(room) if diffs else update_room(room, mesh)
+    join_room(room)
+    join_room(sub_room)
+    workers.join(room, request.sid)
+    workers.listen_to(room, map_id, sub_room, request.sid)
+
+
+def stream_join(room, map_id, diffs=False):
+    """Join a client to a room, sending the map header first and its models after, nearest first.
+
+    Keyword arguments:
+    room -- Code of the room, lower case.
+    map_id -- ObjectId of the map shown in the room.
+    diffs -- True for later edits as mapDiff events, see join_map_room.
+
+    The client gets roomFound with the header and no models, then mapChunk
+    messages of at most STREAM_CHUNK_VOXELS models each, then mapStreamEnd.
+    Every message carries the revision the models are at; mapDiffs or updates
+    for later revisions can arrive before mapStreamEnd and apply after it.
+    """
+    stream = map_stream(map_id, request.sid)
+    if stream is None:
+        emit('roomNotFound', {'data': 'Room ' + room + ' does not exist.'})
+        return
+    header, messages = stream
+    join_map_room(room, map_id, diffs)
+    emit('roomFound', dict(header, models=[], streaming=True))
+    # Let the header go out before the models are read and encoded.
+    socket.sleep(0)
+    count = 0
+    for count, message in enumerate(messages(), 1):
+        emit('mapChunk', Encoded(message))
+        socket.sleep(0)
+    emit('mapStreamEnd', {'revision': header['revision'], 'chunks': count})
+
+
+def edit(map_id, changes, raw_changes, sid=None):
+    """Apply an edit to a map, or forward it to the worker that owns the map.
+
+    Keyword arguments:
+    map_id -- ObjectId of the map.
+    changes -- The validated MapChanges.
+    raw_changes -- The changes as received, forwarded as is.
+    sid -- Socket id of the editing client, if connected to this worker.
+
+    Returns False if the map does not exist or its owner could not be reached.
+    Raises ValueError if the changes place a model outside the map.
+    """
+    owner = workers.claim(map_id)
+    if owner != workers.worker_id:
+        return workers.forward(owner, map_id, raw_changes)
+    state = map_states.load(map_id) if sid is None else map_states.join(map_id, sid)
+    if state is None:
+        return False
+    if changes.is_empty():
+        return True
+    changes.check_bounds(state.header['width'], state.header['height'], state.header['depth'])
+    revision = state.apply(changes)
+    payload = encoder.encode(dict(changes.to_diff(), revision=revision, **state.header))
+    # Every worker sends the diff to its own clients, see announced. The
+    # whole map follows once the edit is flushed.
+    workers.publish({'map_id': str(map_id), 'diff': payload.decode('utf-8')})
+    return True
+
+
+def health():
+    """ Report whether this worker can reach Redis and Mongo, for load balancers. """
+    try:
+        workers.redis.ping()
+        GameMap._get_db().command('ping')
+    except Exception as e:
+        return jsonify(status='unavailable', worker=workers.worker_id, error=str(e)), 503
+    return jsonify(status='ok', **worker_stats()), 200
 
 
 @socket.on('connect')
+@timed_event('connect')
 def connect():
     emit('connected', {})
 
 
 @socket.on('joinRoom')
+@timed_event('joinRoom')
 def join(json):
+    """Join a client to a session room and send it the map.
+
+    Besides the room, the client can ask for zlib compression, a streamed map
+    with "stream" (see stream_join), merged boxes with "mesh" (see mesh.py)
+    and edits as mapDiff events with "diffs". Clients that do not ask for
+    diffs get the whole map as an update event once edits are written,
+    meshed if they asked for "mesh".
+    """
     try:
         room = json['room']
-        session = Session.objects(code=room.lower()).first()
-        if session is not None:
-            join_room(room.lower())
+        session = Session.objects(code=room.lower()).only('game_map_id').first()
+        if session is not None and json.get('stream'):
+            stream_join(room.lower(), session.game_map_id, bool(json.get('diffs')))
+        elif session is not None:
+            payload = map_message(session.game_map_id, request.sid, json.get('compression'), 'roomFound',
+                                  bool(json.get('mesh')))
+            if payload is None:
+                emit('roomNotFound', {'data': 'Room ' + room + ' does not exist.'})
+                return
+            join_map_room(room.lower(), session.game_map_id, bool(json.get('diffs')), bool(json.get('mesh')))
             # sends a message event
             # send("{} has joined {}".format(request.sid, room), room=room)
-            game_map = GameMap.objects(id=session.game_map_id).first()
-            game_map = game_map.to_json()
-            game_map = loads(game_map)
-            name = game_map["name"]
-            color = game_map["color"]
-            models = game_map["models"]
-            width = game_map["width"]
-            height = game_map["height"]
-            color = game_map["color"]
-            depth = game_map["depth"]
-
-            emit('roomFound', {'name': name, 'color': color,
-                               'models': models, 'width': width, 'height': height, 'depth': depth})
+            emit('roomFound', payload)
+        else:
+            emit('roomNotFound', {'data': 'Room ' + room + ' does not exist.'})
+    except KeyError:
+        emit('error', {'data': 'Malformed request'})
+    except Exception as e:
+        current_app.logger.error(str(e))
+        emit('error', {'data': 'Internal server error'})
+
+
+@socket.on('resync')
+@timed_event('resync')
+def resync(json):
+    """ Resend the full map to a client that missed a mapDiff revision. """
+    try:
+        room = json['room']
+        session = Session.objects(code=room.lower()).only('game_map_id').first()
+        payload = None if session is None else map_message(session.game_map_id, request.sid,
+                                                           json.get('compression'), 'update',
+                                                           bool(json.get('mesh')))
+        if payload is not None:
+            emit('update', payload)
         else:
             emit('roomNotFound', {'data': 'Room ' + room + ' does not exist.'})
     except KeyError:
         emit('error', {'data': 'Malformed request'})
     except Exception as e:
-        app.logger.error(str(e))
+        current_app.logger.error(str(e))
+        emit('error', {'data': 'Internal server error'})
+
+
+@socket.on('editMap')
+@timed_event('editMap')
+def edit_map(json):
+    """ Apply an edit from the session owner in memory and send it to every room showing the map. """
+    try:
+        room = json['room']
+        user = User.verify_auth_token(json['auth_token'])
+        session = Session.objects(code=room.lower()).only('game_map_id', 'user_id').first()
+        if session is None:
+            emit('roomNotFound', {'data': 'Room ' + room + ' does not exist.'})
+            return
+        if user is None or user.id != session.user_id:
+            emit('error', {'data': 'Unauthorized'})
+            return
+        changes = MapChanges.from_json(json['changes'])
+        if not edit(session.game_map_id, changes, json['changes'], request.sid):
+            emit('error', {'data': 'Map is unavailable, please retry'})
+    except KeyError:
+        emit('error', {'data': 'Malformed request'})
+    except ValueError as e:
+        emit('error', {'data': str(e)})
+    except Exception as e:
+        current_app.logger.error(str(e))
         emit('error', {'data': 'Internal server error'})
 
 
+@socket.on('disconnect')
+@timed_event('disconnect')
+def client_disconnected():
+    """ Write the maps the client was showing once their last client leaves. """
+    try:
+        map_states.leave(request.sid)
+        workers.leave(request.sid)
+    except Exception as e:
+        current_app.logger.error(str(e))
+
+
 @socket.on('close_room')
 def disconnect(room):
-    close_room(room)
+    for code in session_rooms(room):
+        close_room(code)
 
 
 # Leave room event should be here but we were unable to get it to work.
@@ -82,4 +460,14 @@ def disconnect(room):
 
 
 if __name__ == "__main__":
-    socket.run(app, debug=True, host='0.0.0.0', port=80)
+    parser = ArgumentParser(description="Socket server")
+    parser.add_argument("--deploy", action='store_true')
+    parser.add_argument("--port", type=int, default=80,
+                        help="Port to listen on. Run one process per port to use several workers, see sockets.sh")
+    args = parser.parse_args()
+
+    import eventlet
+    eventlet.monkey_patch()
+
+    app = create_socket_app(port=args.port, **(deploy_config if args.deploy else {}))
+    socket.run(app, debug=True, host='0.0.0.0', port=args.port)
@@ -1,28 +1,66 @@
+import gzip
+import itertools
 import os
 import tempfile
+import threading
+import time
 import unittest
+from datetime import datetime
 
 import bcrypt
 import base64
 import jwt
+from bson import ObjectId
 from json import dumps, loads
 from flask import Blueprint
-from server import app, api
+from server import create_app
 from secrets import JWT_KEY
-from models import GameMap, User, Session, Role
+from models import Counter, GameMap, User, Session, Role
+from chunks import MapChunk
+from cache import MapCache, SizedCache, auth_cache, map_cache
+from codes import code_space, session_code
+from encoding import encoder
+from hashing import hasher
+from mesh import mesh_models
+from metrics import RoomCollector
+from rooms import MapStates
+from somesockets import create_socket_app, socket
+from voxels import MapChanges, nearest_first
 from constants import max_email_length, max_password_length
 from flask_security import MongoEngineUserDatastore
 from flask_mongoengine import MongoEngine
+from mongoengine import OperationError
+from prometheus_client import REGISTRY
+
+app = create_app(MONGODB_DB='test')
+socket_app = None
+
+
+def wait_for(client, count, timeout=5):
+    """ Return the events a socket test client received once there are count of them, or after timeout seconds. """
+    received = []
+    deadline = time.monotonic() + timeout
+    while len(received) < count and time.monotonic() < deadline:
+        time.sleep(0.05)
+        received += client.get_received()
+    return received
+
+
+def socket_client():
+    """ Return a Socket.IO test client of a lone socket worker, created on first use. """
+    global socket_app
+    if socket_app is None:
+        socket_app = create_socket_app(port=0, MONGODB_DB='test', SOCKET_MESSAGE_QUEUE=False,
+                                       SOCKET_LOGGER=False, SOCKET_ASYNC_MODE='threading')
+    return socket.test_client(socket_app)
 
 
 class TestApp(unittest.TestCase):
 
     def setUp(self):
         self.db_fd, app.config['DATABASE'] = tempfile.mkstemp()
-        app.config['MONGODB_DB'] = 'test'
         app.config['DEBUG'] = False
         app.testing = True
-        app.register_blueprint(api)
         self.client = app.test_client()
         self.assertEqual(app.debug, False)
 
@@ -30,6 +68,10 @@ class TestApp(unittest.TestCase):
         GameMap.objects.all().delete()
         User.objects.all().delete()
         Session.objects.all().delete()
+        Counter.objects.all().delete()
+        MapChunk.objects.all().delete()
+        auth_cache.clear()
+        map_cache.clear()
         os.close(self.db_fd)
         os.unlink(app.config['DATABASE'])
 
@@ -127,6 +169,28 @@ class TestApp(unittest.TestCase):
         self.assertEqual(response[0], 422)
         self.assertEqual(response[1]['error'], "Incorrect email or password")
 
+        # Every request thread left for bcrypt busy
+        settings = ('WEB_THREADS', 'BCRYPT_RESERVED_THREADS', 'BCRYPT_RETRY_AFTER')
+        saved = {key: app.config[key] for key in settings}
+        app.config.update(WEB_THREADS=2, BCRYPT_RESERVED_THREADS=1, BCRYPT_RETRY_AFTER=3)
+        hasher.init_app(app)
+        started, finish = threading.Event(), threading.Event()
+        busy = threading.Thread(target=hasher.run, args=(lambda: started.set() or finish.wait(),))
+        busy.start()
+        try:
+            started.wait()
+            data = dict(email=valid_email, password=valid_password)
+            response = self.request('/api/auth', data, 'POST')
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(response.headers['Retry-After'], '3')
+        finally:
+            finish.set()
+            busy.join()
+        response = helper(data)
+        self.assertEqual(response[0], 200)
+        app.config.update(saved)
+        hasher.init_app(app)
+
     def test_authenticated(self):
         def helper(auth_data, payload=None):
             response = self.request(
@@ -163,6 +227,81 @@ class TestApp(unittest.TestCase):
         self.assertEqual(response[0], 401)
         self.assertEqual(response[1], {'error': 'token expired.'})
 
+    def test_auth_cache(self):
+        valid_email = "validEmail@gmail.com"
+        User(email=valid_email, password="unused").save()
+        valid_user = User.objects(email=valid_email).first()
+        token = valid_user.generate_auth_token()
+
+        # Second lookup is served from the cache
+        self.assertEqual(User.verify_auth_token(token).id, valid_user.id)
+        self.assertIs(User.verify_auth_token(token), User.verify_auth_token(token))
+
+        # Saving the user drops its cached tokens
+        valid_user.active = False
+        valid_user.save()
+        self.assertFalse(User.verify_auth_token(token).active)
+
+        # Invalid tokens are never cached
+        self.assertIsNone(User.verify_auth_token('garbage_token'))
+
+        # Redis only holds the user's id
+        app.config['AUTH_CACHE_REDIS'] = True
+        auth_cache.init_app(app)
+        try:
+            token = valid_user.generate_auth_token()
+            self.assertEqual(User.verify_auth_token(token).id, valid_user.id)
+            self.assertEqual(auth_cache.redis.get(auth_cache.prefix + auth_cache.key(token)).decode(),
+                             str(valid_user.id))
+            auth_cache.clear()
+            self.assertEqual(User.verify_auth_token(token).email, valid_email)
+        finally:
+            app.config['AUTH_CACHE_REDIS'] = False
+            auth_cache.init_app(app)
+
+    def test_map_cache(self):
+        # Bounded by bytes, least recently used first
+        cache = SizedCache(max_bytes=10)
+        cache.set('a', b'1234')
+        cache.set('b', b'1234')
+        cache.get('a')
+        self.assertEqual(cache.set('c', b'1234'), 1)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), b'1234')
+        self.assertEqual(cache.size, 8)
+        self.assertEqual(cache.set('d', b'x' * 11), 0)
+        self.assertIsNone(cache.get('d'))
+
+        # Built once per map revision and kind
+        builds = []
+
+        def build():
+            builds.append(1)
+            return b'{}'
+        for _ in range(3):
+            self.assertEqual(map_cache.get('cached', 1, 'payload', build), b'{}')
+        map_cache.get('cached', 2, 'payload', build)
+        self.assertEqual(len(builds), 2)
+        map_cache.invalidate('cached')
+        map_cache.get('cached', 2, 'payload', build)
+        self.assertEqual(len(builds), 3)
+
+        # Reads encode a map once, and saving the map drops it
+        User(email="validEmail@gmail.com", password="unused").save()
+        user = User.objects(email="validEmail@gmail.com").first()
+        token = dict(auth_token=user.generate_auth_token().decode('utf-8'))
+        game_map = GameMap(owner=user.id, name="cached", color="#fff",
+                           models=[dict(type="wall", position=dict(x=0, y=0, z=0), color="#fff")])
+        game_map.save()
+        response = self.request('/api/map/' + str(game_map.id), token, 'GET')
+        self.assertIsNotNone(map_cache.local.get(MapCache.key(game_map.id, game_map.revision, 'document')))
+        self.assertEqual(self.request('/api/map/' + str(game_map.id), token, 'GET').data, response.data)
+        game_map.name = "renamed"
+        game_map.save()
+        self.assertIsNone(map_cache.local.get(MapCache.key(game_map.id, game_map.revision - 1, 'document')))
+        response = self.request('/api/map/' + str(game_map.id), token, 'GET')
+        self.assertEqual(loads(response.data.decode('utf-8'))['name'], "renamed")
+
     def test_create_map(self):
         def helper(auth_data, payload=None):
             response = self.request('/api/map', auth_data, 'POST', payload)
@@ -210,6 +349,170 @@ class TestApp(unittest.TestCase):
         self.assertEqual(response[0], 200)
         self.assertEqual(response[1]['success'], "Successfully created map")
 
+        # Every invalid model is reported at once
+        map_dict['models'] = [
+            dict(type="voxel", position=dict(x=0, y=0, z=0), color="#fff"),
+            dict(type="dragon", position=dict(x=1, y=0, z=0), color="#fff"),
+            dict(type="voxel", position=dict(x=2, y=0, z=0), color="white"),
+            dict(type="voxel", position=dict(x=4, y=0, z=0), color="#fff"),
+            dict(type="voxel", position=dict(x=0, y=0, z=0), color="#000"),
+            dict(type="voxel", position=dict(x="1", y=0, z=0), color="#fff"),
+        ]
+        data['map'] = dumps(map_dict)
+        response = helper(valid_token, data)
+        self.assertEqual(response[0], 422)
+        self.assertEqual(response[1]['error'], "Invalid models")
+        self.assertEqual(response[1]['errors'], [
+            {'index': 1, 'error': "Invalid model type"},
+            {'index': 2, 'error': "Invalid color"},
+            {'index': 3, 'error': "Position out of bounds"},
+            {'index': 4, 'error': "Position already occupied"},
+            {'index': 5, 'error': "Malformed model"},
+        ])
+
+        # Map size outside what is allowed
+        map_dict['models'] = []
+        map_dict['width'] = 0
+        data['map'] = dumps(map_dict)
+        response = helper(valid_token, data)
+        self.assertEqual(response[0], 422)
+        self.assertEqual(response[1]['error'], "Malformed request")
+
+        map_dict['width'] = 4
+        map_dict['models'] = [dict(type="voxel", position=dict(x=x, y=4, z=5), color="#abc") for x in range(4)]
+        data['map'] = dumps(map_dict)
+        response = helper(valid_token, data)
+        self.assertEqual(response[0], 200)
+        self.assertEqual(response[1]['map']['models'], map_dict['models'])
+
+    def test_read_map(self):
+        def helper(auth_data, map_id, accept_encoding='', **headers):
+            headers['Authorization'] = 'Bearer ' + \
+                jwt.encode(dict(data=auth_data), base64.b64decode(JWT_KEY), algorithm='HS512').decode()
+            headers['Accept-Encoding'] = accept_encoding
+            return self.client.open('/api/map/' + map_id, method='GET', headers=headers)
+
+        # Create user
+        valid_email = "validEmail@gmail.com"
+        valid_password = "validPassword123"
+        encrypted_password = bcrypt.hashpw(
+            valid_password.encode(), bcrypt.gensalt())
+        User(email=valid_email, password=encrypted_password).save()
+
+        # Get token
+        response = self.request('/api/auth', dict(email=valid_email,
+                                                  password=valid_password), 'POST')
+        valid_token = loads(response.data.decode('utf-8'))
+
+        # Create a map large enough to be compressed
+        models = [dict(type="floor", position=dict(x=x, y=0, z=z), color="#fff")
+                  for x in range(16) for z in range(16)]
+        map_dict = dict(name="test_map", width=16, height=5,
+                        depth=16, color="#fff", private=True, models=models)
+        response = self.request('/api/map', valid_token, 'POST', dict(map=dumps(map_dict)))
+        test_map_id = loads(response.data.decode('utf-8'))['map']['_id']['$oid']
+        # Last-Modified has a resolution of seconds, so date the map back.
+        GameMap.objects(id=test_map_id).update_one(set__updated=datetime(2000, 1, 1))
+
+        # Success
+        response = helper(valid_token, test_map_id)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('Content-Encoding', response.headers)
+        json = loads(response.data.decode('utf-8'))
+        self.assertEqual(json['_id']['$oid'], test_map_id)
+        self.assertEqual(json['models'], models)
+
+        # Compressed when the client accepts gzip
+        response = helper(valid_token, test_map_id, 'gzip')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(loads(gzip.decompress(response.data).decode('utf-8')), json)
+
+        # Unchanged since the client's copy
+        etag = response.headers['ETag']
+        last_modified = response.headers['Last-Modified']
+        response = helper(valid_token, test_map_id, **{'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        response = helper(valid_token, test_map_id, **{'If-Modified-Since': last_modified})
+        self.assertEqual(response.status_code, 304)
+
+        # Changed since the client's copy
+        response = self.request('/api/map/' + test_map_id, valid_token, 'POST', dict(map=dict(name="renamed")))
+        self.assertEqual(response.status_code, 200)
+        response = helper(valid_token, test_map_id, **{'If-Modified-Since': last_modified})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['Last-Modified'], last_modified)
+        response = helper(valid_token, test_map_id, **{'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+        # Map does not exist
+        response = helper(valid_token, "507f191e810c19729de860ea")
+        self.assertEqual(response.status_code, 404)
+
+    def test_read_list_of_maps(self):
+        def helper(auth_data, query=''):
+            response = self.request('/api/maps/unused' + query, auth_data, 'GET')
+            return response, loads(response.data.decode('utf-8'))
+
+        # Create user
+        valid_email = "validEmail@gmail.com"
+        valid_password = "validPassword123"
+        encrypted_password = bcrypt.hashpw(
+            valid_password.encode(), bcrypt.gensalt())
+        User(email=valid_email, password=encrypted_password).save()
+
+        # Get token
+        response = self.request('/api/auth', dict(email=valid_email,
+                                                  password=valid_password), 'POST')
+        valid_token = loads(response.data.decode('utf-8'))
+
+        # Create maps
+        for i in range(3):
+            models = [dict(type="voxel", position=dict(x=i, y=1, z=2), color="#fff")]
+            map_dict = dict(name="test_map" + str(i), width=4, height=5,
+                            depth=6, color="#fff", private=True, models=models)
+            self.request('/api/map', valid_token, 'POST', dict(map=dumps(map_dict)))
+
+        # Everything fits on one page
+        response = helper(valid_token)
+        self.assertEqual(response[0].status_code, 200)
+        self.assertNotIn('X-Next-Cursor', response[0].headers)
+        self.assertEqual([m['name'] for m in response[1]], ["test_map2", "test_map1", "test_map0"])
+        self.assertNotIn('models', response[1][0])
+        self.assertEqual(response[1][0]['summary'], {'voxel_count': 1, 'min': dict(x=2, y=1, z=2),
+                                                     'max': dict(x=2, y=1, z=2)})
+
+        # Paging through with a cursor
+        response = helper(valid_token, '?limit=2&fields=name')
+        self.assertEqual([m['name'] for m in response[1]], ["test_map2", "test_map1"])
+        self.assertNotIn('summary', response[1][0])
+        cursor = response[0].headers['X-Next-Cursor']
+        response = helper(valid_token, '?limit=2&fields=name&cursor=' + cursor)
+        self.assertEqual([m['name'] for m in response[1]], ["test_map0"])
+        self.assertNotIn('X-Next-Cursor', response[0].headers)
+
+        # Unchanged pages are not sent again
+        response = helper(valid_token, '?limit=2&fields=name')
+        etag = response[0].headers['ETag']
+        headers = {'Authorization': 'Bearer ' + jwt.encode(dict(data=valid_token), base64.b64decode(JWT_KEY),
+                                                           algorithm='HS512').decode(),
+                   'If-None-Match': etag}
+        response = self.client.open('/api/maps/unused?limit=2&fields=name', method='GET', headers=headers)
+        self.assertEqual(response.status_code, 304)
+
+        # An edited map moves to the front
+        test_map = GameMap.objects(name="test_map0").first()
+        self.request('/api/map/' + str(test_map.id), valid_token, 'POST', dict(map=dict(name="edited")))
+        response = self.client.open('/api/maps/unused?limit=2&fields=name', method='GET', headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([m['name'] for m in loads(response.data.decode('utf-8'))], ["edited", "test_map2"])
+
+        # Bad parameters
+        for query in ['?limit=0', '?fields=models', '?cursor=garbage']:
+            response = helper(valid_token, query)
+            self.assertEqual(response[0].status_code, 422)
+
     def test_update_map(self):
         def helper(auth_data, map_id, payload=None):
             response = self.request(
@@ -257,7 +560,7 @@ class TestApp(unittest.TestCase):
         #map = request.json['map']
         data = dict(map=dumps({}))
         test_map = loads(test_map.to_json())
-        mapz = {'id': test_map_id, 'name': test_map['name'], 'color': test_map['color'],
+        mapz = {'name': test_map['name'], 'color': test_map['color'],
                 'width': test_map['width'], 'height': test_map['height'], 'depth': test_map['depth']}
 
         data['map'] = mapz
@@ -293,6 +596,463 @@ class TestApp(unittest.TestCase):
         self.assertEqual(response[0], 200)
         self.assertNotEqual(response[1]['map']['color'], invalid_color)
 
+        # Only the map's own fields can be changed
+        for field in ('id', 'owner', 'revision', 'updated', 'voxels', 'chunked', 'writing'):
+            data['map'] = dict(mapz, **{field: 'x'})
+            response = helper(valid_token, test_map_id, data)
+            self.assertEqual(response[0], 422)
+            self.assertEqual(response[1], {'error': 'Malformed request'})
+        self.assertEqual(GameMap.objects(id=test_map_id).first().owner, valid_user.id)
+
+        # Models are checked against the map's size
+        data['map'] = dict(mapz, models=[dict(type="voxel", position=dict(x=0, y=0, z=6), color="#fff")])
+        response = helper(valid_token, test_map_id, data)
+        self.assertEqual(response[0], 422)
+        self.assertEqual(response[1]['errors'], [{'index': 0, 'error': "Position out of bounds"}])
+
+    def test_patch_map(self):
+        def helper(auth_data, map_id, payload=None):
+            response = self.request(
+                '/api/map/' + map_id, auth_data, 'PATCH', payload)
+            json = loads(response.data.decode('utf-8'))
+            return response.status_code, json
+
+        # Create user
+        valid_email = "validEmail@gmail.com"
+        valid_password = "validPassword123"
+        encrypted_password = bcrypt.hashpw(
+            valid_password.encode(), bcrypt.gensalt())
+        User(email=valid_email, password=encrypted_password).save()
+
+        # Get token
+        response = self.request('/api/auth', dict(email=valid_email,
+                                                  password=valid_password), 'POST')
+        valid_token = loads(response.data.decode('utf-8'))
+
+        # Create map
+        models = [dict(type="voxel", position=dict(x=0, y=0, z=0), color="#fff"),
+                  dict(type="wall", position=dict(x=1, y=0, z=0), color="#000")]
+        map_dict = dict(name="test_map", width=4, height=5,
+                        depth=6, color="#fff", private=True, models=models)
+        data = dict(map=dumps(map_dict))
+        response = self.request('/api/map', valid_token, 'POST', data)
+        json = loads(response.data.decode('utf-8'))
+        test_map_id = json['map']['_id']['$oid']
+        revision = json['map']['revision']
+
+        # Outside the map, though within max_size
+        changes = dict(add=[dict(type="floor", position=dict(x=4, y=0, z=0), color="#abc")])
+        response = helper(valid_token, test_map_id, dict(changes=changes))
+        self.assertEqual(response[0], 422)
+        self.assertEqual(response[1]['error'], "Position out of bounds")
+        self.assertEqual(GameMap.objects(id=test_map_id).first().revision, revision)
+
+        # Success
+        changes = dict(add=[dict(type="floor", position=dict(x=2, y=0, z=0), color="#abc")],
+                       remove=[dict(x=0, y=0, z=0)],
+                       recolor=[dict(position=dict(x=1, y=0, z=0), color="#123456")])
+        response = helper(valid_token, test_map_id, dict(changes=changes))
+        self.assertEqual(response[0], 200)
+        self.assertEqual(response[1]['revision'], revision + 1)
+        test_map = GameMap.objects(id=test_map_id).first()
+        placed = {(m.position.x, m.position.y, m.position.z): (m.type, m.color)
+                  for m in test_map.models}
+        self.assertEqual(placed, {(1, 0, 0): ("wall", "#123456"),
+                                  (2, 0, 0): ("floor", "#abc")})
+
+        # Adding onto an occupied position replaces the model
+        changes = dict(add=[dict(type="goblin", position=dict(x=2, y=0, z=0), color="#fff")])
+        response = helper(valid_token, test_map_id, dict(changes=changes))
+        self.assertEqual(response[0], 200)
+        test_map = GameMap.objects(id=test_map_id).first()
+        self.assertEqual(len(test_map.models), 2)
+
+        # Invalid color
+        changes = dict(recolor=[dict(position=dict(x=1, y=0, z=0), color="not a color")])
+        response = helper(valid_token, test_map_id, dict(changes=changes))
+        self.assertEqual(response[0], 422)
+        self.assertEqual(response[1]['error'], "Malformed request")
+
+        # Map does not exist
+        garbage_map_id = "507f191e810c19729de860ea"
+        response = helper(valid_token, garbage_map_id, dict(changes={}))
+        self.assertEqual(response[0], 404)
+        self.assertEqual(response[1], {'error': 'Map does not exist'})
+
+    def test_packed_storage(self):
+        User(email="packed@gmail.com", password=bcrypt.hashpw(b"validPassword123", bcrypt.gensalt())).save()
+        user = User.objects(email="packed@gmail.com").first()
+        token = loads(self.request('/api/auth', dict(email="packed@gmail.com", password="validPassword123"),
+                                   'POST').data.decode('utf-8'))
+        models = [dict(type="voxel", position=dict(x=x, y=0, z=0), color="#fff") for x in range(4)]
+        models.append(dict(type="goblin", position=dict(x=3, y=4, z=5), color="#123456"))
+        game_map = GameMap(owner=user.id, name="test_map", width=4, height=5, depth=6,
+                           color="#fff", private=True, models=models)
+        game_map.save(storage='packed')
+
+        # Stored as a blob
+        raw = GameMap._get_collection().find_one({'_id': game_map.id})
+        self.assertEqual(raw['models'], [])
+        self.assertIsNotNone(raw['voxels'])
+
+        # Read back as models
+        loaded = loads(GameMap.objects(id=game_map.id).first().to_json())
+        self.assertNotIn('voxels', loaded)
+        self.assertEqual(loaded['models'], models)
+
+        # A patch rewrites the blob
+        changes = dict(add=[dict(type="wall", position=dict(x=0, y=1, z=0), color="#000")],
+                       remove=[dict(x=1, y=0, z=0)], recolor=[dict(position=dict(x=0, y=0, z=0), color="#123")])
+        response = self.request('/api/map/' + str(game_map.id), token, 'PATCH', dict(changes=changes))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(loads(response.data.decode('utf-8'))['revision'], game_map.revision + 1)
+        raw = GameMap._get_collection().find_one({'_id': game_map.id})
+        self.assertEqual(raw['models'], [])
+        self.assertIsNotNone(raw['voxels'])
+        self.assertEqual(raw['summary']['voxel_count'], 5)
+        models = GameMap.find_raw(id=game_map.id)['models']
+        self.assertEqual(sorted((m['position']['x'], m['position']['y'], m['color']) for m in models),
+                         [(0, 0, "#123"), (0, 1, "#000"), (2, 0, "#fff"), (3, 0, "#fff"), (3, 4, "#123456")])
+
+        # Saving as documents unpacks it again
+        GameMap.objects(id=game_map.id).first().save(storage='documents')
+        raw = GameMap._get_collection().find_one({'_id': game_map.id})
+        self.assertEqual(len(raw['models']), len(models))
+        self.assertNotIn('voxels', raw)
+
+    def test_chunked_storage(self):
+        User(email="chunks@gmail.com", password=bcrypt.hashpw(b"validPassword123", bcrypt.gensalt())).save()
+        user = User.objects(email="chunks@gmail.com").first()
+        token = loads(self.request('/api/auth', dict(email="chunks@gmail.com", password="validPassword123"),
+                                   'POST').data.decode('utf-8'))
+        models = [dict(type="voxel", position=dict(x=x, y=0, z=z), color="#fff") for x in (0, 17, 33) for z in (1, 20)]
+        game_map = GameMap(owner=user.id, name="test_map", width=40, height=5, depth=24,
+                           color="#fff", private=True, models=models)
+        game_map.save(storage='chunked')
+
+        def positions(found):
+            return sorted((m['position']['x'], m['position']['y'], m['position']['z'], m['color']) for m in found)
+
+        # One document per chunk holding models
+        raw = GameMap._get_collection().find_one({'_id': game_map.id})
+        self.assertEqual(raw['models'], [])
+        self.assertTrue(raw['chunked'])
+        self.assertEqual(MapChunk.objects(map_id=game_map.id).count(), 6)
+
+        # Read back as models, without the storage fields
+        self.assertEqual(positions(GameMap.find_raw(id=game_map.id)['models']), positions(models))
+        loaded = loads(GameMap.objects(id=game_map.id).first().to_json())
+        self.assertNotIn('chunked', loaded)
+        self.assertEqual(positions(loaded['models']), positions(models))
+
+        app.config['MAP_STORAGE'] = 'chunked'
+        try:
+            # A patch only rewrites the chunk it falls in
+            untouched = MapChunk._get_collection().find_one({'map_id': game_map.id, 'x': 2, 'y': 0, 'z': 1})
+            changes = dict(add=[dict(type="wall", position=dict(x=1, y=0, z=1), color="#000")],
+                           recolor=[dict(position=dict(x=0, y=0, z=1), color="#123")])
+            response = self.request('/api/map/' + str(game_map.id), token, 'PATCH', dict(changes=changes))
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(MapChunk._get_collection().find_one({'_id': untouched['_id']}), untouched)
+            stored = GameMap.find_raw(id=game_map.id)
+            self.assertEqual(stored['summary']['voxel_count'], 7)
+            self.assertEqual(stored['revision'], game_map.revision + 1)
+            self.assertIn((0, 0, 1, "#123"), positions(stored['models']))
+
+            # Full updates drop emptied chunks
+            models = [dict(type="voxel", position=dict(x=x, y=0, z=1), color="#fff") for x in (0, 33)]
+            response = self.request('/api/map/' + str(game_map.id), token, 'POST', dict(map=dict(models=models)))
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(positions(GameMap.find_raw(id=game_map.id)['models']), positions(models))
+            self.assertEqual(MapChunk.objects(map_id=game_map.id).count(), 2)
+
+            # New maps are chunked from the start
+            map_dict = dict(name="new_map", width=40, height=5, depth=24, color="#fff", private=True, models=models)
+            response = self.request('/api/map', token, 'POST', dict(map=dumps(map_dict)))
+            self.assertEqual(response.status_code, 200)
+            new_map_id = ObjectId(loads(response.data.decode('utf-8'))['map']['_id']['$oid'])
+            self.assertTrue(GameMap._get_collection().find_one({'_id': new_map_id})['chunked'])
+            self.assertEqual(MapChunk.objects(map_id=new_map_id).count(), 2)
+            response = self.request('/api/map/' + str(new_map_id), token, 'GET')
+            self.assertEqual(positions(loads(response.data.decode('utf-8'))['models']), positions(models))
+
+            # Saving waits for other writers of the chunks
+            claim = GameMap.claim(game_map.id)[0]
+            with self.assertRaises(OperationError):
+                GameMap.objects(id=game_map.id).first().save(storage='chunked')
+            GameMap.release(game_map.id, claim)
+            GameMap.objects(id=game_map.id).first().save(storage='chunked')
+            self.assertIsNone(GameMap._get_collection().find_one({'_id': game_map.id}).get('writing'))
+            self.assertEqual(positions(GameMap.find_raw(id=game_map.id)['models']), positions(models))
+        finally:
+            app.config['MAP_STORAGE'] = 'documents'
+
+        # A range of chunks
+        response = self.request('/api/map/' + str(game_map.id) + '/chunks?from=1,0,0&to=2,0,0', token, 'GET')
+        self.assertEqual(response.status_code, 200)
+        body = loads(response.data.decode('utf-8'))
+        self.assertEqual(body['chunk_size'], 16)
+        self.assertEqual([(chunk['x'], chunk['y'], chunk['z']) for chunk in body['chunks']], [(2, 0, 0)])
+        self.assertEqual(positions(body['chunks'][0]['models']), [(33, 0, 1, "#fff")])
+        response = self.request('/api/map/' + str(game_map.id) + '/chunks?from=1,0', token, 'GET')
+        self.assertEqual(response.status_code, 422)
+
+        # Saving as documents drops the chunks
+        GameMap.objects(id=game_map.id).first().save(storage='documents')
+        self.assertEqual(MapChunk.objects(map_id=game_map.id).count(), 0)
+        self.assertEqual(len(GameMap._get_collection().find_one({'_id': game_map.id})['models']), 2)
+
+    def test_nearest_first(self):
+        models = [dict(type="voxel", position=dict(x=x, y=y, z=z), color="#fff")
+                  for x in (0, 2, 4) for y in (0, 3) for z in (0, 2, 4)]
+        ordered = nearest_first(models, 5, 5)
+        self.assertEqual(len(ordered), len(models))
+        # The center of the floor first, the top corners last
+        self.assertEqual(ordered[0]['position'], dict(x=2, y=0, z=2))
+        self.assertEqual({m['position']['y'] for m in ordered[-4:]}, {3})
+        distances = [(m['position']['x'] - 2) ** 2 + m['position']['y'] ** 2 + (m['position']['z'] - 2) ** 2
+                     for m in ordered]
+        self.assertEqual(distances, sorted(distances))
+        self.assertEqual(nearest_first([], 5, 5), [])
+
+    def test_mesh(self):
+        models = [dict(type="floor", position=dict(x=x, y=0, z=z), color="#fff") for x in range(4) for z in range(3)]
+        models += [dict(type="wall", position=dict(x=0, y=y, z=0), color="#000") for y in range(1, 5)]
+        models += [dict(type="wall", position=dict(x=3, y=1, z=2), color="#123")]
+        models += [dict(type="goblin", position=dict(x=2, y=1, z=1), color="#fff")]
+
+        result = mesh_models(models)
+        # The floor, the wall column and the lone wall
+        self.assertEqual(len(result['boxes']), 3)
+        self.assertEqual(result['models'], [models[-1]])
+        cells = set()
+        for x, y, z, width, height, depth, index in result['boxes']:
+            entry = result['palette'][index]
+            for cell in itertools.product(range(x, x + width), range(y, y + height), range(z, z + depth)):
+                self.assertNotIn(cell, {key for key, _ in cells})
+                cells.add((cell, (entry['type'], entry['color'])))
+        self.assertEqual(cells, {((m['position']['x'], m['position']['y'], m['position']['z']), (m['type'], m['color']))
+                                 for m in models[:-1]})
+
+        # Served on request by the api
+        User(email="mesh@gmail.com", password=bcrypt.hashpw(b"validPassword123", bcrypt.gensalt())).save()
+        user = User.objects(email="mesh@gmail.com").first()
+        token = loads(self.request('/api/auth', dict(email="mesh@gmail.com", password="validPassword123"),
+                                   'POST').data.decode('utf-8'))
+        game_map = GameMap(owner=user.id, name="test_map", width=4, height=5, depth=3, color="#fff", models=models)
+        game_map.save()
+        body = loads(self.request('/api/map/' + str(game_map.id) + '?mesh=1', token, 'GET').data.decode('utf-8'))
+        self.assertEqual(len(body['mesh']['boxes']), 3)
+        self.assertEqual(body['models'], [models[-1]])
+        body = loads(self.request('/api/map/' + str(game_map.id), token, 'GET').data.decode('utf-8'))
+        self.assertNotIn('mesh', body)
+        self.assertEqual(len(body['models']), len(models))
+
+    def test_map_states(self):
+        models = [dict(type="voxel", position=dict(x=x, y=0, z=0), color="#fff") for x in range(3)]
+        game_map = GameMap(name="test_map", width=4, height=4, depth=4,
+                           color="#fff", private=True, models=models)
+        game_map.save()
+        states = MapStates()
+        state = states.join(game_map.id, 'a')
+        self.assertEqual(state.revision, 1)
+        self.assertIsNone(states.join(GameMap().id, 'a'))
+
+        # Edits stay in memory until flushed
+        state.apply(MapChanges.from_json({'add': [dict(type="goblin", position=dict(x=3, y=3, z=3), color="#000")],
+                                          'remove': [dict(x=0, y=0, z=0)]}))
+        state.apply(MapChanges.from_json({'recolor': [dict(position=dict(x=1, y=0, z=0), color="#123")]}))
+        self.assertEqual(state.revision, 3)
+        self.assertEqual(len(state.payload()['models']), 3)
+        self.assertEqual(len(GameMap.find_raw(id=game_map.id)['models']), 3)
+        self.assertEqual(GameMap.find_raw(id=game_map.id)['revision'], 1)
+
+        self.assertEqual(states.flush(), 0)
+        stored = GameMap.find_raw(id=game_map.id)
+        self.assertEqual(stored['revision'], 3)
+        self.assertEqual(sorted((m['position']['x'], m['color']) for m in stored['models']),
+                         [(1, "#123"), (2, "#fff"), (3, "#000")])
+
+        # A write made elsewhere is merged under the pending edits
+        state.apply(MapChanges.from_json({'remove': [dict(x=2, y=0, z=0)]}))
+        GameMap.objects(id=game_map.id).first().save()
+        self.assertEqual(states.flush(), 0)
+        stored = GameMap.find_raw(id=game_map.id)
+        self.assertEqual(stored['revision'], 5)
+        self.assertEqual(len(stored['models']), 2)
+
+        # The last client leaving evicts the map
+        states.join(game_map.id, 'b')
+        states.leave('a')
+        self.assertIsNotNone(states.get(game_map.id))
+        states.leave('b')
+        self.assertIsNone(states.get(game_map.id))
+
+    def test_socket_edits(self):
+        user = User(email="validEmail@gmail.com", password=bcrypt.hashpw(b"validPassword123", bcrypt.gensalt()))
+        user.save()
+        game_map = GameMap(owner=user.id, name="test_map", width=4, height=4, depth=4, color="#fff", private=True,
+                           models=[dict(type="voxel", position=dict(x=0, y=0, z=0), color="#fff")])
+        game_map.save()
+        session = Session(user_id=user.id, game_map_id=game_map.id)
+        session.save()
+
+        # Clients get whole maps as updates unless they ask for diffs
+        plain, diffs = socket_client(), socket_client()
+        plain.emit('joinRoom', {'room': session.code})
+        diffs.emit('joinRoom', {'room': session.code.upper(), 'diffs': True})
+        self.assertEqual([event['name'] for event in plain.get_received()], ['connected', 'roomFound'])
+        self.assertEqual([event['name'] for event in diffs.get_received()], ['connected', 'roomFound'])
+
+        # Diffs go out per edit, whole maps once per flush
+        token = user.generate_auth_token().decode()
+        changes = {'add': [dict(type="wall", position=dict(x=1, y=0, z=0), color="#000")]}
+        diffs.emit('editMap', {'room': session.code, 'auth_token': token, 'changes': changes})
+        diffs.emit('editMap', {'room': session.code, 'auth_token': token,
+                               'changes': {'recolor': [dict(position=dict(x=0, y=0, z=0), color="#123")]}})
+        received = wait_for(diffs, 2)
+        self.assertEqual([event['name'] for event in received], ['mapDiff', 'mapDiff'])
+        self.assertEqual([event['args'][0]['revision'] for event in received], [2, 3])
+        self.assertEqual(received[0]['args'][0]['added'], changes['add'])
+        received = wait_for(plain, 1)
+        self.assertEqual([event['name'] for event in received], ['update'])
+        self.assertEqual(received[0]['args'][0]['revision'], 3)
+        self.assertEqual(len(received[0]['args'][0]['models']), 2)
+        self.assertEqual(GameMap.find_raw(id=game_map.id)['revision'], 3)
+
+        # A closed session's clients stop getting edits
+        plain.emit('close_room', session.code)
+        diffs.emit('editMap', {'room': session.code, 'auth_token': token,
+                               'changes': {'remove': [dict(x=1, y=0, z=0)]}})
+        self.assertEqual(wait_for(plain, 1, 1.5), [])
+        self.assertEqual(diffs.get_received(), [])
+        plain.disconnect()
+        diffs.disconnect()
+
+    def test_socket_announcements(self):
+        User(email="validEmail@gmail.com", password=bcrypt.hashpw(b"validPassword123", bcrypt.gensalt())).save()
+        user = User.objects(email="validEmail@gmail.com").first()
+        token = loads(self.request('/api/auth', dict(email="validEmail@gmail.com", password="validPassword123"),
+                                   'POST').data.decode('utf-8'))
+        game_map = GameMap(owner=user.id, name="test_map", width=4, height=4, depth=4, color="#fff", private=True,
+                           models=[dict(type="voxel", position=dict(x=0, y=0, z=0), color="#fff")])
+        game_map.save()
+        other_map = GameMap(owner=user.id, name="other_map", width=4, height=4, depth=4, color="#000",
+                            private=True, models=[])
+        other_map.save()
+        session = Session(user_id=user.id, game_map_id=game_map.id)
+        session.save()
+        plain, diffs, meshes = socket_client(), socket_client(), socket_client()
+        plain.emit('joinRoom', {'room': session.code})
+        diffs.emit('joinRoom', {'room': session.code, 'diffs': True})
+        meshes.emit('joinRoom', {'room': session.code, 'mesh': True})
+        for client in (plain, diffs, meshes):
+            client.get_received()
+
+        # A REST edit publishes the diff, and the worker sends the whole map to clients without diffs
+        changes = {'add': [dict(type="wall", position=dict(x=1, y=0, z=0), color="#000")]}
+        response = self.request('/api/map/' + str(game_map.id), token, 'PATCH', dict(changes=changes))
+        self.assertEqual(response.status_code, 200)
+        received = wait_for(plain, 1)
+        self.assertEqual([event['name'] for event in received], ['update'])
+        self.assertEqual(received[0]['args'][0]['revision'], game_map.revision + 1)
+        self.assertEqual(len(received[0]['args'][0]['models']), 2)
+        received = wait_for(diffs, 1)
+        self.assertEqual([event['name'] for event in received], ['mapDiff'])
+        self.assertEqual(received[0]['args'][0]['added'], changes['add'])
+        received = wait_for(meshes, 1)
+        self.assertEqual([event['name'] for event in received], ['update'])
+        self.assertEqual(received[0]['args'][0]['models'], [])
+        self.assertEqual(len(received[0]['args'][0]['mesh']['boxes']), 2)
+
+        # Pointing the session at another map sends it to every client
+        session.game_map_id = other_map.id
+        session.save()
+        for client in (plain, diffs, meshes):
+            received = wait_for(client, 1)
+            self.assertEqual([event['name'] for event in received], ['update'])
+            self.assertEqual(received[0]['args'][0]['name'], "other_map")
+        response = self.request('/api/map/' + str(game_map.id), token, 'PATCH',
+                                dict(changes={'remove': [dict(x=1, y=0, z=0)]}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(wait_for(plain, 1, 0.5), [])
+        for client in (plain, diffs, meshes):
+            client.disconnect()
+
+    def test_socket_stream(self):
+        models = [dict(type="voxel", position=dict(x=x, y=0, z=0), color="#fff") for x in range(5)]
+        game_map = GameMap(name="test_map", width=5, height=4, depth=1, color="#fff", private=True, models=models)
+        game_map.save()
+        session = Session(user_id=ObjectId(), game_map_id=game_map.id)
+        session.save()
+
+        client = socket_client()
+        socket_app.config['STREAM_CHUNK_VOXELS'] = 2
+        try:
+            client.emit('joinRoom', {'room': session.code, 'stream': True})
+        finally:
+            socket_app.config['STREAM_CHUNK_VOXELS'] = 2048
+        received = client.get_received()
+        self.assertEqual([event['name'] for event in received],
+                         ['connected', 'roomFound', 'mapChunk', 'mapChunk', 'mapChunk', 'mapStreamEnd'])
+        header = received[1]['args'][0]
+        self.assertEqual((header['models'], header['streaming'], header['voxel_count']), ([], True, 5))
+
+        # Nearest to the floor's center first, every model once
+        chunks = [event['args'][0] for event in received[2:5]]
+        self.assertEqual([chunk['index'] for chunk in chunks], [0, 1, 2])
+        self.assertEqual([chunk['revision'] for chunk in chunks], [game_map.revision] * 3)
+        positions = [model['position']['x'] for chunk in chunks for model in chunk['models']]
+        self.assertEqual(positions[0], 2)
+        self.assertEqual(sorted(positions), list(range(5)))
+        self.assertEqual(received[5]['args'][0], {'revision': game_map.revision, 'chunks': 3})
+        client.disconnect()
+
+    def test_session_codes(self):
+        # Distinct for every index, and valid codes
+        codes = [session_code(index) for index in range(20000)]
+        self.assertEqual(len(set(codes)), len(codes))
+        for code in codes[:100]:
+            self.assertRegex(code, '^[a-z0-9]{5}$')
+        self.assertEqual(len(session_code(code_space - 1)), 5)
+        with self.assertRaises(ValueError):
+            session_code(code_space)
+
+        # Sessions take consecutive counter values
+        first = Counter.next('test_codes')
+        self.assertEqual(Counter.next('test_codes'), first + 1)
+
+    def test_metrics(self):
+        def sample(name, **labels):
+            return REGISTRY.get_sample_value(name, labels) or 0
+
+        # Requests are counted per route, method and status
+        labels = dict(route='/api/map/<id>', method='GET')
+        response = self.request('/api/map/000000000000000000000000', None, 'GET')
+        status = str(response.status_code)
+        before = sample('artop_requests_total', status=status, **labels)
+        self.request('/api/map/000000000000000000000000', None, 'GET')
+        self.assertEqual(sample('artop_requests_total', status=status, **labels), before + 1)
+        self.assertGreater(sample('artop_request_seconds_count', **labels), 0)
+
+        # Socket.IO packets carrying map payloads are sized
+        before = sample('artop_payload_bytes_count', event='roomFound', encoding='json')
+        encoder.dumps(['roomFound', {'models': []}])
+        encoder.dumps(['mapDiff', {'models': []}])
+        self.assertEqual(sample('artop_payload_bytes_count', event='roomFound', encoding='json'), before + 1)
+
+        # Room sizes of a socket worker
+        collector = RoomCollector(lambda: {'a': {'room1'}, 'b': {'room1'}, 'c': {'room2'}})
+        families = {family.name: family for family in collector.collect()}
+        self.assertEqual(families['artop_socket_clients'].samples[0][2], 3)
+        self.assertEqual(families['artop_socket_rooms'].samples[0][2], 2)
+
+        # Served in the Prometheus text format
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'artop_requests_total', response.data)
+        self.assertIn(b'artop_bcrypt_seconds', response.data)
+
     def test_delete_map(self):
         def helper(auth_data, map_id, payload=None):
             response = self.request(
@@ -404,6 +1164,17 @@ class TestApp(unittest.TestCase):
         self.assertEqual(json['session'], session_json)
         self.assertEqual(json['success'], 'Successfully read session')
 
+    def test_owned_id(self):
+        owner, other = ObjectId(), ObjectId()
+        game_map = GameMap(owner=owner, name="owned", color="#fff")
+        game_map.save()
+
+        # Only the owner's existing maps are found, without loading them
+        self.assertEqual(GameMap.owned_id(str(game_map.id), owner), game_map.id)
+        self.assertIsNone(GameMap.owned_id(str(game_map.id), other))
+        self.assertIsNone(GameMap.owned_id(str(ObjectId()), owner))
+        self.assertIsNone(GameMap.owned_id("not an id", owner))
+
     def test_create_session(self):
         def helper(auth_data, payload=None):
             response = self.request(
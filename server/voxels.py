@@ -0,0 +1,299 @@
+import numpy as np
+
+from constants import color_pattern, max_size, model_types
+
+type_codes = {model_type: code for code, model_type in enumerate(model_types)}
+# Colors already matched against color_pattern, so each distinct color is checked once.
+color_table = {}
+color_table_size = 4096
+
+
+def position_key(position):
+    """ Return a hashable (x, y, z) key for a position dict. """
+    return (int(position['x']), int(position['y']), int(position['z']))
+
+
+def position_query(key, prefix='position'):
+    """ Return a Mongo query matching a model at the (x, y, z) key. """
+    return {prefix + '.x': key[0], prefix + '.y': key[1], prefix + '.z': key[2]}
+
+
+def validate_model(model):
+    """Validate a single model dict and return a clean copy.
+
+    Keyword arguments:
+    model -- Dict with type, position and color keys.
+
+    Raises ValueError if the model is malformed.
+    """
+    try:
+        key = position_key(model['position'])
+        model_type = model['type']
+        color = model['color']
+    except (KeyError, TypeError, ValueError):
+        raise ValueError("Malformed model")
+    if model_type not in model_types:
+        raise ValueError("Invalid model type")
+    if type(color) is not str or not color_pattern.match(color):
+        raise ValueError("Invalid color")
+    if not all(0 <= c < max_size for c in key):
+        raise ValueError("Position out of bounds")
+    return {'type': model_type, 'position': {'x': key[0], 'y': key[1], 'z': key[2]}, 'color': color}
+
+
+def valid_color(color):
+    valid = color_table.get(color)
+    if valid is None:
+        if len(color_table) >= color_table_size:
+            color_table.clear()
+        valid = color_table[color] = color_pattern.match(color) is not None
+    return valid
+
+
+def validate_models(models, width, height, depth):
+    """Validate every model of a map payload at once.
+
+    Keyword arguments:
+    models -- List of model dicts.
+    width, height, depth -- Size of the map the models must fit in.
+
+    Returns the clean model dicts and a list of {index, error} for every
+    invalid model, with one error per model. Raises ValueError if the
+    models are not a list or the size is invalid.
+    """
+    if type(models) is not list:
+        raise ValueError("Models must be a list")
+    size = (width, height, depth)
+    if not all(type(length) is int and 1 <= length <= max_size for length in size):
+        raise ValueError("Invalid map size")
+
+    # The only per model Python work: pull fields out of the JSON.
+    count = len(models)
+    clean, flat, codes, colors = [], [], [], []
+    malformed = np.zeros(count, dtype=bool)
+    for index, model in enumerate(models):
+        try:
+            position = model['position']
+            x, y, z = position['x'], position['y'], position['z']
+            model_type, color = model['type'], model['color']
+            if type(x) is not int or type(y) is not int or type(z) is not int:
+                raise TypeError
+        except (KeyError, TypeError):
+            malformed[index] = True
+            x = y = z = model_type = color = None
+        flat.extend((x or 0, y or 0, z or 0))
+        codes.append(type_codes.get(model_type, -1) if type(model_type) is str else -1)
+        colors.append(color if type(color) is str else None)
+        clean.append({'type': model_type, 'position': {'x': x, 'y': y, 'z': z}, 'color': color})
+
+    try:
+        coords = np.array(flat, dtype=np.int64).reshape(count, 3)
+    except OverflowError:
+        coords = np.array([min(max(c, -1), max_size) for c in flat], dtype=np.int64).reshape(count, 3)
+    bad_type = np.array(codes, dtype=np.int8) < 0
+    invalid_colors = {color for color in set(colors) if color is None or not valid_color(color)}
+    bad_color = np.array([color in invalid_colors for color in colors], dtype=bool)
+    out_of_bounds = ((coords < 0) | (coords >= np.array(size))).any(axis=1)
+
+    # Later models landing on an occupied cell are duplicates.
+    placed = np.flatnonzero(~(malformed | out_of_bounds))
+    cells = coords[placed, 0] + width * (coords[placed, 1] + height * coords[placed, 2])
+    order = np.argsort(cells, kind='mergesort')
+    repeated = cells[order][1:] == cells[order][:-1]
+    duplicate = np.zeros(count, dtype=bool)
+    duplicate[placed[order][1:][repeated]] = True
+
+    checks = [(malformed, "Malformed model"), (bad_type, "Invalid model type"), (bad_color, "Invalid color"),
+              (out_of_bounds, "Position out of bounds"), (duplicate, "Position already occupied")]
+    reason = np.select([mask for mask, _ in checks], np.arange(len(checks)), default=-1)
+    errors = [{'index': int(index), 'error': checks[reason[index]][1]} for index in np.flatnonzero(reason >= 0)]
+    return clean, errors
+
+
+def summarize(models):
+    """Return the precomputed summary stored with a map.
+
+    Keyword arguments:
+    models -- List of model dicts or GameModel documents.
+
+    Returns a dict with the voxel count and, for non empty maps, the bounding box.
+    """
+    if len(models) == 0:
+        return {'voxel_count': 0}
+    keys = [position_key(model['position']) for model in models]
+    xs, ys, zs = zip(*keys)
+    return {'voxel_count': len(models),
+            'min': {'x': min(xs), 'y': min(ys), 'z': min(zs)},
+            'max': {'x': max(xs), 'y': max(ys), 'z': max(zs)}}
+
+
+def nearest_first(models, width, depth):
+    """Order models from the center of the map's floor outward.
+
+    Keyword arguments:
+    models -- List of model dicts.
+    width, depth -- Size of the map along x and z.
+
+    Returns a new list, nearest to the floor's center first, ties in their original order.
+    """
+    if len(models) == 0:
+        return []
+    keys = np.array([position_key(model['position']) for model in models], dtype=np.int64)
+    # Doubled coordinates keep the center of even sized maps on the integer grid.
+    distance = (2 * keys[:, 0] - (width - 1)) ** 2 + (2 * keys[:, 1]) ** 2 + (2 * keys[:, 2] - (depth - 1)) ** 2
+    return [models[index] for index in np.argsort(distance, kind='mergesort')]
+
+
+class MapChanges():
+    """ A batch of add, remove and recolor operations keyed by position. """
+
+    def __init__(self, add=None, remove=None, recolor=None):
+        """Init function for MapChanges class.
+
+        Keyword arguments:
+        add -- Dict of position key to model dict. A model replaces whatever is at its position.
+        remove -- Set of position keys to clear.
+        recolor -- Dict of position key to new color.
+        """
+        self.add = add or {}
+        self.remove = remove or set()
+        self.recolor = recolor or {}
+
+    @staticmethod
+    def from_json(changes):
+        """Build a validated batch from a request body.
+
+        Keyword arguments:
+        changes -- Dict with optional add, remove and recolor lists.
+
+        Raises ValueError if any operation is malformed.
+        """
+        if type(changes) is not dict:
+            raise ValueError("Malformed changes")
+        add, remove, recolor = {}, set(), {}
+        try:
+            for position in changes.get('remove', []):
+                key = position_key(position)
+                remove.add(key)
+                add.pop(key, None)
+            for model in changes.get('add', []):
+                model = validate_model(model)
+                add[position_key(model['position'])] = model
+            for entry in changes.get('recolor', []):
+                key = position_key(entry['position'])
+                color = entry['color']
+                if type(color) is not str or not color_pattern.match(color):
+                    raise ValueError("Invalid color")
+                if key in add:
+                    add[key]['color'] = color
+                else:
+                    recolor[key] = color
+        except (KeyError, TypeError, AttributeError):
+            raise ValueError("Malformed changes")
+        return MapChanges(add, remove, recolor)
+
+    def is_empty(self):
+        return not (self.add or self.remove or self.recolor)
+
+    def check_bounds(self, width, height, depth):
+        """Check every added model fits in a map.
+
+        Keyword arguments:
+        width, height, depth -- Size of the map the batch applies to.
+
+        Raises ValueError if a model would be placed outside the map.
+        """
+        for x, y, z in self.add:
+            if not (x < width and y < height and z < depth):
+                raise ValueError("Position out of bounds")
+
+    def keys(self):
+        """ Return the set of every position key the batch touches. """
+        return self.remove | set(self.add) | set(self.recolor)
+
+    def pull_update(self):
+        """ Mongo update that clears every position being removed or replaced. """
+        keys = self.remove | set(self.add)
+        if not keys:
+            return None
+        return {'$pull': {'models': {'$or': [position_query(key) for key in sorted(keys)]}}}
+
+    def recolor_update(self):
+        """ Mongo update and array filters that recolor models in place. """
+        if not self.recolor:
+            return None, None
+        update, array_filters = {}, []
+        for i, (key, color) in enumerate(sorted(self.recolor.items())):
+            update['models.$[r' + str(i) + '].color'] = color
+            array_filters.append(position_query(key, 'r' + str(i) + '.position'))
+        return {'$set': update}, array_filters
+
+    def push_update(self):
+        """ Mongo update that appends the new models. """
+        if not self.add:
+            return None
+        return {'$push': {'models': {'$each': [self.add[key] for key in sorted(self.add)]}}}
+
+    def apply(self, models):
+        """Apply the batch to a list of model dicts in memory.
+
+        Keyword arguments:
+        models -- The current models of the map.
+
+        Returns the new list of models.
+        """
+        cleared = self.remove | set(self.add)
+        result = []
+        for model in models:
+            key = position_key(model['position'])
+            if key in cleared:
+                continue
+            if key in self.recolor:
+                model = dict(model, color=self.recolor[key])
+            result.append(model)
+        result.extend(self.add[key] for key in sorted(self.add))
+        return result
+
+    def apply_by_position(self, models):
+        """Apply the batch in place to models indexed by position.
+
+        Keyword arguments:
+        models -- Dict of position key to model dict.
+        """
+        for key in self.remove | set(self.add):
+            models.pop(key, None)
+        for key, color in self.recolor.items():
+            if key in models:
+                models[key] = dict(models[key], color=color)
+        models.update(self.add)
+
+    def to_diff(self):
+        """ Return the batch as an added/removed/changed diff for clients. """
+        return {
+            'added': [self.add[key] for key in sorted(self.add)],
+            'removed': [{'x': key[0], 'y': key[1], 'z': key[2]} for key in sorted(self.remove - set(self.add))],
+            'changed': [{'position': {'x': key[0], 'y': key[1], 'z': key[2]}, 'color': color}
+                        for key, color in sorted(self.recolor.items())],
+        }
+
+
+def model_changes(old_models, new_models):
+    """Compute the batch of changes turning one list of model dicts into another.
+
+    Keyword arguments:
+    old_models -- The models before the edit.
+    new_models -- The models after the edit.
+
+    Returns a MapChanges batch.
+    """
+    old = {position_key(model['position']): model for model in old_models}
+    new = {position_key(model['position']): model for model in new_models}
+    changes = MapChanges()
+    for key, model in new.items():
+        previous = old.get(key)
+        if previous is None or previous['type'] != model['type']:
+            changes.add[key] = model
+        elif previous['color'] != model['color']:
+            changes.recolor[key] = model['color']
+    changes.remove = set(old) - set(new)
+    return changes
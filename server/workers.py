@@ -0,0 +1,169 @@
+import os
+import socket as sockets
+from json import dumps, loads
+
+import redis
+
+prefix = 'sockets:'
+
+# Every worker listens here for edited maps and changed sessions, and sends
+# them on to its own clients, see WorkerRegistry.sessions.
+maps_channel = prefix + 'maps'
+
+# Deletes a key only if it still holds the given value, so a worker never
+# drops a lease another worker has taken over.
+release_script = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+class WorkerRegistry():
+    """ Shared view of every socket worker, kept in Redis.
+
+    Tracks the rooms of this worker's clients and which worker owns the live
+    state of each map. A map is edited by one worker at a time: the owner
+    holds a lease that it renews while it keeps the map in memory, and other
+    workers forward edits to it over pub/sub. Edited maps are announced to
+    every worker on maps_channel, and each sends them to its own clients.
+    """
+
+    def __init__(self, app=None):
+        """Init function for WorkerRegistry class.
+
+        Keyword arguments:
+        app -- Optional Flask app to bind to immediately.
+        """
+        self.redis = None
+        self.worker_id = None
+        self.memberships = {}
+        self.held = set()
+        # Session code to the map it shows and its sub-rooms with clients on this worker.
+        self.sessions = {}
+        self.listening = {}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app, port=None):
+        """Connect to Redis.
+
+        Keyword arguments:
+        app -- The Flask app. Uses REDIS_HOST and the SOCKET_* settings.
+        port -- The port this worker listens on, part of its id.
+        """
+        self.redis = redis.StrictRedis(host=app.config.get('REDIS_HOST') or 'localhost')
+        self.worker_id = sockets.gethostname() + ':' + str(port or os.getpid())
+        self.lease_ttl = app.config.get('SOCKET_LEASE_TTL', 10)
+        self.release = self.redis.register_script(release_script)
+        app.extensions['workers'] = self
+
+    def channel(self, worker_id):
+        return prefix + 'worker:' + worker_id + ':edits'
+
+    def join(self, code, sid):
+        """ Record that a client of this worker is in a room. """
+        self.memberships.setdefault(sid, set()).add(code)
+
+    def listen_to(self, code, map_id, room, sid):
+        """Record that a client of this worker gets the edits of a map in one of a session's sub-rooms.
+
+        Keyword arguments:
+        code -- Code of the session, lower case.
+        map_id -- ObjectId of the map shown in the session.
+        room -- The sub-room, see constants.diff_room and update_room.
+        sid -- The client's socket id.
+        """
+        session = self.sessions.setdefault(code, {'map_id': map_id, 'rooms': {}})
+        session['map_id'] = map_id
+        session['rooms'].setdefault(room, set()).add(sid)
+        self.listening.setdefault(sid, set()).add(code)
+
+    def rooms_showing(self, map_id):
+        """ Return the sub-rooms with clients on this worker of every session showing a map. """
+        return [room for session in self.sessions.values() if session['map_id'] == map_id
+                for room in session['rooms']]
+
+    def session_rooms(self, code):
+        """ Return the sub-rooms of a session with clients on this worker. """
+        session = self.sessions.get(code)
+        return [] if session is None else list(session['rooms'])
+
+    def move(self, code, map_id):
+        """ Point a session with clients on this worker at another map. """
+        if code in self.sessions:
+            self.sessions[code]['map_id'] = map_id
+
+    def forget(self, code):
+        """ Drop a closed session. Its clients are no longer in its rooms. """
+        self.sessions.pop(code, None)
+
+    def leave(self, sid):
+        """ Forget a disconnected client. Returns the rooms it was in. """
+        for code in self.listening.pop(sid, set()):
+            session = self.sessions.get(code)
+            if session is None:
+                continue
+            for room, members in list(session['rooms'].items()):
+                members.discard(sid)
+                if len(members) == 0:
+                    del session['rooms'][room]
+            if len(session['rooms']) == 0:
+                del self.sessions[code]
+        return self.memberships.pop(sid, set())
+
+    def renew(self):
+        """ Renew the leases of the maps this worker holds. """
+        pipe = self.redis.pipeline()
+        for map_id in self.held:
+            pipe.expire(prefix + 'map:' + str(map_id), self.lease_ttl)
+        pipe.execute()
+
+    def claim(self, map_id):
+        """Take the lease on a map if nobody holds it.
+
+        Returns the id of the worker owning the map, which may be this one.
+        """
+        key = prefix + 'map:' + str(map_id)
+        if self.redis.set(key, self.worker_id, nx=True, ex=self.lease_ttl):
+            self.held.add(map_id)
+            return self.worker_id
+        owner = self.redis.get(key)
+        if owner is None:
+            # The lease expired between the two calls.
+            return self.claim(map_id)
+        owner = owner.decode()
+        if owner == self.worker_id:
+            self.held.add(map_id)
+        return owner
+
+    def hold(self, map_ids):
+        """ Release the leases of maps this worker no longer keeps in memory. """
+        for map_id in self.held - set(map_ids):
+            self.release(keys=[prefix + 'map:' + str(map_id)], args=[self.worker_id])
+        self.held &= set(map_ids)
+
+    def forward(self, owner, map_id, changes):
+        """ Send an edit to the worker owning the map. Returns False if that worker is gone. """
+        message = dumps({'map_id': str(map_id), 'changes': changes})
+        return self.redis.publish(self.channel(owner), message) > 0
+
+    def publish(self, message):
+        """ Send a message to every worker, see maps_channel. """
+        self.redis.publish(maps_channel, dumps(message))
+
+    def listen(self):
+        """ Yield every message forwarded to this worker or sent to every worker, as a dict. Blocks. """
+        pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(self.channel(self.worker_id), maps_channel)
+        for message in pubsub.listen():
+            try:
+                data = loads(message['data'].decode())
+            except (ValueError, AttributeError):
+                continue
+            if isinstance(data, dict):
+                yield data
+
+
+workers = WorkerRegistry()
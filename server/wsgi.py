@@ -0,0 +1,8 @@
+import os
+
+from server import create_app, deploy_config
+
+# Entry point for production servers, e.g.
+#   gunicorn -c gunicorn_config.py wsgi:app
+# Set DEPLOY=1 to use the docker-compose hosts for Mongo and Redis.
+app = create_app(**(deploy_config if os.environ.get('DEPLOY') else {}))